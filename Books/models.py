@@ -2,14 +2,17 @@ from django.db import models
 from Polls.models import (Transaction, Account, Report, Report_Archive,
                             TransactionReport, Login)
 from collections import defaultdict
+from itertools import islice
+from Polls.util.db_routing import replica_reads
 from Polls.util.vts import VtsLinkGenerator
+from Polls.util.vts_cache import CachedVtsLinkGenerator
 from Polls.logger import Logger
 from django.core.exceptions import ValidationError
 from django.core.validators import validate_email
 
 
 logger = Logger()
-vts_link_gen = VtsLinkGenerator(logger)
+vts_link_gen = CachedVtsLinkGenerator(VtsLinkGenerator(logger))
 
 
 class EmptyReport(object):
@@ -23,10 +26,74 @@ class EmptyReport(object):
         return self._fixed_attrs.get(attr, 'Unknown')
 
 
+class PackagesLoader(object):
+    '''Builds the FrontendUser.packages() structure (credit transactions with
+    their reports and remaining credits) using a fixed number of queries:
+    one for the transactions (joined with their reports and conditions) and,
+    if requested, one for the archived reports (joined via TransactionReport).'''
+
+    PULL_TYPE = 200
+
+    def __init__(self, show_archived_reports=False):
+        self.show_archived_reports = show_archived_reports
+
+    def load(self, account):
+        return self.load_many([account]).get(account.id, [])
+
+    def load_many(self, accounts):
+        '''Returns {account_id: packages} for all given accounts using the same
+        fixed number of queries as for a single account.'''
+
+        account_ids = [acc.id for acc in accounts]
+        transactions = defaultdict(list)
+        for transaction in Transaction.objects.filter(account__in=account_ids) \
+                                              .select_related('report', 'condition') \
+                                              .order_by('-id'):
+            transactions[transaction.account_id].append(transaction)
+        archived_reports = self._archived_reports(account_ids) if self.show_archived_reports else {}
+        return dict((acc_id, self._build(transactions.get(acc_id, []), archived_reports)) for acc_id in account_ids)
+
+    def _archived_reports(self, account_ids):
+        '''Maps transaction_id -> {report_id: Report_Archive} for all archived pulls of the accounts.'''
+
+        archived_reports = defaultdict(dict)
+        for tr in TransactionReport.objects.filter(transaction__account__in=account_ids,
+                                                   transaction__t_type=self.PULL_TYPE).select_related('report'):
+            archived_reports[tr.transaction_id][tr.report_id] = tr.report
+        return archived_reports
+
+    def _build(self, transactions, archived_reports):
+        packages_container = []
+        reports = defaultdict(list)
+        pulled_report_count = defaultdict(int)
+        for transaction in transactions:
+            if Transaction.is_credit(transaction.t_type):
+                packages_container.append(transaction)
+            elif transaction.t_type == self.PULL_TYPE:
+                pulled_report_count[transaction.t_ref_id] += 1
+                if transaction.report_id:
+                    report = transaction.report
+                    report.active = True
+                    report.vts_link = vts_link_gen.get_vts_link(report)
+                    reports[transaction.t_ref_id].append(report)
+                elif self.show_archived_reports:
+                    for report in archived_reports.get(transaction.id, {}).values():
+                        report.active = False
+                        report.vts_link = vts_link_gen.get_vts_link(report)
+                        reports[transaction.t_ref_id].append(report)
+
+        for transaction in packages_container:
+            transaction.reports = sorted(reports.get(transaction.t_ref_id, []), key=lambda x: x.id, reverse=True)
+            transaction.remaining_credits = transaction.qty - pulled_report_count.get(transaction.t_ref_id, 0) if not transaction.condition_id.endswith('UNLIMITED') else 'INF'
+
+        return packages_container
+
+
 class FrontendPaymentItem(models.Model):
     class Meta:
         #app_label = 'backofficedddddddddddddddddd'
         db_table = 'carfax_payment_item'
+        index_together = (('mail', 'cpid'),)   # keyset paging of FrontendUser.payments_page()
 
     cpid = models.IntegerField(primary_key=True)
     coid = models.CharField(max_length=16)
@@ -44,7 +111,8 @@ class FrontendPaymentItem(models.Model):
 
 class FrontendUser(models.Model):
 
-    CREDIT_RANGE = range(100, 199)
+    BULK_CHUNK_SIZE = 500  # users per set-based query (keeps IN (...) lists and memory bounded)
+    PAYMENTS_PAGE_SIZE = 50
 
     class Meta:
         #app_label = 'backoffice'
@@ -56,11 +124,53 @@ class FrontendUser(models.Model):
     login = models.IntegerField()
 
     def clean(self):
-        all_emails = [login.login for login in Login.objects.all()]
-        if self.mail in all_emails:
+        if Login.login_exists(self.mail):
             raise ValidationError("This email already exists as a B2B user!")
         validate_email(self.mail)
 
+    @classmethod
+    def iter_packages(cls, users, show_archived_reports=False, chunk_size=BULK_CHUNK_SIZE):
+        '''Attaches packages_container to many users (uids or FrontendUser instances)
+        using set-based queries per chunk of chunk_size users; yields the users
+        (in the given order) chunk by chunk so memory stays bounded.
+        Unknown uids are skipped.'''
+
+        users = iter(users)
+        while True:
+            chunk = list(islice(users, chunk_size))
+            if not chunk:
+                break
+            uids = [user for user in chunk if not isinstance(user, FrontendUser)]
+            with replica_reads():
+                known_users = cls.objects.in_bulk(uids) if uids else {}
+            chunk = [user if isinstance(user, FrontendUser) else known_users.get(user) for user in chunk]
+            chunk = [user for user in chunk if user is not None]
+
+            pending = defaultdict(list)     # uid -> instances (a uid may occur more than once)
+            for user in chunk:
+                if not hasattr(user, 'packages_container'):
+                    pending[user.uid].append(user)
+            if pending:
+                with replica_reads():
+                    accounts = list(Account.objects.filter(ext_usr_ref__in=pending.keys()))
+                    packages = PackagesLoader(show_archived_reports).load_many(accounts)
+                for acc in accounts:
+                    for user in pending.pop(acc.ext_usr_ref, ()):
+                        user.packages_container = packages[acc.id]
+                for users_without_account in pending.values():
+                    for user in users_without_account:
+                        user.packages_container = []
+
+            for user in chunk:
+                yield user
+
+    @classmethod
+    def bulk_packages(cls, users, show_archived_reports=False, chunk_size=BULK_CHUNK_SIZE):
+        '''Returns the list of users (see iter_packages) with packages_container attached.'''
+
+        return list(cls.iter_packages(users, show_archived_reports, chunk_size))
+
+    @replica_reads()
     def packages(self, show_archived_reports=False):
         if not hasattr(self, 'packages_container'):
             try:
@@ -69,41 +179,41 @@ class FrontendUser(models.Model):
                 self.packages_container = []
                 return self.packages_container
 
-            packages_container = []
-            reports = defaultdict(list)
-            pulled_report_count = defaultdict(int)
-            for transaction in Transaction.objects.filter(account=acc).order_by('-id'):
-                if transaction.t_type in FrontendUser.CREDIT_RANGE:
-                    packages_container.append(transaction)
-                elif transaction.t_type == 200:
-                    pulled_report_count[transaction.t_ref_id] += 1
-                    if transaction.report_id:
-                        report = Report.objects.get(pk=transaction.report_id)
-                        report.active = True
-                        report.vts_link = vts_link_gen.get_vts_link(report)
-                        reports[transaction.t_ref_id].append(report)
-                    elif show_archived_reports:
-                        for report in Report_Archive.objects.filter(id__in=[tr.report_id for tr in TransactionReport.objects.filter(transaction_id=transaction.id)]):
-                            report.active = False
-                            report.vts_link = vts_link_gen.get_vts_link(report)
-                            reports[transaction.t_ref_id].append(report)
-                    else:
-                        continue
-
-            for transaction in packages_container:
-                transaction.reports = sorted(reports.get(transaction.t_ref_id, []), key=lambda x: x.id, reverse=True)
-                transaction.remaining_credits = transaction.qty - pulled_report_count.get(transaction.t_ref_id, 0) if not transaction.condition_id.endswith('UNLIMITED') else 'INF'
-
-            self.packages_container = list(packages_container)
+            self.packages_container = PackagesLoader(show_archived_reports).load(acc)
 
         return self.packages_container
 
     def payments(self):
         if not hasattr(self, 'payments_container'):
-            self.payments_container = list(FrontendPaymentItem.objects.filter(mail=self.mail).order_by('-cpid'))
+            self.payments_container = list(self.iter_payments())
 
         return self.payments_container
 
+    @replica_reads()
+    def payments_page(self, before=None, limit=PAYMENTS_PAGE_SIZE):
+        '''Returns (payment items, cursor): up to limit items, newest first, with cpid < before
+        (keyset paging on (mail, cpid): every page costs the same). cursor is the before value
+        of the next page or None on the last page.'''
+
+        items = FrontendPaymentItem.objects.filter(mail=self.mail)
+        if before is not None:
+            items = items.filter(cpid__lt=before)
+        items = list(items.order_by('-cpid')[:limit + 1])
+        if len(items) > limit:
+            return items[:limit], items[limit - 1].cpid
+        return items, None
+
+    def iter_payments(self, chunk_size=BULK_CHUNK_SIZE):
+        '''Yields all payment items, newest first, fetching chunk_size rows per query.'''
+
+        before = None
+        while True:
+            items, before = self.payments_page(before, chunk_size)
+            for item in items:
+                yield item
+            if before is None:
+                break
+
 
 
 def not_existing_frontend_user(mail_addr):
@@ -1,3 +1,116 @@
+import datetime
+
 from django.test import TestCase
+from django.utils import timezone
+
+from Books.models import FrontendPaymentItem, FrontendUser, PackagesLoader
+from Polls.models import (Account, Batch, Condition, Report, Report_Archive, ReportType, Requester,
+                          Transaction, TransactionReference, TransactionReport)
+
+
+class IterPackagesTest(TestCase):
+
+    def setUp(self):
+        requester = Requester.objects.create(desc='test', legal_entity='SE')
+        condition = Condition.objects.create(id='SE_VHR_5', requester=requester, price=100)
+        account = Account.objects.create(ext_usr_ref=1)
+        t_ref = TransactionReference()
+        t_ref.save()
+        self.credit = Transaction.objects.create(t_ref=t_ref, account=account, t_type=100,
+                                                 condition=condition, qty=5)
+
+    def test_duplicate_instances(self):
+        users = [FrontendUser(uid=1), FrontendUser(uid=1), FrontendUser(uid=2)]
+        self.assertEqual(FrontendUser.bulk_packages(users), users)
+        for user in users[:2]:
+            self.assertEqual([t.id for t in user.packages_container], [self.credit.id])
+            self.assertEqual(user.packages_container[0].remaining_credits, 5)
+        self.assertEqual(users[2].packages_container, [])
+
+
+class PackagesLoaderTest(TestCase):
+
+    def setUp(self):
+        requester = Requester.objects.create(desc='test', legal_entity='SE')
+        self.limited = Condition.objects.create(id='SE_VHR_5', requester=requester, price=100)
+        self.unlimited = Condition.objects.create(id='SE_VHR_UNLIMITED', requester=requester, price=1000)
+        self.report_type = ReportType.objects.create(id='VHR_SE')
+        self.account = Account.objects.create(ext_usr_ref=1)
+        batch = Batch.objects.create()
+
+        self.credit, t_ref = self.transaction(None, 100, self.limited, qty=5)
+        self.live = self.pull(t_ref, 'LIVE')
+        archived_pull = self.transaction(t_ref, 200, self.limited)[0]
+        self.archived = Report_Archive.objects.create(id=1000, account_id=self.account.id, report_type_id='VHR_SE',
+                                                      report_ref='ARCHIVED', query='ARCHIVED',
+                                                      created=timezone.now(), batch=batch)
+        TransactionReport.objects.create(transaction=archived_pull, report=self.archived, batch=batch)
+
+        self.unlimited_credit, t_ref = self.transaction(None, 100, self.unlimited, qty=1)
+        self.pull(t_ref, 'UNLIMITED')
+        self.last_credit = self.transaction(None, 199, self.limited, qty=1)[0]
+
+    def transaction(self, t_ref, t_type, condition, **kwargs):
+        if t_ref is None:
+            t_ref = TransactionReference()
+            t_ref.save()
+        return Transaction.objects.create(t_ref=t_ref, account=self.account, t_type=t_type, condition=condition,
+                                          **kwargs), t_ref
+
+    def pull(self, t_ref, ref):
+        report = Report.objects.create(account=self.account, report_type=self.report_type, report_ref=ref, query=ref)
+        self.transaction(t_ref, 200, self.limited, report=report)
+        return report
+
+    def summary(self, packages):
+        return [(t.id, t.remaining_credits, [(report.id, report.active) for report in t.reports]) for t in packages]
+
+    def test_packages(self):
+        with self.assertNumQueries(2):      # account, transactions
+            packages = FrontendUser(uid=1).packages()
+        self.assertEqual(self.summary(packages), [
+            (self.last_credit.id, 1, []),
+            (self.unlimited_credit.id, 'INF', [(self.live.id + 1, True)]),
+            (self.credit.id, 3, [(self.live.id, True)]),
+        ])
+
+    def test_archived_reports(self):
+        with self.assertNumQueries(3):      # account, transactions, archived reports
+            packages = FrontendUser(uid=1).packages(show_archived_reports=True)
+        self.assertEqual(self.summary(packages)[-1], (self.credit.id, 3, [(self.archived.id, False), (self.live.id, True)]))
+
+    def test_bulk_queries(self):
+        other = Account.objects.create(ext_usr_ref=2)
+        Transaction.objects.create(t_ref=self.credit.t_ref, account=other, t_type=100, condition=self.limited, qty=1)
+        users = [FrontendUser(uid=1), FrontendUser(uid=2), FrontendUser(uid=3)]
+        with self.assertNumQueries(3):      # accounts, transactions, archived reports (for all users)
+            FrontendUser.bulk_packages(users, show_archived_reports=True)
+        self.assertEqual(self.summary(users[0].packages_container),
+                         self.summary(PackagesLoader(show_archived_reports=True).load(self.account)))
+        self.assertEqual(len(users[1].packages_container), 1)
+        self.assertEqual(users[2].packages_container, [])
+
+
+class PaymentsPageTest(TestCase):
+
+    def setUp(self):
+        for cpid, mail in [(cpid, 'a@b.c') for cpid in range(1, 8)] + [(8, 'x@y.z'), (9, 'x@y.z')]:
+            FrontendPaymentItem.objects.create(cpid=cpid, coid='C%i' % cpid, mail=mail, amount=1.0, package='P',
+                                               status='1', timestamp=timezone.now() - datetime.timedelta(days=cpid),
+                                               vin='V', report_ref='R')
+        self.user = FrontendUser(uid=1, mail='a@b.c')
+
+    def cpids(self, page):
+        items, before = page
+        return [item.cpid for item in items], before
+
+    def test_pages(self):
+        self.assertEqual(self.cpids(self.user.payments_page(limit=3)), ([7, 6, 5], 5))
+        self.assertEqual(self.cpids(self.user.payments_page(5, limit=3)), ([4, 3, 2], 2))
+        self.assertEqual(self.cpids(self.user.payments_page(2, limit=3)), ([1], None))
+        self.assertEqual(self.cpids(self.user.payments_page(limit=7)), (range(7, 0, -1), None))
+        self.assertEqual(self.cpids(self.user.payments_page(1)), ([], None))
 
-# Create your tests here.
+    def test_iter_payments(self):
+        self.assertEqual([item.cpid for item in self.user.iter_payments(chunk_size=2)], range(7, 0, -1))
+        self.assertEqual([item.cpid for item in self.user.payments()], range(7, 0, -1))
@@ -27,6 +27,25 @@ TEMPLATE_DEBUG = True
 ALLOWED_HOSTS = []
 
 VTS_PRODUCTION = False
+
+# Runtime files (write-behind spool and lock files); created on demand, not versioned
+SPOOL_DIR = os.environ.get('MULTIAPP_SPOOL_DIR', os.path.join(BASE_DIR, 'var', 'spool'))
+
+# Viatel notifications which could not be written to the database (replayed on start)
+VIATEL_LOG_SPOOL = os.path.join(SPOOL_DIR, 'viatel_log.spool')
+
+# Polls.record_check.RcRecorder: RC/RcResult rows written behind the request
+RC_RECORDER_FLUSH_INTERVAL = 1.0   # max. seconds a record check waits in the buffer
+RC_RECORDER_SPOOL = os.path.join(SPOOL_DIR, 'rc_recorder.spool')
+
+# Polls.logger.Logger: queued (non-blocking) stdout logging
+LOGGER_JSON = False             # structured (JSON) output
+LOGGER_BUFFER_SIZE = 10000      # queued records
+LOGGER_OVERFLOW = 'drop'        # 'drop', 'drop_oldest' or 'block'
+
+# Polls.models.SessionResolver: shared cache alias (see CACHES; None = process-local cache only)
+SESSION_RESOLVER_CACHE = None
+
 # Application definition
 
 INSTALLED_APPS = (
@@ -48,8 +67,14 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'Polls.middleware.QueryProfilerMiddleware',
+    'Polls.middleware.DatabaseRoutingMiddleware',
 )
 
+# Per-request query count/DB time logging and N+1 detection (Polls.middleware)
+QUERY_PROFILER = False
+QUERY_PROFILER_N_PLUS_ONE = 10  # same query shape executed more often => N+1 suspect
+
 ROOT_URLCONF = 'MultiApp.urls'
 
 WSGI_APPLICATION = 'MultiApp.wsgi.application'
@@ -62,9 +87,19 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'CONN_MAX_AGE': 600,    # persistent connections (seconds); pool with pgbouncer in front of PostgreSQL
     }
 }
 
+# Polls.util.db_routing: Books (Drupal tables) use the 'drupal' connection if configured,
+# everything else 'default'; replica_reads() blocks may read from DATABASE_REPLICAS.
+# Local stand-ins, e.g.:
+#   DATABASES['drupal'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(BASE_DIR, 'drupal.sqlite3')}
+#   DATABASES['replica'] = dict(DATABASES['default'], TEST_MIRROR='default')
+#   DATABASE_REPLICAS = {'default': ['replica']}
+DATABASE_REPLICAS = {}
+DATABASE_ROUTERS = ['Polls.util.db_routing.DatabaseRouter']
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -9,4 +9,5 @@ urlpatterns = patterns('',
     # url(r'^blog/', include('blog.urls')),
 
     url(r'^admin/', include(admin.site.urls)),
+    url(r'^viatel/notify/$', 'Polls.views.viatel_notification', name='viatel_notification'),
 )
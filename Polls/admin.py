@@ -1,3 +1,209 @@
+import json
+
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList, ORDER_VAR, PAGE_VAR, SEARCH_VAR
+from django.core.paginator import Paginator
+from django.db import connections
+
+from Polls.models import Report, Transaction, ViatelLog
+
+
+# Changelists for the large tables: counts come from the planner's row estimate (no COUNT(*)
+# over millions of rows), pages are selected with keyset conditions on the primary key
+# (?before=<id>/?after=<id> instead of OFFSET), displayed FKs are joined (select_related)
+# and the filters only use indexed columns.
+
+EXACT_COUNT_LIMIT = 10000   # below this number of rows counts are exact
+KEYSET_BEFORE = 'before'
+KEYSET_AFTER = 'after'
+
+
+def _planner_estimate(queryset):
+    '''Row estimate of the database planner for queryset (None if the backend has none).'''
+
+    connection = connections[queryset.db]
+    sql, params = queryset.values_list('pk').order_by().query.sql_with_params()
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+        return int((json.loads(plan) if isinstance(plan, basestring) else plan)[0]['Plan']['Plan Rows'])
+    if connection.vendor == 'mysql':
+        cursor.execute('EXPLAIN ' + sql, params)
+        rows = [column[0] for column in cursor.description].index('rows')
+        return int(cursor.fetchone()[rows])
+    return None
+
+
+def estimated_count(queryset, limit=EXACT_COUNT_LIMIT):
+    '''Exact number of rows up to limit (the scan stops after limit + 1 rows), beyond that the
+    planner's estimate (exact COUNT(*) on backends without one, e.g. SQLite).'''
+
+    sql, params = queryset.values_list('pk').order_by()[:limit + 1].query.sql_with_params()
+    cursor = connections[queryset.db].cursor()
+    cursor.execute('SELECT COUNT(*) FROM (%s) capped' % sql, params)
+    count = cursor.fetchone()[0]
+    if count <= limit:
+        return count
+    estimate = _planner_estimate(queryset)
+    return queryset.count() if estimate is None else max(estimate, count)
+
+
+def _id_column(attname, title):
+    '''list_display column showing a raw FK value (no join, no query).'''
+
+    column = lambda self, obj: getattr(obj, attname)
+    column.short_description = title
+    column.admin_order_field = attname
+    return column
+
+
+class EstimatedCountPaginator(Paginator):
+
+    def _get_count(self):
+        if self._count is None:
+            self._count = estimated_count(self.object_list)
+        return self._count
+    count = property(_get_count)
+
+
+class KeysetChangeList(ChangeList):
+    '''Newest first, paged with ?before=<pk>/?after=<pk>. Sorting by a column falls back to
+    OFFSET paging (with estimated counts).'''
+
+    def get_filters_params(self, params=None):
+        lookup_params = super(KeysetChangeList, self).get_filters_params(params)
+        for var in (KEYSET_BEFORE, KEYSET_AFTER):
+            lookup_params.pop(var, None)
+        return lookup_params
+
+    def get_results(self, request):
+        self.keyset = ORDER_VAR not in self.params
+        if not self.keyset:
+            return super(KeysetChangeList, self).get_results(request)
+
+        per_page = self.list_per_page
+        before, after = self.params.get(KEYSET_BEFORE), self.params.get(KEYSET_AFTER)
+        queryset = self.queryset.order_by('-pk')
+        if after:
+            rows = list(queryset.filter(pk__gt=after).order_by('pk')[:per_page + 1])
+            has_newer, has_older = len(rows) > per_page, True
+            rows = rows[:per_page][::-1]
+        else:
+            if before:
+                queryset = queryset.filter(pk__lt=before)
+            rows = list(queryset[:per_page + 1])
+            has_newer, has_older = bool(before), len(rows) > per_page
+            rows = rows[:per_page]
+
+        self.newer_url = self.get_query_string({KEYSET_AFTER: rows[0].pk}, [KEYSET_BEFORE, PAGE_VAR]) \
+            if has_newer and rows else None
+        self.older_url = self.get_query_string({KEYSET_BEFORE: rows[-1].pk}, [KEYSET_AFTER, PAGE_VAR]) \
+            if has_older and rows else None
+
+        self.paginator = self.model_admin.get_paginator(request, self.queryset, per_page)
+        self.result_count = self.paginator.count
+        filtered = self.get_filters_params() or self.params.get(SEARCH_VAR)
+        self.full_result_count = estimated_count(self.root_queryset) if filtered else self.result_count
+        self.result_list = rows
+        self.can_show_all = False
+        self.multi_page = has_newer or has_older
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    '''Base ModelAdmin for tables with millions of rows.
+
+    select_related: FKs joined for the displayed columns (reference data FKs such as condition
+    or report_type are served by ReferenceData and need no join).
+    exact_search_fields: indexed fields searched by exact match (no LIKE scans).'''
+
+    paginator = EstimatedCountPaginator
+    change_list_template = 'admin/Polls/keyset_change_list.html'
+    list_per_page = 50
+    actions = None
+    select_related = ()
+    exact_search_fields = ()
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_queryset(self, request):
+        queryset = super(LargeTableAdmin, self).get_queryset(request)
+        return queryset.select_related(*self.select_related) if self.select_related else queryset
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        matches = None
+        for name in self.exact_search_fields:
+            field = self.model._meta.get_field(name)
+            try:
+                value = (field.rel.get_related_field() if field.rel else field).to_python(search_term)
+            except Exception:   # not a valid value for this field
+                continue
+            match = queryset.filter(**{name: value})
+            matches = match if matches is None else matches | match
+        return (queryset.none() if matches is None else matches), False
+
+
+class TransactionTypeFilter(admin.SimpleListFilter):
+    title = 'type'
+    parameter_name = 'type'
+
+    def lookups(self, request, model_admin):
+        return (('credit', 'Credits (1xx)'), ('pull', 'Pulls (%i)' % Transaction.PULL_TYPE))
+
+    def queryset(self, request, queryset):
+        if self.value() == 'credit':
+            return queryset.filter(t_type__range=Transaction.CREDIT_TYPES)
+        if self.value() == 'pull':
+            return queryset.filter(t_type=Transaction.PULL_TYPE)
+        return queryset
+
+
+class TransactionAdmin(LargeTableAdmin):
+    list_display = ('id', 'created', 't_type', 'account_ref', 't_ref_ref', 'condition_ref', 'qty', 'report_ref', 'expires_on')
+    list_filter = (TransactionTypeFilter, 'created')
+    select_related = ('account', 'report')
+    exact_search_fields = ('id', 't_ref', 'account')
+    search_fields = ('t_ref',)  # shows the search box (see exact_search_fields)
+    raw_id_fields = ('t_ref', 'account', 'sub_account', 'rcresult', 'report', 'asset')
+
+    t_ref_ref = _id_column('t_ref_id', 'reference')
+    condition_ref = _id_column('condition_id', 'condition')
+
+    def account_ref(self, obj):
+        return obj.account.org_ref or obj.account.ext_usr_ref
+    account_ref.short_description = 'account'
+
+    def report_ref(self, obj):
+        return obj.report.report_ref if obj.report_id else ''
+    report_ref.short_description = 'report'
+
+
+class ReportAdmin(LargeTableAdmin):
+    list_display = ('id', 'created', 'report_type_ref', 'report_ref', 'account_ref', 'expires_on')
+    list_filter = ('report_type', 'created')
+    select_related = ('account',)
+    exact_search_fields = ('id', 'account', 'token')
+    search_fields = ('id',)
+    raw_id_fields = ('account', 'parent', 'token')
+
+    report_type_ref = _id_column('report_type_id', 'report type')
+
+    def account_ref(self, obj):
+        return obj.account.org_ref or obj.account.ext_usr_ref
+    account_ref.short_description = 'account'
+
+
+class ViatelLogAdmin(LargeTableAdmin):
+    list_display = ('id', 'time', 'prn', 'input', 'caller', 'rate', 'currency', 'duration')
+    list_filter = ('time',)
+    exact_search_fields = ('input',)
+    search_fields = ('input',)
+
 
-# Register your models here.
+admin.site.register(Transaction, TransactionAdmin)
+admin.site.register(Report, ReportAdmin)
+admin.site.register(ViatelLog, ViatelLogAdmin)
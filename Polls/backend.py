@@ -0,0 +1,443 @@
+'''
+Backend maintenance tasks (archiving, roll-overs, expiry).
+
+All tasks work in bounded chunks (one transaction per chunk) using set-based
+statements, and are registered under a maintenance Batch, so an interrupted
+run can be resumed with the same batch id.
+'''
+
+import datetime
+import time
+
+from collections import defaultdict
+
+from django.db import connection
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from Polls.logger import Logger
+from Polls.models import (Account, Batch, Condition, CreditBalance, ExpirySweep, Report, Report_Archive, ReportType, Transaction,
+                          Transaction_Archive, TransactionReport, TransactionReport_Archive, Receipt, Receipt_Archive)
+
+
+class Backend(object):
+
+    ARCHIVE_CHUNK_SIZE = 500  # root reports/transaction references per chunk (keeps IN (...) lists and locks short)
+    DELETE_CHUNK_SIZE = 500   # rows per DELETE statement
+    EXPIRY_CHUNK_SIZE = 500   # expired rows/backfilled rows per transaction
+    CASE_CHUNK_SIZE = 300     # rows per UPDATE ... CASE statement (3 parameters per row)
+    CREDIT_TYPES = Transaction.CREDIT_TYPES
+    PULL_TYPE = Transaction.PULL_TYPE
+
+    def __init__(self, logger=None):
+        self.logger = logger or Logger()
+
+    def _get_batch(self, batch):
+        '''Returns the given Batch (instance or id), or a new one.'''
+
+        if batch is None:
+            return Batch.objects.create()
+        if isinstance(batch, Batch):
+            return batch
+        return Batch.objects.get(pk=batch)
+
+    def _execute(self, sql, params):
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        return cursor.rowcount
+
+    def reports_archive_all(self, batch=None, chunk_size=ARCHIVE_CHUNK_SIZE, expired_before=None, max_chunks=None):
+        '''Moves expired reports into Report_Archive, replacing Transaction.report links by
+        TransactionReport rows and deleting the original reports.
+
+        Linked reports (Report.parent) are archived together with their parent report.
+        Every chunk is a single transaction of INSERT ... SELECT/UPDATE/DELETE statements;
+        re-running with the same batch continues where an interrupted run stopped.
+
+        Returns (batch, number of archived reports).'''
+
+        batch = self._get_batch(batch)
+        expired_before = expired_before or timezone.now()
+        self.logger.info('Report archiving (batch %i): reports expired before %s' % (batch.id, expired_before))
+
+        archived, chunks, last_id = 0, 0, 0
+        while max_chunks is None or chunks < max_chunks:
+            root_ids = list(Report.objects.filter(id__gt=last_id, parent__isnull=True, expires_on__lt=expired_before)
+                                          .order_by('id').values_list('id', flat=True)[:chunk_size])
+            if not root_ids:
+                break
+            with transaction.atomic():
+                archived += self._archive_reports(batch, root_ids)
+            last_id = root_ids[-1]
+            chunks += 1
+            self.logger.info('Report archiving (batch %i): %i report(s) archived, last id %i' % (batch.id, archived, last_id))
+
+        return batch, archived
+
+    def _archive_reports(self, batch, root_ids):
+        '''Archives the given root reports with their linked reports; returns the number of archived reports.
+        Reports whose id (or a linked report's id) is already taken in Report_Archive are left untouched.'''
+
+        qn = connection.ops.quote_name
+        children = list(Report.objects.filter(parent__in=root_ids).values_list('id', 'parent'))
+        conflicts = set(Report_Archive.objects.filter(id__in=root_ids + [id for id, _ in children]).values_list('id', flat=True))
+        if conflicts:
+            conflicts.update(parent for id, parent in children if id in conflicts)
+            self.logger.error('Report archiving (batch %i): report(s) %s already archived, skipped' % (
+                batch.id, ', '.join(str(id) for id in sorted(conflicts))))
+            root_ids = [id for id in root_ids if id not in conflicts]
+            children = [(id, parent) for id, parent in children if parent not in conflicts]
+            if not root_ids:
+                return 0
+        child_ids = [id for id, _ in children]
+        report_table, archive_table = qn(Report._meta.db_table), qn(Report_Archive._meta.db_table)
+        report_pk = qn(Report._meta.pk.column)
+        t_table, t_report = qn(Transaction._meta.db_table), qn(Transaction._meta.get_field('report').column)
+
+        report_columns = dict((field.attname, field.column) for field in Report._meta.fields)
+        archive_columns, select_columns = [], []
+        for field in Report_Archive._meta.fields:
+            archive_columns.append(qn(field.column))
+            select_columns.append('%s' if field.attname == 'batch_id' else 'r.' + qn(report_columns[field.attname]))
+
+        def in_list(ids):
+            return ', '.join(['%s'] * len(ids))
+
+        # parents before children on insert, children before parents on delete
+        for ids in (root_ids, child_ids):
+            if ids:
+                self._execute('INSERT INTO %s (%s) SELECT %s FROM %s r WHERE r.%s IN (%s)' % (
+                                  archive_table, ', '.join(archive_columns), ', '.join(select_columns), report_table,
+                                  report_pk, in_list(ids)),
+                              [batch.id] + ids)
+        all_ids = root_ids + child_ids
+        self._execute('INSERT INTO %s (%s, %s, %s) SELECT %s, %s, %%s FROM %s WHERE %s IN (%s)' % (
+                          qn(TransactionReport._meta.db_table), qn(TransactionReport._meta.get_field('transaction').column),
+                          qn(TransactionReport._meta.get_field('report').column), qn(TransactionReport._meta.get_field('batch').column),
+                          qn(Transaction._meta.pk.column), t_report, t_table, t_report, in_list(all_ids)),
+                      [batch.id] + all_ids)
+        self._execute('UPDATE %s SET %s = NULL WHERE %s IN (%s)' % (t_table, t_report, t_report, in_list(all_ids)), all_ids)
+        for ids in (child_ids, root_ids):
+            if ids:
+                self._execute('DELETE FROM %s WHERE %s IN (%s)' % (report_table, report_pk, in_list(ids)), ids)
+        return len(all_ids)
+
+    # ---------------------------------------------------------------------
+    # Transactions
+    # ---------------------------------------------------------------------
+
+    def _t_ref_balances(self, after, created_before, chunk_size, b2b_only=False):
+        '''Aggregates (set-based) the next chunk of transaction references (> after) not touched
+        since created_before. Returns rows of: t_ref_id, credits (sum of qty), credit rows, pulls,
+        referenced pulls, unlimited flag, live (not expired) credit rows.
+
+        Referenced pulls (by TransactionReport/Receipt) are kept by the roll-over.'''
+
+        qn = connection.ops.quote_name
+        column = lambda model, name: qn(model._meta.get_field(name).column)
+        credit = 't.%s BETWEEN %i AND %i' % ((column(Transaction, 't_type'),) + self.CREDIT_TYPES)
+        pull = 't.%s = %i' % (column(Transaction, 't_type'), self.PULL_TYPE)
+        referenced = '(EXISTS (SELECT 1 FROM %s tr WHERE tr.%s = t.%s) OR EXISTS (SELECT 1 FROM %s rc WHERE rc.%s = t.%s))' % (
+            qn(TransactionReport._meta.db_table), column(TransactionReport, 'transaction'), qn(Transaction._meta.pk.column),
+            qn(Receipt._meta.db_table), column(Receipt, 'transaction'), qn(Transaction._meta.pk.column))
+        sum_if = lambda condition, value='1': 'SUM(CASE WHEN %s THEN %s ELSE 0 END)' % (condition, value)
+
+        sql = 'SELECT t.%s, %s, %s, %s, %s, %s, %s FROM %s t %s WHERE t.%s > %%s GROUP BY t.%s HAVING MAX(t.%s) < %%s ORDER BY t.%s LIMIT %i' % (
+            column(Transaction, 't_ref'),
+            sum_if(credit, 'COALESCE(t.%s, 0)' % column(Transaction, 'qty')),
+            sum_if(credit),
+            sum_if(pull),
+            sum_if('%s AND %s' % (pull, referenced)),
+            'MAX(CASE WHEN %s AND t.%s LIKE %%s THEN 1 ELSE 0 END)' % (credit, column(Transaction, 'condition')),
+            sum_if('%s AND (t.%s IS NULL OR t.%s >= %%s)' % (credit, column(Transaction, 'expires_on'), column(Transaction, 'expires_on'))),
+            qn(Transaction._meta.db_table),
+            'JOIN %s a ON a.%s = t.%s AND a.%s IS NOT NULL' % (qn(Account._meta.db_table), qn(Account._meta.pk.column),
+                                                               column(Transaction, 'account'), column(Account, 'org_ref')) if b2b_only else '',
+            column(Transaction, 't_ref'), column(Transaction, 't_ref'), column(Transaction, 'created'),
+            column(Transaction, 't_ref'), chunk_size)
+        cursor = connection.cursor()
+        cursor.execute(sql, ['%UNLIMITED', timezone.now(), after, created_before])
+        return cursor.fetchall()
+
+    def _referenced_transaction_ids(self, transaction_ids):
+        referenced = set()
+        for model in (TransactionReport, Receipt):
+            for i in range(0, len(transaction_ids), self.DELETE_CHUNK_SIZE):
+                referenced.update(model.objects.filter(transaction__in=transaction_ids[i:i + self.DELETE_CHUNK_SIZE])
+                                               .values_list('transaction_id', flat=True))
+        return referenced
+
+    def _pulled_reports(self, t_ref_ids, now):
+        '''Returns (t_ref_id -> ids of the expired root reports pulled by the given transaction references,
+        ids of the references pulling a report which has not expired yet). A linked report expires with
+        its parent.'''
+
+        expired, live = defaultdict(set), set()
+        for t_ref_id, report_id, parent_id, expires_on, parent_expires_on in \
+                Transaction.objects.filter(t_ref__in=t_ref_ids, report__isnull=False).values_list(
+                    't_ref', 'report', 'report__parent', 'report__expires_on', 'report__parent__expires_on'):
+            if parent_id is not None:
+                report_id, expires_on = parent_id, parent_expires_on
+            if expires_on is None or expires_on >= now:
+                live.add(t_ref_id)
+            else:
+                expired[t_ref_id].add(report_id)
+        return expired, live
+
+    def _archive_pulled_reports(self, batch, root_ids):
+        '''Archives the given root reports (with their linked reports) in chunks; returns the number of
+        archived reports.'''
+
+        root_ids = sorted(root_ids)
+        archived = 0
+        for i in range(0, len(root_ids), self.ARCHIVE_CHUNK_SIZE):
+            archived += self._archive_reports(batch, root_ids[i:i + self.ARCHIVE_CHUNK_SIZE])
+        return archived
+
+    def _archive_links(self, batch, model, archive_model, transaction_ids):
+        '''Moves the rows of model (TransactionReport/Receipt) referencing the given transactions into archive_model.'''
+
+        qn = connection.ops.quote_name
+        columns = dict((field.attname, field.column) for field in model._meta.fields)
+        archive_columns, select_columns = [], []
+        for field in archive_model._meta.fields:
+            archive_columns.append(qn(field.column))
+            select_columns.append('%s' if field.attname == 'batch_id' else qn(columns[field.attname]))
+        table, t_column = qn(model._meta.db_table), qn(model._meta.get_field('transaction').column)
+        in_list = ', '.join(['%s'] * len(transaction_ids))
+        self._execute('INSERT INTO %s (%s) SELECT %s FROM %s WHERE %s IN (%s)' % (
+                          qn(archive_model._meta.db_table), ', '.join(archive_columns), ', '.join(select_columns),
+                          table, t_column, in_list),
+                      [batch.id] + transaction_ids)
+        self._execute('DELETE FROM %s WHERE %s IN (%s)' % (table, t_column, in_list), transaction_ids)
+
+    def _archive_transactions(self, batch, rows):
+        '''Copies transactions (values() rows) into Transaction_Archive and deletes them; their
+        TransactionReport/Receipt rows are moved into TransactionReport_Archive/Receipt_Archive.'''
+
+        Transaction_Archive.objects.bulk_create([
+            Transaction_Archive(batch=batch, created_month=row['created'].year * 100 + row['created'].month, **row)
+            for row in rows])
+        qn = connection.ops.quote_name
+        ids = [row['id'] for row in rows]
+        for i in range(0, len(ids), self.DELETE_CHUNK_SIZE):
+            chunk = ids[i:i + self.DELETE_CHUNK_SIZE]
+            self._archive_links(batch, TransactionReport, TransactionReport_Archive, chunk)
+            self._archive_links(batch, Receipt, Receipt_Archive, chunk)
+            self._execute('DELETE FROM %s WHERE %s IN (%s)' % (qn(Transaction._meta.db_table), qn(Transaction._meta.pk.column),
+                                                              ', '.join(['%s'] * len(chunk))), chunk)
+
+    def _run_t_ref_chunks(self, name, process_chunk, batch, created_before, chunk_size, dry_run, b2b_only=False):
+        '''Drives process_chunk(batch, balances, dry_run, stats) over all transaction reference chunks and
+        logs throughput metrics. Returns (batch, stats).'''
+
+        batch = None if dry_run else self._get_batch(batch)
+        created_before = created_before or timezone.now()
+        stats = dict(t_refs=0, archived=0, archived_reports=0, carried_over=0, carried_credits=0, skipped=0)
+        started, after = time.time(), ''
+        self.logger.info('%s (%s): transactions not touched since %s' % (name, 'dry run' if dry_run else 'batch %i' % batch.id, created_before))
+        while True:
+            balances = self._t_ref_balances(after, created_before, chunk_size, b2b_only)
+            if not balances:
+                break
+            with transaction.atomic():
+                process_chunk(batch, balances, dry_run, stats)
+            after = balances[-1][0]
+            stats['t_refs'] += len(balances)
+
+        stats['seconds'] = time.time() - started
+        stats['rows_per_second'] = (stats['archived'] + stats['carried_over']) / stats['seconds'] if stats['seconds'] else 0.0
+        self.logger.info('%s: %s' % (name, ', '.join('%s=%s' % item for item in sorted(stats.items()))))
+        return batch, stats
+
+    def transaction_archive_all(self, batch=None, created_before=None, chunk_size=ARCHIVE_CHUNK_SIZE, dry_run=False):
+        '''Archives complete transaction references (credits and pulls together, so remaining credits
+        stay correct) not touched since created_before whose credits are used up or expired.
+        References with a pulled report which has not expired yet (or never expires) are skipped; the
+        expired reports of the others are archived first (see reports_archive_all). TransactionReport/Receipt
+        rows are archived with their transactions.
+
+        Returns (batch, stats); with dry_run nothing is written and batch is None.'''
+
+        def process_chunk(batch, balances, dry_run, stats):
+            t_ref_ids = [t_ref_id for t_ref_id, credits, credit_rows, pulls, _, unlimited, live_credits in balances
+                         if (credit_rows and not live_credits) or (not unlimited and credits - pulls <= 0)]
+            if t_ref_ids:
+                expired, live = self._pulled_reports(t_ref_ids, timezone.now())
+                if live:
+                    t_ref_ids = [t_ref_id for t_ref_id in t_ref_ids if t_ref_id not in live]
+                    stats['skipped'] += len(live)
+                if t_ref_ids and not dry_run:
+                    root_ids = set().union(*[expired[t_ref_id] for t_ref_id in t_ref_ids if t_ref_id in expired])
+                    if root_ids:
+                        stats['archived_reports'] += self._archive_pulled_reports(batch, root_ids)
+                    # reports which could not be archived (see _archive_reports) keep their references
+                    kept = set(Transaction.objects.filter(t_ref__in=t_ref_ids, report__isnull=False).values_list('t_ref', flat=True))
+                    t_ref_ids = [t_ref_id for t_ref_id in t_ref_ids if t_ref_id not in kept]
+                    stats['skipped'] += len(kept)
+            rows = list(Transaction.objects.filter(t_ref__in=t_ref_ids).values()) if t_ref_ids else []
+            if rows and not dry_run:
+                self._archive_transactions(batch, rows)
+                CreditBalance.refresh(t_ref_ids)
+            stats['archived'] += len(rows)
+
+        return self._run_t_ref_chunks('Transaction archiving', process_chunk, batch, created_before, chunk_size, dry_run)
+
+    def transaction_b2b_rollover_all(self, batch=None, created_before=None, chunk_size=ARCHIVE_CHUNK_SIZE, dry_run=False):
+        '''Rolls over B2B credits: for every live, limited credit (one credit row per transaction reference)
+        not touched since created_before, a carry-over credit transaction is written (bulk) and the old
+        credit with its consumed pulls is archived. Pulls with a live report or referenced by
+        TransactionReport/Receipt stay and are still counted against the carry-over credit.
+
+        Returns (batch, stats); with dry_run nothing is written and batch is None.'''
+
+        def process_chunk(batch, balances, dry_run, stats):
+            candidates = {}
+            for t_ref_id, credits, credit_rows, pulls, referenced_pulls, unlimited, live_credits in balances:
+                if credit_rows == 1 and live_credits == 1 and not unlimited and credits - pulls > 0 and pulls - referenced_pulls > 0:
+                    candidates[t_ref_id] = (credits, credits - pulls)
+                else:
+                    stats['skipped'] += 1
+            if not candidates:
+                return
+
+            rows = list(Transaction.objects.filter(t_ref__in=candidates.keys()).values())
+            referenced = self._referenced_transaction_ids([row['id'] for row in rows if row['t_type'] == self.PULL_TYPE])
+            consumed, carry_overs = [], []
+            now = timezone.now()
+            for row in rows:
+                if row['t_type'] == self.PULL_TYPE and (row['id'] in referenced or row['report_id'] is not None):
+                    continue
+                consumed.append(row)
+            archived_pulls = defaultdict(int)
+            for row in consumed:
+                if row['t_type'] == self.PULL_TYPE:
+                    archived_pulls[row['t_ref_id']] += 1
+            for t_ref_id in [t_ref_id for t_ref_id in candidates if not archived_pulls[t_ref_id]]:
+                del candidates[t_ref_id]    # nothing to consume
+                stats['skipped'] += 1
+            consumed = [row for row in consumed if row['t_ref_id'] in candidates]
+            for row in consumed:
+                if Transaction.is_credit(row['t_type']):
+                    credits, remaining = candidates[row['t_ref_id']]
+                    carry_over = dict(row, qty=credits - archived_pulls[row['t_ref_id']], created=now)
+                    del carry_over['id']
+                    carry_overs.append(Transaction(**carry_over))
+                    stats['carried_credits'] += remaining
+
+            if not dry_run:
+                self._archive_transactions(batch, consumed)
+                Transaction.objects.bulk_create(carry_overs)
+                CreditBalance.refresh(candidates.keys())
+            stats['archived'] += len(consumed)
+            stats['carried_over'] += len(carry_overs)
+
+        return self._run_t_ref_chunks('B2B roll-over', process_chunk, batch, created_before, chunk_size, dry_run, b2b_only=True)
+
+    # ---------------------------------------------------------------------
+    # Expiry
+    # ---------------------------------------------------------------------
+
+    def _update_expires_on(self, model, values):
+        '''Writes {id: expires_on} with UPDATE ... CASE statements. The values are prepared by the
+        field (as by the ORM), so they compare correctly with the ones saved by the sweeps.'''
+
+        qn = connection.ops.quote_name
+        field, pk = model._meta.get_field('expires_on'), qn(model._meta.pk.column)
+        ids = sorted(values)
+        for i in range(0, len(ids), self.CASE_CHUNK_SIZE):
+            chunk = ids[i:i + self.CASE_CHUNK_SIZE]
+            params = [param for id in chunk for param in (id, field.get_db_prep_value(values[id], connection))]
+            self._execute('UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+                              qn(model._meta.db_table), qn(field.column), pk, ' '.join(['WHEN %s THEN %s'] * len(chunk)),
+                              pk, ', '.join(['%s'] * len(chunk))),
+                          params + chunk)
+
+    def expiry_backfill(self, chunk_size=EXPIRY_CHUNK_SIZE):
+        '''Sets missing expires_on values in bulk (chunked UPDATEs): created + ReportType.expiration_days
+        for reports, created + Condition.expiration_days for credit transactions. The high-water marks of
+        the expiry sweeps are lowered to the earliest backfilled value, so these rows are swept too.
+
+        Returns dict(reports=n, credits=n).'''
+
+        stats = {}
+        for sweep, queryset, type_field, type_model in (
+                ('reports', Report.objects.all(), 'report_type', ReportType),
+                ('credits', Transaction.objects.filter(t_type__range=self.CREDIT_TYPES), 'condition', Condition)):
+            model, updated, earliest = queryset.model, 0, None
+            for type_id, days in type_model.objects.filter(expiration_days__isnull=False).values_list('pk', 'expiration_days'):
+                missing = queryset.filter(**{type_field: type_id, 'expires_on__isnull': True}).order_by('id')
+                expiration = datetime.timedelta(days=days)
+                while True:
+                    # computed here rather than by SQL date arithmetic, whose results are formatted
+                    # differently from the ORM's values on some backends (e.g. an UTC offset on SQLite)
+                    values = dict((id, created + expiration) for id, created in missing.values_list('id', 'created')[:chunk_size])
+                    if not values:
+                        break
+                    with transaction.atomic():
+                        self._update_expires_on(model, values)
+                    chunk_earliest = min(values.itervalues())
+                    earliest = chunk_earliest if earliest is None else min(earliest, chunk_earliest)
+                    updated += len(values)
+            if earliest is not None:
+                ExpirySweep.objects.filter(name=sweep, expires_on__gt=earliest).update(expires_on=earliest, last_id=0)
+            stats[sweep] = updated
+
+        self.logger.info('Expiry backfill: %s' % ', '.join('%s=%s' % item for item in sorted(stats.items())))
+        return stats
+
+    def _sweep(self, name, rows, action, now, chunk_size, max_chunks):
+        '''Runs action(rows) over the rows (values() queryset with id and expires_on) expired since the
+        high-water mark of the sweep, in chunks ordered by (expires_on, id) (expires_on index); the mark
+        is advanced in the same transaction as the action. Returns the number of processed rows.'''
+
+        state, _ = ExpirySweep.objects.get_or_create(name=name)
+        processed, chunks = 0, 0
+        while max_chunks is None or chunks < max_chunks:
+            expired = rows.filter(expires_on__lte=now)
+            if state.expires_on is not None:
+                expired = expired.filter(Q(expires_on__gt=state.expires_on) | Q(expires_on=state.expires_on, id__gt=state.last_id))
+            chunk = list(expired.order_by('expires_on', 'id')[:chunk_size])
+            if not chunk:
+                break
+            if state.expires_on is not None and (chunk[-1]['expires_on'], chunk[-1]['id']) <= (state.expires_on, state.last_id):
+                self.logger.error('Expiry sweep %s: no progress past (%s, %i), stopped' % (name, state.expires_on, state.last_id))
+                break
+            with transaction.atomic():
+                action(chunk)
+                state.expires_on, state.last_id = chunk[-1]['expires_on'], chunk[-1]['id']
+                state.save()
+            processed += len(chunk)
+            chunks += 1
+        return processed
+
+    def expiry_sweep(self, batch=None, now=None, chunk_size=EXPIRY_CHUNK_SIZE, max_chunks=None):
+        '''Applies expiry to the rows expired since the last run:
+          - expired reports are archived (see reports_archive_all; linked reports go with their parent),
+          - the balances of references with expired credits are refreshed (CreditBalance.expired).
+        Each sweep handles at most max_chunks chunks of chunk_size rows per run.
+
+        Returns (batch (None if nothing was archived), stats).'''
+
+        now = now or timezone.now()
+        stats = dict(reports=0, archived_reports=0, credits=0, expired_balances=0)
+        archive_batch = []  # created on the first archived chunk
+
+        def archive(chunk):
+            if not archive_batch:
+                archive_batch.append(self._get_batch(batch))
+            stats['archived_reports'] += self._archive_reports(archive_batch[0], [row['id'] for row in chunk])
+
+        def expire_credits(chunk):
+            t_ref_ids = list(set(row['t_ref'] for row in chunk))
+            CreditBalance.refresh(t_ref_ids)
+            stats['expired_balances'] += CreditBalance.objects.filter(t_ref__in=t_ref_ids, expired=True).count()
+
+        stats['reports'] = self._sweep('reports', Report.objects.filter(parent__isnull=True).values('id', 'expires_on'),
+                                       archive, now, chunk_size, max_chunks)
+        stats['credits'] = self._sweep('credits', Transaction.objects.filter(t_type__range=self.CREDIT_TYPES)
+                                                                   .values('id', 'expires_on', 't_ref'),
+                                       expire_credits, now, chunk_size, max_chunks)
+        self.logger.info('Expiry sweep (expired before %s): %s' % (now, ', '.join('%s=%s' % item for item in sorted(stats.items()))))
+        return (archive_batch[0] if archive_batch else None), stats
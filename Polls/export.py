@@ -0,0 +1,160 @@
+'''
+Streaming exports for accounting (constant memory, whatever the table size).
+
+Rows are read as values_list() tuples (no model instances) in keyset chunks on the
+transaction id and written (optionally compressed) as they are read. Django 1.6 has
+no server-side cursors, so every chunk is a separate short query instead.
+
+Incremental exports follow two streams: new transactions (by id, see
+iter_transaction_rows) and receipts issued for transactions exported before (by
+creation time, see iter_receipt_rows). Both stop at the same bound (until, a
+while ago: younger rows may not be committed yet), so every receipt is exported
+exactly once and a transaction whose lower id commits late is not skipped.
+'''
+
+import csv
+import datetime
+import decimal
+import json
+
+from django.db.models import Q
+
+from Polls.models import Receipt, Transaction
+
+
+CHUNK_SIZE = 5000       # transactions per query
+IN_CHUNK_SIZE = 500     # receipt ids per IN (...) list
+SETTLE = datetime.timedelta(minutes=1)    # younger transactions/receipts may not be committed yet (left for the next run)
+
+# (column, Transaction lookup); one row per receipt (transactions without receipts: one row, empty receipt columns)
+TRANSACTION_COLUMNS = (
+    ('id', 'id'),
+    ('created', 'created'),
+    ('t_type', 't_type'),
+    ('qty', 'qty'),
+    ('expires_on', 'expires_on'),
+    ('t_ref', 't_ref'),
+    ('t_ref_created', 't_ref__created'),
+    ('ext_t_ref', 'ext_t_ref'),
+    ('account', 'account'),
+    ('org_ref', 'account__org_ref'),
+    ('usr_ref', 'account__usr_ref'),
+    ('ext_usr_ref', 'account__ext_usr_ref'),
+    ('condition', 'condition'),
+    ('condition_price', 'condition__price'),
+    ('condition_currency', 'condition__currency'),
+    ('receipt', 'receipt__id'),
+    ('receipt_created', 'receipt__created'),
+    ('price', 'receipt__price'),
+    ('net_price', 'receipt__net_price'),
+    ('vat_rate', 'receipt__vat_rate'),
+    ('vat_value', 'receipt__vat_value'),
+    ('currency', 'receipt__currency'),
+)
+
+
+CREATED = [name for name, _ in TRANSACTION_COLUMNS].index('created')
+RECEIPT_CREATED = [name for name, _ in TRANSACTION_COLUMNS].index('receipt_created')
+RECEIPT_COLUMNS = [i for i, (_, lookup) in enumerate(TRANSACTION_COLUMNS) if lookup.startswith('receipt__')]
+
+
+def _transactions(created_from=None, created_to=None):
+    transactions = Transaction.objects.all()
+    if created_from is not None:
+        transactions = transactions.filter(created__gte=created_from)
+    if created_to is not None:
+        transactions = transactions.filter(created__lt=created_to)
+    return transactions
+
+
+def iter_transaction_rows(after_id=0, created_from=None, created_to=None, chunk_size=CHUNK_SIZE, until=None):
+    '''Yields TRANSACTION_COLUMNS tuples of the transactions with id > after_id (and created in
+    [created_from, created_to)), ordered by id. A chunk always contains all receipts of its transactions.
+    With until, the rows stop before the first transaction created after it (so the highest id yielded
+    can be used as the next after_id), and receipts created after it are left out (empty receipt
+    columns, see iter_receipt_rows).'''
+
+    transactions = _transactions(created_from, created_to)
+    lookups = [lookup for _, lookup in TRANSACTION_COLUMNS]
+    while True:
+        ids = list(transactions.filter(id__gt=after_id).order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            break
+        for row in transactions.filter(id__gt=after_id, id__lte=ids[-1]).order_by('id', 'receipt__id') \
+                               .values_list(*lookups).iterator():
+            if until is not None:
+                if row[CREATED] > until:
+                    return
+                if row[RECEIPT_CREATED] is not None and row[RECEIPT_CREATED] > until:
+                    row = tuple(None if i in RECEIPT_COLUMNS else value for i, value in enumerate(row))
+            yield row
+        after_id = ids[-1]
+
+
+def iter_receipt_rows(to_id, receipts_from, receipts_until, created_from=None, created_to=None, chunk_size=CHUNK_SIZE):
+    '''Yields TRANSACTION_COLUMNS tuples of the receipts created in (receipts_from, receipts_until] for
+    transactions with id <= to_id (and created in [created_from, created_to)), i.e. receipts issued after
+    their transaction was exported. Ordered by receipt creation time (keyset chunks on (created, id)).'''
+
+    receipts = Receipt.objects.filter(transaction__id__lte=to_id, created__gt=receipts_from, created__lte=receipts_until)
+    if created_from is not None:
+        receipts = receipts.filter(transaction__created__gte=created_from)
+    if created_to is not None:
+        receipts = receipts.filter(transaction__created__lt=created_to)
+    lookups = [lookup for _, lookup in TRANSACTION_COLUMNS]
+    after = None
+    while True:
+        chunk = receipts if after is None else receipts.filter(Q(created__gt=after[0]) | Q(created=after[0], id__gt=after[1]))
+        chunk = list(chunk.order_by('created', 'id').values_list('created', 'id')[:chunk_size])
+        if not chunk:
+            break
+        ids = [id for _, id in chunk]
+        for i in range(0, len(ids), IN_CHUNK_SIZE):
+            for row in Transaction.objects.filter(receipt__id__in=ids[i:i + IN_CHUNK_SIZE]) \
+                                          .order_by('receipt__created', 'receipt__id').values_list(*lookups).iterator():
+                yield row
+        after = chunk[-1]
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    raise TypeError(repr(value))
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def write_csv(rows, stream, columns=TRANSACTION_COLUMNS):
+    '''Writes a header and the rows; returns the number of rows.'''
+
+    writer = csv.writer(stream)
+    writer.writerow([name for name, _ in columns])
+    count = 0
+    for row in rows:
+        writer.writerow([_csv_value(value) for value in row])
+        count += 1
+    return count
+
+
+def write_ndjson(rows, stream, columns=TRANSACTION_COLUMNS):
+    '''Writes one JSON object per row; returns the number of rows.'''
+
+    names = [name for name, _ in columns]
+    count = 0
+    for row in rows:
+        stream.write(json.dumps(dict(zip(names, row)), default=_json_default, sort_keys=True) + '\n')
+        count += 1
+    return count
+
+
+WRITERS = {'csv': write_csv, 'ndjson': write_ndjson}
@@ -1,34 +1,186 @@
-import logging, sys
+import atexit, json, logging, os, sys, threading, time, Queue
+
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+class FieldsFormatter(logging.Formatter):
+    '''Plain text formatter; structured fields are appended as key=value pairs.'''
+
+    def format(self, record):
+        msg = logging.Formatter.format(self, record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            msg += ' ' + ' '.join('%s=%s' % item for item in sorted(fields.items()))
+        return msg
+
+
+class JsonFormatter(logging.Formatter):
+    '''One JSON object per record; structured fields are merged in.'''
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class BufferedStreamHandler(logging.Handler):
+    '''Formats records in the calling thread and queues them; a background thread writes
+    them to the stream in batches (one write/flush per batch).
+
+    The queue holds up to capacity records. When it is full, overflow decides:
+    'drop' (drop the new record), 'drop_oldest' (make room by dropping the oldest one)
+    or 'block' (wait for the writer). Dropped records are counted and reported.
+
+    The writer thread is started by the first record of each process, so handlers
+    configured before a (pre-)fork get their own writer in every worker.'''
+
+    OVERFLOW_POLICIES = ('drop', 'drop_oldest', 'block')
+
+    def __init__(self, stream, capacity=10000, batch_size=500, overflow='drop'):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: %s' % overflow)
+        logging.Handler.__init__(self)
+        self.stream = stream
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self.dropped = 0
+        self._capacity = capacity
+        self._queue = None
+        self._closed = False
+        self._writer = None
+        self._pid = None
+        atexit.register(self.close)
+
+    def _start(self):
+        '''Starts the writer thread of this process (with a new queue: the one of the parent
+        process may be left locked by its writer).'''
+
+        self._queue = Queue.Queue(self._capacity)
+        self._writer = threading.Thread(target=self._run, args=(self._queue,), name='BufferedStreamHandler')
+        self._writer.daemon = True
+        self._writer.start()
+        self._pid = os.getpid()
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        if self._closed:
+            return
+        if self._pid != os.getpid():  # emit() is called with the handler lock held
+            self._start()
+        if self.overflow == 'block':
+            self._queue.put(line)
+            return
+        try:
+            self._queue.put_nowait(line)
+        except Queue.Full:
+            if self.overflow == 'drop_oldest':
+                try:
+                    self._queue.get_nowait()
+                except Queue.Empty:
+                    pass
+                try:
+                    self._queue.put_nowait(line)
+                except Queue.Full:
+                    pass
+            self.dropped += 1
+
+    def _run(self, queue):
+        reported = 0
+        while True:
+            lines = [queue.get()]
+            while len(lines) < self.batch_size:
+                try:
+                    lines.append(queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = None in lines
+            lines = [line for line in lines if line is not None]
+            if self.dropped != reported:
+                lines.append('%i log record(s) dropped (buffer full)' % (self.dropped - reported))
+                reported = self.dropped
+            if lines:
+                try:
+                    self.stream.write('\n'.join(lines) + '\n')
+                    self.stream.flush()
+                except Exception:
+                    pass
+            if stop:
+                break
+
+    def close(self):
+        '''Writes all queued records and stops the writer thread.'''
+
+        if not self._closed:
+            self._closed = True
+            if self._pid == os.getpid():
+                self._queue.put(None)
+                self._writer.join()
+        logging.Handler.close(self)
+
 
 class Logger(object):
-    
+
     _instance = None
-    
+
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
             cls._instance = super(Logger, cls).__new__(cls, *args, **kwargs)
             cls._instance.logger = logging.getLogger('backoffice')
             cls._instance.logger.setLevel(logging.INFO)
-            
-            stdo_hdlr = logging.StreamHandler(sys.stdout)
+
+            stdo_hdlr = BufferedStreamHandler(sys.stdout,
+                                              capacity=getattr(settings, 'LOGGER_BUFFER_SIZE', 10000),
+                                              overflow=getattr(settings, 'LOGGER_OVERFLOW', 'drop'))
             stdo_hdlr.setLevel(logging.INFO)
-            formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+            if getattr(settings, 'LOGGER_JSON', False):
+                formatter = JsonFormatter()
+            else:
+                formatter = FieldsFormatter('%(asctime)s - %(levelname)s - %(message)s')
             stdo_hdlr.setFormatter(formatter)
-            
+
             cls._instance.logger.addHandler(stdo_hdlr)
-        
+
         return cls._instance
 
+    @staticmethod
+    def _extra(fields):
+        return {'fields': fields} if fields else None
+
     @classmethod
-    def info(cls, msg):
-        cls._instance.logger.info(msg)
-        
+    def info(cls, msg, **fields):
+        cls._instance.logger.info(msg, extra=cls._extra(fields))
+
     @classmethod
-    def warning(cls, msg):
-        cls._instance.logger.warning(msg)
+    def warning(cls, msg, **fields):
+        cls._instance.logger.warning(msg, extra=cls._extra(fields))
 
     @classmethod
-    def error(cls, msg):
-        cls._instance.logger.error(msg)
+    def error(cls, msg, **fields):
+        cls._instance.logger.error(msg, extra=cls._extra(fields))
+
+    @classmethod
+    @contextmanager
+    def timed(cls, msg, level=logging.INFO, **fields):
+        '''Logs msg with a duration_ms field once the block finishes (fields may be extended inside the block).'''
+
+        started = time.time()
+        try:
+            yield fields
+        finally:
+            fields['duration_ms'] = round((time.time() - started) * 1000, 3)
+            cls._instance.logger.log(level, msg, extra=cls._extra(fields))
 
 
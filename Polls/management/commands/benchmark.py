@@ -0,0 +1,134 @@
+import datetime
+import json
+import random
+import subprocess
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+
+from Books.models import FrontendUser
+from Polls.backend import Backend
+from Polls.models import (Account, Report, Report_Archive, Session, Transaction, ViatelBatch, ViatelBatchCache, ViatelCode,
+                          ViatelLog)
+from Polls.util.query_profiler import QueryProfiler
+from Polls.viatel import reconcile_day, redeem_code
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Times the hot paths (packages, Viatel code generation/redemption, archiving) against the current ' \
+           'database (see populate_synthetic) and stores the results as JSON. Writes are rolled back.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', dest='repeat', default=5,
+                    help='Runs per benchmark (default: 5).'),
+        make_option('--only', dest='only', default=None,
+                    help='Comma separated benchmark names.'),
+        make_option('--output', dest='output', default=None,
+                    help='Result file (default: benchmark-<commit>.json).'),
+        make_option('--compare', dest='compare', default=None,
+                    help='Result file of a previous run to compare with.'),
+        make_option('--seed', type='int', dest='seed', default=1,
+                    help='Random seed for the sampled users/codes (default: 1).'),
+    )
+
+    BENCHMARKS = ('packages_heavy', 'packages_random', 'bulk_packages', 'viatel_generate', 'viatel_redeem',
+                  'viatel_reconcile_day', 'reports_archive_chunk')
+
+    def handle(self, *args, **options):
+        names = options['only'].split(',') if options['only'] else self.BENCHMARKS
+        unknown = set(names) - set(self.BENCHMARKS)
+        if unknown:
+            raise CommandError('Unknown benchmark(s): %s' % ', '.join(sorted(unknown)))
+        self.viatel_batch = ViatelBatch.objects.filter(prn='0900SYN').order_by('-batch').first()
+        if self.viatel_batch is None:
+            raise CommandError('No synthetic data found, run populate_synthetic first')
+
+        commit = _git_commit()
+        results = {
+            'commit': commit,
+            'database': connection.vendor,
+            'started': datetime.datetime.now().isoformat(),
+            'rows': dict((model.__name__, model.objects.count()) for model in
+                         (Account, Session, Transaction, Report, Report_Archive, ViatelCode, ViatelLog)),
+            'benchmarks': {},
+        }
+        for name in names:
+            random.seed(options['seed'])
+            run = getattr(self, '_%s' % name)()
+            runs, queries = [], 0
+            for _ in range(options['repeat']):
+                with QueryProfiler('benchmark %s' % name) as profiler:
+                    started = time.time()
+                    try:
+                        with transaction.atomic():
+                            run()
+                            raise _Rollback
+                    except _Rollback:
+                        pass
+                    runs.append(round((time.time() - started) * 1000, 3))
+                queries = profiler.count
+            ViatelBatchCache.invalidate()
+            runs.sort()
+            results['benchmarks'][name] = dict(runs_ms=runs, min_ms=runs[0], median_ms=runs[len(runs) // 2], queries=queries)
+
+        output = options['output'] or 'benchmark-%s.json' % (commit or 'unknown')[:7]
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+        previous = {}
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)['benchmarks']
+        for name in names:
+            result = results['benchmarks'][name]
+            line = '%-24s median %10.1f ms  min %10.1f ms  %6i queries' % (name, result['median_ms'], result['min_ms'], result['queries'])
+            if name in previous and previous[name]['median_ms']:
+                line += '  (%+.1f%%)' % ((result['median_ms'] / previous[name]['median_ms'] - 1) * 100)
+            self.stdout.write(line)
+        self.stdout.write('Results written to %s' % output)
+
+    # Each _<benchmark> method does the (untimed) setup and returns the timed callable.
+
+    def _b2c_uids(self, count):
+        uids = list(Account.objects.filter(ext_usr_ref__isnull=False).values_list('ext_usr_ref', flat=True))
+        return random.sample(uids, min(count, len(uids)))
+
+    def _packages_heavy(self):
+        uids = [row['ext_usr_ref'] for row in Account.objects.filter(ext_usr_ref__isnull=False).values('ext_usr_ref')
+                .annotate(transactions=Count('transaction')).order_by('-transactions')[:20]]
+        return lambda: [FrontendUser(uid=uid).packages(show_archived_reports=True) for uid in uids]
+
+    def _packages_random(self):
+        uids = self._b2c_uids(100)
+        return lambda: [FrontendUser(uid=uid).packages(show_archived_reports=True) for uid in uids]
+
+    def _bulk_packages(self):
+        uids = self._b2c_uids(FrontendUser.BULK_CHUNK_SIZE)
+        return lambda: FrontendUser.bulk_packages([FrontendUser(uid=uid) for uid in uids], show_archived_reports=True)
+
+    def _viatel_generate(self):
+        return lambda: ViatelCode.generate_batch(self.viatel_batch, 1000)
+
+    def _viatel_redeem(self):
+        codes = random.sample(list(ViatelCode.objects.filter(batch=self.viatel_batch).values_list('code', flat=True)[:10000]), 100)
+        return lambda: [redeem_code(code) for code in codes]
+
+    def _viatel_reconcile_day(self):
+        return lambda: reconcile_day(datetime.date.today() - datetime.timedelta(days=1))
+
+    def _reports_archive_chunk(self):
+        return lambda: Backend().reports_archive_all(max_chunks=1)
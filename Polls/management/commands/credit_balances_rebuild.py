@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from Polls.models import CreditBalance
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the materialised credit balances from the transactions (reconciliation).'
+
+    def handle(self, *args, **options):
+        self.stdout.write('%i credit balance(s) rebuilt' % CreditBalance.rebuild())
@@ -0,0 +1,34 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Polls.backend import Backend
+from Polls.models import Batch
+
+
+class Command(BaseCommand):
+    help = 'Applies expiry to rows expired since the last run (archives reports, deactivates credits).'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--backfill', action='store_true', dest='backfill', default=False,
+                    help='First set missing expires_on values from ReportType/Condition.expiration_days.'),
+        make_option('--batch', type='int', dest='batch', default=None,
+                    help='Batch id to register archived reports under (default: a new batch).'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=Backend.EXPIRY_CHUNK_SIZE,
+                    help='Rows processed per transaction (default: %i).' % Backend.EXPIRY_CHUNK_SIZE),
+        make_option('--max-chunks', type='int', dest='max_chunks', default=None,
+                    help='Stop each sweep after this number of chunks (continues on the next run).'),
+    )
+
+    def handle(self, *args, **options):
+        backend = Backend()
+        if options['backfill']:
+            stats = backend.expiry_backfill(chunk_size=options['chunk_size'])
+            self.stdout.write('Backfilled: %s' % ', '.join('%s=%s' % item for item in sorted(stats.items())))
+        try:
+            batch, stats = backend.expiry_sweep(batch=options['batch'], chunk_size=options['chunk_size'],
+                                                max_chunks=options['max_chunks'])
+        except Batch.DoesNotExist:
+            raise CommandError('Batch %s does not exist' % options['batch'])
+        self.stdout.write('%s: %s' % ('Batch %i' % batch.id if batch else 'Nothing archived',
+                                      ', '.join('%s=%s' % item for item in sorted(stats.items()))))
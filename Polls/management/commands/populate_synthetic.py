@@ -0,0 +1,160 @@
+import datetime
+import random
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection
+from django.db.models import Max
+
+from Polls.models import (Account, Batch, Condition, CreditBalance, Report, Report_Archive, ReportType, Requester,
+                          Session, SessionAccount, Transaction, TransactionReference, TransactionReport, ViatelBatch,
+                          ViatelCode, ViatelLog)
+
+
+MIN_SCALE, MAX_SCALE = 10000, 10000000
+
+
+class Command(BaseCommand):
+    help = 'Fills the database with synthetic data (skewed: few heavy users, many light ones) for benchmarks.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--scale', type='int', dest='scale', default=MIN_SCALE,
+                    help='Approximate number of transactions (%i to %i; default: %i).' % (MIN_SCALE, MAX_SCALE, MIN_SCALE)),
+        make_option('--seed', type='int', dest='seed', default=1,
+                    help='Random seed (default: 1).'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=5000,
+                    help='Rows per bulk INSERT (default: 5000).'),
+    )
+
+    PACKS = (1, 5, 10, 10, 50, None)     # credit quantities (None = unlimited)
+    ARCHIVED_SHARE = 0.3                 # pulls with archived reports
+    B2B_SHARE = 0.1                      # B2B (CCD/SF) accounts
+    PULLS_PER_ACCOUNT = 40               # average
+    PARETO_ALPHA = 1.16                  # 80/20 distribution of pulls over accounts
+    MAX_VIATEL_CODES = 400000            # keeps the 6 digit code space usable
+
+    def handle(self, *args, **options):
+        scale = options['scale']
+        if not MIN_SCALE <= scale <= MAX_SCALE:
+            raise CommandError('--scale must be between %i and %i' % (MIN_SCALE, MAX_SCALE))
+        random.seed(options['seed'])
+        self.chunk_size = options['chunk_size']
+        self.buffers = dict((model, []) for model in (Account, Session, SessionAccount, TransactionReference, Report,
+                                                     Report_Archive, Transaction, TransactionReport, ViatelLog))
+        self.counts = dict((model.__name__, 0) for model in self.buffers)
+        self.now = datetime.datetime.now()
+
+        self._reference_data()
+        self._accounts_and_transactions(scale)
+        self._viatel(min(scale // 10, self.MAX_VIATEL_CODES))
+        self._flush()
+
+        cursor = connection.cursor()
+        for sql in connection.ops.sequence_reset_sql(no_style(), list(self.buffers)):
+            cursor.execute(sql)
+        CreditBalance.rebuild()
+        self.stdout.write(', '.join('%s=%i' % item for item in sorted(self.counts.items())))
+
+    def _add(self, obj):
+        self.buffers[type(obj)].append(obj)
+        if sum(len(objs) for objs in self.buffers.values()) >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        # dependency order (FKs)
+        for model in (Account, Session, SessionAccount, TransactionReference, Report, Report_Archive, Transaction,
+                      TransactionReport, ViatelLog):
+            objs, self.buffers[model] = self.buffers[model], []
+            if objs:
+                model.objects.bulk_create(objs)
+                self.counts[model.__name__] += len(objs)
+
+    def _next_id(self, *models):
+        return max((model.objects.aggregate(max_id=Max('id'))['max_id'] or 0) for model in models) + 1
+
+    def _created(self, days=730):
+        return self.now - datetime.timedelta(seconds=random.randint(0, days * 86400))
+
+    def _reference_data(self):
+        self.requester, _ = Requester.objects.get_or_create(desc='synthetic', defaults={'legal_entity': 'SE'})
+        self.report_type, _ = ReportType.objects.get_or_create(id='SYN_VHR', defaults={'expiration_days': 30})
+        self.conditions = {}
+        for qty in set(self.PACKS):
+            condition_id = 'SYN_VHR_%s' % ('UNLIMITED' if qty is None else qty)
+            try:
+                self.conditions[qty] = Condition.objects.get(pk=condition_id)
+            except Condition.DoesNotExist:
+                condition = Condition(id=condition_id, requester=self.requester, qty_limit=qty, price=qty * 10 if qty else 999,
+                                      currency='SEK')
+                condition.save()
+                self.conditions[qty] = condition
+        self.batch = Batch.objects.create()
+
+    def _accounts_and_transactions(self, scale):
+        accounts = max(10, scale // (self.PULLS_PER_ACCOUNT + 5))
+        weights = [random.paretovariate(self.PARETO_ALPHA) for _ in range(accounts)]
+        pulls_per_weight = scale * 0.85 / sum(weights)
+
+        account_id, session_id = self._next_id(Account), self._next_id(Session)
+        report_id = self._next_id(Report, Report_Archive)
+        transaction_id = self._next_id(Transaction)
+        t_ref_ids = []
+        for weight in weights:
+            b2b = random.random() < self.B2B_SHARE
+            account = Account(id=account_id, created=self._created(),
+                              org_ref='SYN%07i' % account_id if b2b else None, ext_usr_ref=None if b2b else account_id)
+            self._add(account)
+            for _ in range(random.randint(1, 3)):
+                self._add(Session(id=session_id, ext_session_ref='syn%i' % session_id, ext_session_timestamp=self._created()))
+                self._add(SessionAccount(session_id=session_id, account_id=account_id))
+                session_id += 1
+
+            pulls = int(round(weight * pulls_per_weight))
+            while True:
+                if not t_ref_ids:
+                    t_ref_ids = TransactionReference.reserve_ids(self.chunk_size)
+                t_ref_id = t_ref_ids.pop()
+                self._add(TransactionReference(id=t_ref_id))
+                qty = random.choice(self.PACKS)
+                condition = self.conditions[qty]
+                created = self._created()
+                self._add(Transaction(id=transaction_id, t_ref_id=t_ref_id, account_id=account_id, t_type=100,
+                                      condition_id=condition.id, requester_id=self.requester.id, qty=qty or 1, created=created,
+                                      expires_on=created + datetime.timedelta(days=365)))
+                transaction_id += 1
+
+                pack_pulls = pulls if qty is None else min(pulls, qty - random.randint(0, qty // 3))
+                for _ in range(pack_pulls):
+                    pulled = created + datetime.timedelta(seconds=random.randint(0, 180 * 86400))
+                    report = dict(id=report_id, account_id=account_id, report_type_id=self.report_type.id,
+                                  report_ref='SYNVIN%011i' % report_id, query='SYNVIN%011i' % report_id, created=pulled,
+                                  expires_on=pulled + datetime.timedelta(days=30))
+                    archived = random.random() < self.ARCHIVED_SHARE
+                    if archived:
+                        self._add(Report_Archive(batch_id=self.batch.id, **report))
+                    else:
+                        self._add(Report(**report))
+                    self._add(Transaction(id=transaction_id, t_ref_id=t_ref_id, account_id=account_id, t_type=200,
+                                          condition_id=condition.id, requester_id=self.requester.id, created=pulled,
+                                          report_id=None if archived else report_id))
+                    if archived:
+                        self._add(TransactionReport(transaction_id=transaction_id, report_id=report_id, batch_id=self.batch.id))
+                    report_id += 1
+                    transaction_id += 1
+                pulls -= pack_pulls
+                if pulls <= 0:
+                    break
+            account_id += 1
+
+    def _viatel(self, codes):
+        viatel_batch = ViatelBatch.objects.create(batch=Batch.objects.create(), valid_from=self.now - datetime.timedelta(days=60),
+                                                  valid_to=self.now + datetime.timedelta(days=300), prn='0900SYN')
+        generated, _ = ViatelCode.generate_batch(viatel_batch, codes)
+        self.counts['ViatelCode'] = len(generated)
+        for i in range(codes):
+            # most calls enter a valid code; some codes are called more than once, some inputs are invalid
+            code = random.choice(generated) if random.random() < 0.9 else '%06i' % random.randint(0, 999999)
+            self._add(ViatelLog(prn='0900SYN', input=code, caller='+4670%07i' % random.randint(0, 9999999),
+                                time=self._created(30), rate=990, currency='SEK', ratetype='PPC',
+                                duration=random.randint(5, 120), repeats=0, protected=False))
@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Polls.backend import Backend
+from Polls.models import Batch
+
+
+class Command(BaseCommand):
+    help = 'Moves expired reports into the report archive (chunked; resumable with --batch).'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', type='int', dest='batch', default=None,
+                    help='Batch id of an interrupted run to resume.'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=Backend.ARCHIVE_CHUNK_SIZE,
+                    help='Reports archived per transaction (default: %i).' % Backend.ARCHIVE_CHUNK_SIZE),
+        make_option('--max-chunks', type='int', dest='max_chunks', default=None,
+                    help='Stop after this number of chunks.'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            batch, archived = Backend().reports_archive_all(batch=options['batch'],
+                                                            chunk_size=options['chunk_size'],
+                                                            max_chunks=options['max_chunks'])
+        except Batch.DoesNotExist:
+            raise CommandError('Batch %s does not exist' % options['batch'])
+        self.stdout.write('Batch %i: %i report(s) archived' % (batch.id, archived))
@@ -0,0 +1,37 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from Polls.backend import Backend
+from Polls.models import Batch
+
+
+class Command(BaseCommand):
+    help = 'Archives used up/expired transaction references (chunked; resumable with --batch).'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', type='int', dest='batch', default=None,
+                    help='Batch id of an interrupted run to resume.'),
+        make_option('--days', type='int', dest='days', default=365,
+                    help='Only transaction references not touched for this number of days (default: 365).'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=Backend.ARCHIVE_CHUNK_SIZE,
+                    help='Transaction references processed per transaction (default: %i).' % Backend.ARCHIVE_CHUNK_SIZE),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Report what would be archived without writing anything.'),
+    )
+
+    task = 'transaction_archive_all'
+
+    def handle(self, *args, **options):
+        try:
+            batch, stats = getattr(Backend(), self.task)(
+                batch=options['batch'],
+                created_before=timezone.now() - datetime.timedelta(days=options['days']),
+                chunk_size=options['chunk_size'],
+                dry_run=options['dry_run'])
+        except Batch.DoesNotExist:
+            raise CommandError('Batch %s does not exist' % options['batch'])
+        self.stdout.write('%s: %s' % ('Dry run' if batch is None else 'Batch %i' % batch.id,
+                                      ', '.join('%s=%s' % item for item in sorted(stats.items()))))
@@ -0,0 +1,85 @@
+import datetime
+import gzip
+import json
+import os
+import sys
+from itertools import chain
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from Polls.export import CHUNK_SIZE, SETTLE, WRITERS, iter_receipt_rows, iter_transaction_rows
+
+
+class Command(BaseCommand):
+    help = 'Streams transactions with their reference, account, condition and receipts as CSV/NDJSON ' \
+           '(constant memory; --month for monthly dumps, --state for incremental runs).'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='csv', choices=sorted(WRITERS),
+                    help='csv (default) or ndjson.'),
+        make_option('--output', dest='output', default='-',
+                    help='Output file (default: stdout); compressed if it ends with .gz.'),
+        make_option('--gzip', action='store_true', dest='gzip', default=False,
+                    help='Compress the output (gzip).'),
+        make_option('--month', dest='month', default=None,
+                    help='Only transactions created in this month (YYYY-MM).'),
+        make_option('--state', dest='state', default=None,
+                    help='State file of incremental runs: only transactions after the last exported one '
+                         'and receipts issued since the last run are exported, the file is updated after '
+                         'a successful run.'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=CHUNK_SIZE,
+                    help='Transactions per query (default: %i).' % CHUNK_SIZE),
+    )
+
+    def handle(self, *args, **options):
+        created_from = created_to = None
+        if options['month']:
+            try:
+                created_from = datetime.datetime.strptime(options['month'], '%Y-%m')
+            except ValueError:
+                raise CommandError('--month must be YYYY-MM')
+            created_to = (created_from + datetime.timedelta(days=32)).replace(day=1)
+            if settings.USE_TZ:
+                created_from, created_to = [timezone.make_aware(value, timezone.get_current_timezone())
+                                            for value in (created_from, created_to)]
+
+        state = {'last_id': 0}
+        if options['state'] and os.path.exists(options['state']):
+            with open(options['state']) as f:
+                state = json.load(f)
+
+        # both streams stop at the same bound (see Polls.export)
+        until = timezone.now() - SETTLE if options['state'] else None
+        rows = iter_transaction_rows(state['last_id'], created_from, created_to, options['chunk_size'], until)
+        if state.get('until'):
+            rows = chain(iter_receipt_rows(state['last_id'], parse_datetime(state['until']), until,
+                                           created_from, created_to, options['chunk_size']), rows)
+        exported = {'last_id': state['last_id'], 'until': until and until.isoformat()}
+
+        def tracked(rows):
+            for row in rows:
+                exported['last_id'] = max(exported['last_id'], row[0])     # receipt rows: transactions exported before
+                yield row
+
+        output = options['output']
+        compress = options['gzip'] or output.endswith('.gz')
+        if output == '-':
+            stream = gzip.GzipFile(fileobj=sys.stdout, mode='wb') if compress else sys.stdout
+        else:
+            stream = gzip.open(output, 'wb') if compress else open(output, 'wb')
+        try:
+            count = WRITERS[options['format']](tracked(rows), stream)
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+
+        if options['state']:
+            exported.update(exported_rows=count, updated=timezone.now().isoformat())
+            with open(options['state'] + '.tmp', 'w') as f:
+                json.dump(exported, f)
+            os.rename(options['state'] + '.tmp', options['state'])
+        self.stderr.write('%i row(s) exported, last transaction id %s' % (count, exported['last_id']))
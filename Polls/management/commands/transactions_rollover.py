@@ -0,0 +1,7 @@
+from Polls.management.commands import transactions_archive
+
+
+class Command(transactions_archive.Command):
+    help = 'Rolls over remaining B2B credits into carry-over credits and archives the consumed transactions.'
+
+    task = 'transaction_b2b_rollover_all'
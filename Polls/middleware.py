@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from Polls.util import db_routing
+from Polls.util.query_profiler import QueryProfiler
+
+
+class QueryProfilerMiddleware(object):
+    '''Logs query count, DB time and N+1 suspects per request (opt-in: settings.QUERY_PROFILER;
+    when disabled the middleware removes itself from the chain).'''
+
+    def __init__(self):
+        if not getattr(settings, 'QUERY_PROFILER', False):
+            raise MiddlewareNotUsed
+
+    def process_request(self, request):
+        request._query_profiler = QueryProfiler('%s %s' % (request.method, request.path))
+        request._query_profiler.__enter__()
+
+    def process_response(self, request, response):
+        profiler = getattr(request, '_query_profiler', None)
+        if profiler is not None:
+            del request._query_profiler
+            profiler.__exit__(None, None, None)
+            response['X-Query-Count'] = str(profiler.count)
+        return response
+
+
+class DatabaseRoutingMiddleware(object):
+    '''Scopes the read-your-writes pinning of Polls.util.db_routing to a single request.'''
+
+    def process_request(self, request):
+        db_routing.reset()
+
+    def process_response(self, request, response):
+        db_routing.reset()
+        return response
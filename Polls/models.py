@@ -4,13 +4,30 @@ Created on 18.04.2013
 @author: aimiela
 '''
 
+import binascii
 import datetime
+import operator
+import os
+import threading
+import time
 
-from random import random
+from collections import defaultdict, OrderedDict
+from itertools import imap
+from random import random, randrange, sample
 
+from django.conf import settings
+from django.core.cache import get_cache
 from django.db import models
+from django.db import connection
 from django.db import IntegrityError
-import md5
+from django.db import transaction
+from django.db.models.fields.related import ReverseSingleRelatedObjectDescriptor
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from Polls.util.bloom import BloomFilter
+from Polls.util.vat import vat_breakdown, vat_rate
 
 
 class BackendDB(models.Model):
@@ -96,6 +113,87 @@ class SessionAccount(BackendDB):
         app_label = 'Polls'
 
 
+class SessionResolver(object):
+    '''Resolves a Drupal session reference (Session.ext_session_ref) to (session_id, account_id, sub_account_id)
+    (latest session and SessionAccount; account ids are None for sessions without accounts).
+
+    Two cache levels: a process-local LRU of up to MAXSIZE entries kept for TTL seconds and an optional
+    shared Django cache (alias in settings.SESSION_RESOLVER_CACHE, e.g. memcached; locmem works as a
+    local stand-in). Misses are resolved with one joined query; unknown references are not cached.
+    Saved/deleted SessionAccount rows invalidate their session reference (local caches of other
+    processes catch up after TTL seconds).'''
+
+    MAXSIZE = 10000
+    TTL = 300
+    KEY_PREFIX = 'session_resolver:'
+
+    shared_cache = get_cache(settings.SESSION_RESOLVER_CACHE) if getattr(settings, 'SESSION_RESOLVER_CACHE', None) else None
+
+    _entries = OrderedDict()   # ext_session_ref -> (expires, resolution); most recently used last
+    _lock = threading.Lock()
+    hits = shared_hits = misses = evictions = 0
+
+    @classmethod
+    def resolve(cls, ext_session_ref):
+        now = time.time()
+        with cls._lock:
+            entry = cls._entries.pop(ext_session_ref, None)
+            if entry is not None:
+                if entry[0] > now:
+                    cls._entries[ext_session_ref] = entry
+                    cls.hits += 1
+                    return entry[1]
+                cls.evictions += 1
+
+        resolution = cls.shared_cache.get(cls.KEY_PREFIX + ext_session_ref) if cls.shared_cache is not None else None
+        if resolution is not None:
+            cls.shared_hits += 1
+        else:
+            cls.misses += 1
+            resolution = next(iter(Session.objects.filter(ext_session_ref=ext_session_ref)
+                                                  .order_by('-id', '-sessionaccount__id')
+                                                  .values_list('id', 'sessionaccount__account', 'sessionaccount__sub_account')[:1]), None)
+            if resolution is None:
+                return None
+            if cls.shared_cache is not None:
+                cls.shared_cache.set(cls.KEY_PREFIX + ext_session_ref, resolution, cls.TTL)
+
+        with cls._lock:
+            cls._entries.pop(ext_session_ref, None)
+            cls._entries[ext_session_ref] = (now + cls.TTL, resolution)
+            while len(cls._entries) > cls.MAXSIZE:
+                cls._entries.popitem(last=False)
+                cls.evictions += 1
+        return resolution
+
+    @classmethod
+    def invalidate(cls, ext_session_ref=None):
+        '''Drops one session reference (from both cache levels) or the whole local cache.'''
+
+        with cls._lock:
+            if ext_session_ref is None:
+                cls._entries.clear()
+            else:
+                cls._entries.pop(ext_session_ref, None)
+        if ext_session_ref is not None and cls.shared_cache is not None:
+            cls.shared_cache.delete(cls.KEY_PREFIX + ext_session_ref)
+
+    @classmethod
+    def stats(cls):
+        lookups = cls.hits + cls.shared_hits + cls.misses
+        return dict(size=len(cls._entries), hits=cls.hits, shared_hits=cls.shared_hits, misses=cls.misses,
+                    evictions=cls.evictions, hit_rate=float(cls.hits + cls.shared_hits) / lookups if lookups else 0.0)
+
+
+@receiver(post_save, sender=SessionAccount)
+@receiver(post_delete, sender=SessionAccount)
+def _session_account_changed(sender, instance, **kwargs):
+    try:
+        SessionResolver.invalidate(Session.objects.values_list('ext_session_ref', flat=True).get(pk=instance.session_id))
+    except Session.DoesNotExist:
+        SessionResolver.invalidate()
+
+
 class Login(BackendDB):
     '''Stores CCD/SF logins.'''
 
@@ -114,6 +212,77 @@ class Login(BackendDB):
     class Meta:
 		app_label = 'Polls'
 
+    @classmethod
+    def login_exists(cls, login):
+        '''Checks a single login using the PK index.'''
+
+        return cls.objects.filter(pk=login).exists()
+
+    @classmethod
+    def existing_logins(cls, logins, use_filter=False, chunk_size=500):
+        '''Returns the subset of logins already registered, using one PK IN (...) query per chunk.
+        With use_filter clear negatives are sorted out by LoginFilter without touching the database.'''
+
+        logins = set(logins)
+        if use_filter:
+            login_filter = LoginFilter.get()
+            logins = [login for login in logins if login in login_filter]
+        else:
+            logins = list(logins)
+
+        existing = set()
+        for i in range(0, len(logins), chunk_size):
+            existing.update(cls.objects.filter(pk__in=logins[i:i + chunk_size]).values_list('login', flat=True))
+        return existing
+
+
+class LoginFilter(object):
+    '''Process-local Bloom filter of all Login.login values (no false negatives).
+
+    New logins are added on Login save; deleted ones cannot be removed from a Bloom filter,
+    so a delete marks the filter stale. Logins saved by other processes are picked up by
+    rebuilding the filter after TTL seconds (use it for bulk validation only).'''
+
+    TTL = 300
+    ERROR_RATE = 0.001
+    CAPACITY_HEADROOM = 2   # planned capacity = HEADROOM * current logins
+
+    _filter = None
+    _built = 0
+
+    @classmethod
+    def get(cls):
+        if cls._filter is None or cls._filter.is_full() or time.time() - cls._built > cls.TTL:
+            cls.rebuild()
+        return cls._filter
+
+    @classmethod
+    def rebuild(cls):
+        logins = Login.objects.values_list('login', flat=True)
+        login_filter = BloomFilter(cls.CAPACITY_HEADROOM * logins.count(), cls.ERROR_RATE)
+        login_filter.update(logins.iterator())
+        cls._filter, cls._built = login_filter, time.time()
+
+    @classmethod
+    def add(cls, login):
+        if cls._filter is not None:
+            cls._filter.add(login)
+
+    @classmethod
+    def invalidate(cls):
+        cls._filter = None
+
+
+@receiver(post_save, sender=Login)
+def _login_saved(sender, instance, **kwargs):
+    LoginFilter.add(instance.login)
+
+
+@receiver(post_delete, sender=Login)
+def _login_deleted(sender, instance, **kwargs):
+    LoginFilter.invalidate()
+
+
 class Requester(BackendDB):
     '''Stores requesters/originators to identify the direct/indirect service caller.'''
 
@@ -123,7 +292,49 @@ class Requester(BackendDB):
     class Meta:
 		app_label = 'Polls'
 
-class RC(BackendDB):
+class SequenceIdBase(BackendDB):
+    '''Abstract integer IDs taken from blocks reserved in IdSequence (one sequence per table) instead
+    of the table's autoincrement counter, so rows written with bulk INSERTs (see Polls.record_check)
+    get their IDs up front. Every save() of a new row takes its ID from the sequence as well; rows
+    must not be inserted with raw SQL relying on the autoincrement counter.'''
+
+    ID_BLOCK_SIZE = 1000    # IDs reserved per process and table at once
+
+    _id_blocks = {}         # (pid, table) -> IDs reserved by this process
+    _id_lock = threading.Lock()
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def take_ids(cls, count):
+        '''Returns count unique IDs from the blocks reserved by this process.'''
+
+        table = cls._meta.db_table
+        with cls._id_lock:
+            ids = cls._id_blocks.setdefault((os.getpid(), table), [])
+            if len(ids) < count:
+                reserve = max(count - len(ids), cls.ID_BLOCK_SIZE)
+                # the first block starts above the rows written before the sequence existed
+                start = IdSequence.reserve(table, reserve,
+                                           initial=lambda: (cls.objects.aggregate(max_id=models.Max('id'))['max_id'] or 0) + 1)
+                ids.extend(xrange(start, start + reserve))
+            taken = ids[:count]
+            del ids[:count]
+        return taken
+
+    def save(self, *args, **kwargs):
+        '''Takes a new ID from the sequence automatically.'''
+
+        if self.pk is None:
+            self.pk = self.take_ids(1)[0]
+            args = (True, False) + args[2:]  # force_insert, force_update
+            kwargs.pop('force_insert', None)
+            kwargs.pop('force_update', None)
+        return super(SequenceIdBase, self).save(*args, **kwargs)
+
+
+class RC(SequenceIdBase):
     '''Registers each record check attempt.'''
 
     id = models.AutoField(primary_key=True, null=False)                                 # Record Check ID (PK)
@@ -159,26 +370,22 @@ class Condition(BackendDB):
     vat_value = models.DecimalField(max_digits=10, decimal_places=2, null=True)  # VAT value (if relevant)
     currency = models.CharField(max_length=3, null=True)                        # Currency (if relevant)
 
+    @property
+    def country(self):
+        '''VAT country: condition IDs start with the country ISO code ('SE_VHR_SINGLE').'''
+
+        return self.id[:2]
+
     def save(self, *args, **kwargs):
         '''Calculates (if needed) tax-related values.'''
 
         if self.price and self.net_price is None and self.vat_rate is None and self.vat_value is None:
-            if self.id.startswith('SE'):
-                vat_rate = 25
-            else:
-                vat_rate = 19
-            net_price = round(100 * self.price / (100 + vat_rate), 2)
-            vat_value = self.price - net_price
-
-            self.price = '%.2f' % self.price
-            self.net_price = '%.2f' % net_price
-            self.vat_rate = '%.2f' % vat_rate
-            self.vat_value = '%.2f' % vat_value
+            self.price, self.net_price, self.vat_rate, self.vat_value = vat_breakdown(self.price, vat_rate(self.country))
 
             args = (True, False) + args[2:]  # force_insert, force_update
             kwargs.pop('force_insert', None)
             kwargs.pop('force_update', None)
-        return super(Condition, self).save(args, **kwargs)
+        return super(Condition, self).save(*args, **kwargs)
 
 
 class ReportCondition(BackendDB):
@@ -196,7 +403,7 @@ class ReportCondition(BackendDB):
         app_label = 'Polls'
 		
 		
-class RcResult(BackendDB):
+class RcResult(SequenceIdBase):
     id = models.AutoField(primary_key=True, null=False)                    # Record Check alternative ID (PK)
     rc = models.ForeignKey(RC)                                             # Record Check reference
     report_type = models.ForeignKey(ReportType)                            # ReportType ID
@@ -208,36 +415,101 @@ class RcResult(BackendDB):
 #    lang = models.CharField(max_length=2, null=False)
 
 
+class IdSequence(BackendDB):
+    '''Block allocator counters (one row per sequence). Each reservation takes a disjoint
+    block of values, so concurrent workers never hand out the same value.'''
+
+    name = models.CharField(max_length=50, primary_key=True, null=False)   # sequence name (PK)
+    next_value = models.BigIntegerField(default=0, null=False)            # first value of the next block
+
+    class Meta:
+        app_label = 'Polls'
+
+    @classmethod
+    def reserve(cls, name, count, initial=None):
+        '''Reserves count consecutive values of the sequence; returns the first one.
+        initial: callable returning the first value of a sequence which does not exist yet (default: 0).'''
+
+        with transaction.atomic():
+            try:
+                seq = cls.objects.select_for_update().get(name=name)
+            except cls.DoesNotExist:
+                try:
+                    with transaction.atomic():
+                        seq = cls.objects.create(name=name, next_value=initial() if initial else 0)
+                except IntegrityError:  # created concurrently
+                    seq = cls.objects.select_for_update().get(name=name)
+            cls.objects.filter(name=name).update(next_value=models.F('next_value') + count)
+        return seq.next_value
+
+
+class ExpirySweep(BackendDB):
+    '''High-water mark of an incremental expiry sweep (see Backend.expiry_sweep): rows up to
+    (expires_on, last_id) have been processed.'''
+
+    name = models.CharField(max_length=50, primary_key=True, null=False)   # sweep name (PK)
+    expires_on = models.DateTimeField(null=True)                          # expires_on of the last processed row
+    last_id = models.IntegerField(default=0, null=False)                  # id of the last processed row
+    updated = models.DateTimeField(auto_now=True, null=False)             # last run
+
+    class Meta:
+        app_label = 'Polls'
+
+
 class TransactionReferenceBase(BackendDB):
-    '''Abstract parameters of an unique "human readable" transaction references for grouping related Transaction records and issuing receipts.'''
+    '''Abstract parameters of an unique "human readable" transaction references for grouping related Transaction records and issuing receipts.
+
+    New IDs are taken from blocks reserved in IdSequence instead of being generated randomly, so no
+    ID is ever handed out twice. All subclasses share one sequence (ID_SEQUENCE): a Receipt shares
+    its id with its TransactionReference, so an ID allocated for one table must never be handed
+    out for another.'''
 
     ALLOWED_PK_CHARACTERS = '34679ACDEFGHJKLMNPRTUVWXY'  # removed: 0/O/Q, 1/I, 2/Z, 5/S, B/8
     PK_LENGTH = 8
     MAX_PK_TRIES = 5
+    ID_BLOCK_SIZE = 100          # IDs reserved per process at once
+    ID_MULTIPLIER = 2654435761   # coprime with len(ALLOWED_PK_CHARACTERS) ** PK_LENGTH: scatters consecutive sequence values
+    ID_SEQUENCE = 'Polls_transactionreference'   # IdSequence name (shared by all subclasses)
+
+    _id_block = []               # IDs reserved by this process (shared by all subclasses)
+    _id_lock = threading.Lock()
 
     class Meta:
         abstract = True
 
+    @classmethod
+    def _id_from_index(cls, index):
+        '''Maps a sequence value onto an ID using ALLOWED_PK_CHARACTERS/PK_LENGTH constrains (bijective).'''
 
-class TransactionReference(TransactionReferenceBase):
-    '''Provides unique "human readable" transaction references for grouping related Transaction records.'''
+        base = len(cls.ALLOWED_PK_CHARACTERS)
+        index = index * cls.ID_MULTIPLIER % base ** cls.PK_LENGTH
+        chars = []
+        for _ in range(cls.PK_LENGTH):
+            index, pos = divmod(index, base)
+            chars.append(cls.ALLOWED_PK_CHARACTERS[pos])
+        return u''.join(chars)
 
-    id = models.CharField(max_length=TransactionReferenceBase.PK_LENGTH, primary_key=True, null=False)  # PK
-    created = models.DateTimeField(default=datetime.datetime.now, null=False)                         # Creation timestamp
+    @classmethod
+    def reserve_ids(cls, count):
+        '''Reserves a batch of count unique IDs (one short locking UPDATE).'''
 
-    def __get_id(self):
-        '''Generates randomly a new alpha-numerical token using ALLOWED_PK_CHARACTERS/PK_LENGTH constrains.'''
+        start = IdSequence.reserve(cls.ID_SEQUENCE, count)
+        return [cls._id_from_index(index) for index in xrange(start, start + count)]
 
-        new_id = u''
-        for _ in range(self.PK_LENGTH):
-            new_id += self.ALLOWED_PK_CHARACTERS[int(random() * len(self.ALLOWED_PK_CHARACTERS))]
-        return new_id
+    @classmethod
+    def next_id(cls):
+        '''Returns the next unique ID from the block reserved by this process.'''
+
+        with cls._id_lock:
+            if not cls._id_block:
+                cls._id_block.extend(reversed(cls.reserve_ids(cls.ID_BLOCK_SIZE)))
+            return cls._id_block.pop()
 
     def save(self, *args, **kwargs):
-        '''Generates a new key automatically.'''
+        '''Takes a new key from the allocator automatically.'''
 
         if self.pk:
-            return super(TransactionReference, self).save(*args, **kwargs)
+            return super(TransactionReferenceBase, self).save(*args, **kwargs)
         else:
             # Django ORM clean-up...
             args = (True, False) + args[2:]  # force_insert, force_update
@@ -246,49 +518,69 @@ class TransactionReference(TransactionReferenceBase):
             # ...Django ORM clean-up
             for _ in range(self.MAX_PK_TRIES):
                 try:
-                    self.pk = self.__get_id()
-                    return super(TransactionReference, self).save(args, **kwargs)
+                    self.pk = self.next_id()
+                    with transaction.atomic():
+                        return super(TransactionReferenceBase, self).save(*args, **kwargs)
                 except IntegrityError:
+                    # ID taken by a legacy (randomly generated) record: use the next allocated one
                     pass
-                except:
-                    raise
             else:
 # TODO: consider a dedicated/own exception
                 raise IntegrityError
 
 
+class TransactionReference(TransactionReferenceBase):
+    '''Provides unique "human readable" transaction references for grouping related Transaction records.'''
+
+    id = models.CharField(max_length=TransactionReferenceBase.PK_LENGTH, primary_key=True, null=False)  # PK
+    created = models.DateTimeField(default=datetime.datetime.now, null=False)                         # Creation timestamp
+
+
 class Token(BackendDB):
     '''Stores CCD tokens. Might be used also for supporting US and PDF links.'''
 
-    MAX_PK_TRIES = 3
+    BULK_CHUNK_SIZE = 300  # reports linked per UPDATE statement
 
     id = models.CharField(max_length=32, primary_key=True)   # PK
 
-    def __get_id(self):
-        '''Generates a random MD5 hash'''
-        return md5.md5('%s%s' % (unicode(random()), unicode(datetime.datetime.now()))).hexdigest()
+    @staticmethod
+    def new_id():
+        '''Generates an unguessable 32 characters ID (128 bits from the OS CSPRNG: collisions are not an issue).'''
+
+        return binascii.hexlify(os.urandom(16))
 
     def save(self, *args, **kwargs):
         '''Generates a new key automatically.'''
-        if self.pk:
-            return super(Token, self).save(*args, **kwargs)
-        else:
+        if not self.pk:
             # Django ORM clean-up...
             args = (True, False) + args[2:]  # force_insert, force_update
             kwargs.pop('force_insert', None)
             kwargs.pop('force_update', None)
             # ...Django ORM clean-up
-            for _ in range(self.MAX_PK_TRIES):
-                try:
-                    self.pk = self.__get_id()
-                    return super(Token, self).save(args, **kwargs)
-                except IntegrityError:
-                    pass
-                except:
-                    raise
-            else:
-# TODO: consider a dedicated/own exception
-                raise IntegrityError
+            self.pk = self.new_id()
+        return super(Token, self).save(*args, **kwargs)
+
+    @classmethod
+    def issue_for_reports(cls, reports):
+        '''Creates tokens for all given reports (not having one yet) with a single bulk INSERT
+        and links Report.token (UPDATE ... CASE per chunk) in the same transaction.'''
+
+        reports = [report for report in reports if report.token_id is None]
+        tokens = [cls(id=cls.new_id()) for _ in reports]
+        qn = connection.ops.quote_name
+        pk_column = qn(Report._meta.pk.column)
+        with transaction.atomic():
+            cls.objects.bulk_create(tokens)
+            cursor = connection.cursor()
+            for i in range(0, len(reports), cls.BULK_CHUNK_SIZE):
+                chunk = zip(reports[i:i + cls.BULK_CHUNK_SIZE], tokens[i:i + cls.BULK_CHUNK_SIZE])
+                cursor.execute('UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+                                    qn(Report._meta.db_table), qn(Report._meta.get_field('token').column), pk_column,
+                                    ' '.join(['WHEN %s THEN %s'] * len(chunk)), pk_column, ', '.join(['%s'] * len(chunk))),
+                               [param for report, token in chunk for param in (report.pk, token.pk)] + [report.pk for report, _ in chunk])
+        for report, token in zip(reports, tokens):
+            report.token = token
+        return tokens
 
 
 class Report(BackendDB):
@@ -302,8 +594,8 @@ class Report(BackendDB):
 
     query = models.CharField(max_length=50, default=None, null=False)           # Original user query
 
-    expires_on = models.DateTimeField(null=True)                                # Expiration date
-    created = models.DateTimeField(default=datetime.datetime.now, null=False)  # Creation timestamp
+    expires_on = models.DateTimeField(null=True, db_index=True)                 # Expiration date
+    created = models.DateTimeField(default=datetime.datetime.now, null=False, db_index=True)  # Creation timestamp
     ccd_ag_req = models.URLField(null=True, max_length=250)                     # CCD-alike AG request (backwards compatibility/used for log maintenance)
     parent = models.ForeignKey('Report', null=True, default=None)               # Parent report reference for linked reports (like US links)
     token = models.ForeignKey(Token, null=True, unique=True)                    # Report token
@@ -331,24 +623,149 @@ class Asset(BackendDB):
 class Transaction(BackendDB):
     '''Stores transactions: credits, purchases & more.'''
 
+    CREDIT_TYPES = (100, 199)   # 1xx=credits (inclusive range)
+    PULL_TYPE = 200             # pulled report (counts against credits)
+
     id = models.AutoField(primary_key=True, null=False)                                             # PK
     t_ref = models.ForeignKey(TransactionReference)                                                 # Transaction reference (to group related transactions)
     account = models.ForeignKey(Account)                                                            # account_id (company's account ID for b2b)
     sub_account = models.ForeignKey(Account, related_name='transaction_sub_account', null=True)   # employee's account ID (applicable for b2b only)
     role = models.IntegerField(default=None, null=True)                                             # Defined by frontend MIGHT BE DELETED
-    t_type = models.IntegerField(default=0, null=False)                                             # Transaction type: 1xx=credits; 2xx=pulls;
+    t_type = models.IntegerField(default=0, null=False, db_index=True)                              # Transaction type: 1xx=credits; 2xx=pulls;
     requester = models.ForeignKey(Requester, null=True)                                             # Requester (website) reference
     condition = models.ForeignKey(Condition, null=True)                                             # Condition reference
     rcresult = models.ForeignKey(RcResult, null=True)                                               # RC result reference
     report = models.ForeignKey(Report, null=True)                                                   # Report related directly to the transaction (if any)
     ext_t_ref = models.CharField(max_length=50, null=True)                                          # External transaction reference
     qty = models.IntegerField(null=True)                                                            # Quantity (if relevant)
-    expires_on = models.DateTimeField(null=True)                                                    # Expiration date
-    created = models.DateTimeField(default=datetime.datetime.now, null=False)                     # Creation timestamp
+    expires_on = models.DateTimeField(null=True, db_index=True)                                     # Expiration date
+    created = models.DateTimeField(default=datetime.datetime.now, null=False, db_index=True)      # Creation timestamp
     asset = models.ForeignKey(Asset, null=True)                                                     # Asset reference
     class Meta:
 		app_label = 'Polls'
 
+    @classmethod
+    def is_credit(cls, t_type):
+        return cls.CREDIT_TYPES[0] <= t_type <= cls.CREDIT_TYPES[1]
+
+class CreditBalance(BackendDB):
+    '''Materialised credit balance per transaction reference.
+
+    Kept up to date incrementally on Transaction save/delete (1xx/2xx types); bulk operations
+    bypassing the ORM signals have to call refresh() for the affected references.'''
+
+    t_ref = models.OneToOneField(TransactionReference, primary_key=True)   # Transaction reference (PK)
+    credits = models.IntegerField(default=0, null=False)                  # Sum of credit quantities (1xx)
+    pulls = models.IntegerField(default=0, null=False)                    # Number of pulled reports (see Transaction.PULL_TYPE)
+    unlimited = models.BooleanField(default=False)                        # Credited with an UNLIMITED condition
+    expired = models.BooleanField(default=False)                          # All credits expired (no credits remaining)
+    class Meta:
+		app_label = 'Polls'
+
+    MAX_REFRESH_TRIES = 3   # refresh() attempts per chunk (concurrent inserts of the same balance)
+
+    @classmethod
+    def remaining_credits(cls, t_ref):
+        '''Remaining credits of a transaction reference (instance or id); 'INF' for unlimited conditions.'''
+
+        try:
+            balance = cls.objects.get(pk=getattr(t_ref, 'pk', t_ref))
+        except cls.DoesNotExist:
+            return 0
+        if balance.expired:
+            return 0
+        return 'INF' if balance.unlimited else balance.credits - balance.pulls
+
+    @classmethod
+    def apply(cls, transaction, sign=1):
+        '''Adds (sign=1) or removes (sign=-1) a transaction to/from the balance of its reference.'''
+
+        if Transaction.is_credit(transaction.t_type):
+            if sign < 0 or (transaction.condition_id or '').endswith('UNLIMITED'):
+                # rare; the unlimited/expired flags cannot be maintained incrementally on removal
+                cls.refresh([transaction.t_ref_id])
+                return
+            changes = {'credits': models.F('credits') + (transaction.qty or 0)}
+            if transaction.expires_on is None or transaction.expires_on > timezone.now():
+                changes['expired'] = False
+        elif transaction.t_type == Transaction.PULL_TYPE:
+            changes = {'pulls': models.F('pulls') + sign}
+        else:
+            return
+
+        if not cls.objects.filter(t_ref=transaction.t_ref_id).update(**changes):
+            # first transaction of the reference (or balance not built yet)
+            cls.refresh([transaction.t_ref_id])
+
+    @classmethod
+    def _insert_select(cls, where='', params=()):
+        qn = connection.ops.quote_name
+        column = lambda model, name: qn(model._meta.get_field(name).column)
+        credit = '%s BETWEEN %i AND %i' % ((column(Transaction, 't_type'),) + Transaction.CREDIT_TYPES)
+        live_credit = '%s AND (%s IS NULL OR %s > %%s)' % (credit, column(Transaction, 'expires_on'), column(Transaction, 'expires_on'))
+        sql = 'INSERT INTO %s (%s, %s, %s, %s, %s) SELECT %s, ' \
+              'SUM(CASE WHEN %s THEN COALESCE(%s, 0) ELSE 0 END), SUM(CASE WHEN %s = %i THEN 1 ELSE 0 END), ' \
+              'CASE WHEN MAX(CASE WHEN %s AND %s LIKE %%s THEN 1 ELSE 0 END) = 1 THEN %%s ELSE %%s END, ' \
+              'CASE WHEN MAX(CASE WHEN %s THEN 1 ELSE 0 END) = 1 AND MAX(CASE WHEN %s THEN 1 ELSE 0 END) = 0 THEN %%s ELSE %%s END ' \
+              'FROM %s %s GROUP BY %s' % (
+                  qn(cls._meta.db_table), column(cls, 't_ref'), column(cls, 'credits'), column(cls, 'pulls'), column(cls, 'unlimited'),
+                  column(cls, 'expired'),
+                  column(Transaction, 't_ref'), credit, column(Transaction, 'qty'), column(Transaction, 't_type'), Transaction.PULL_TYPE,
+                  credit, column(Transaction, 'condition'), credit, live_credit,
+                  qn(Transaction._meta.db_table), where, column(Transaction, 't_ref'))
+        cursor = connection.cursor()
+        cursor.execute(sql, ['%UNLIMITED', True, False, timezone.now(), True, False] + list(params))
+        return cursor.rowcount
+
+    @classmethod
+    def refresh(cls, t_ref_ids, chunk_size=500):
+        '''Recomputes (set-based) the balances of the given transaction references.
+
+        A balance inserted concurrently (e.g. the first transactions of a new reference saved in
+        parallel) makes the INSERT fail: the chunk is retried, its DELETE then removes the other
+        balance and the INSERT ... SELECT sees the other transaction.'''
+
+        qn = connection.ops.quote_name
+        t_ref_ids = list(t_ref_ids)
+        for i in range(0, len(t_ref_ids), chunk_size):
+            chunk = t_ref_ids[i:i + chunk_size]
+            for attempt in range(cls.MAX_REFRESH_TRIES):
+                try:
+                    with transaction.atomic():
+                        cls.objects.filter(t_ref__in=chunk).delete()
+                        cls._insert_select('WHERE %s IN (%s)' % (qn(Transaction._meta.get_field('t_ref').column),
+                                                                 ', '.join(['%s'] * len(chunk))), chunk)
+                    break
+                except IntegrityError:
+                    if attempt == cls.MAX_REFRESH_TRIES - 1:
+                        raise
+
+    @classmethod
+    def rebuild(cls):
+        '''Rebuilds the whole table from scratch (single INSERT ... SELECT); returns the number of balances.'''
+
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls._insert_select()
+        return cls.objects.count()
+
+
+@receiver(post_save, sender=Transaction)
+def _transaction_saved(sender, instance, created, raw=False, **kwargs):
+    if raw or not 100 <= instance.t_type < 300:
+        return
+    if created:
+        CreditBalance.apply(instance)
+    else:
+        CreditBalance.refresh([instance.t_ref_id])
+
+
+@receiver(post_delete, sender=Transaction)
+def _transaction_deleted(sender, instance, **kwargs):
+    if 100 <= instance.t_type < 300:
+        CreditBalance.apply(instance, -1)
+
+
 class Report_Archive(BackendDB):
     '''Stores report data.'''
 
@@ -386,7 +803,7 @@ class Receipt(TransactionReferenceBase):
     '''Stores issued receipts/freezing actual purchase conditions.
 
     WARNING: for better performance there is no constrain Receipt.id->TransactionReference.id!
-    It has to be enforced by the code.'''
+    It has to be enforced by the code: if no id is given, the id of the transaction's reference is used.'''
 
     id = models.CharField(max_length=TransactionReferenceBase.PK_LENGTH, primary_key=True, null=False)   # PK
     transaction = models.ForeignKey(Transaction)                                                         # Transaction id
@@ -395,8 +812,19 @@ class Receipt(TransactionReferenceBase):
     vat_rate = models.DecimalField(max_digits=4, decimal_places=2, null=False)                           # VAT rate (if relevant)
     vat_value = models.DecimalField(max_digits=10, decimal_places=2, null=False)                         # VAT value (if relevant)
     currency = models.CharField(max_length=3, default=None, null=False)                                  # Currency (if relevant)
+    created = models.DateTimeField(default=timezone.now, null=False, db_index=True)                     # Issue timestamp (incremental exports)
     class Meta:
 		app_label = 'Polls'
+
+    def save(self, *args, **kwargs):
+        '''Takes the id of the transaction's reference (never a new one from the allocator).'''
+
+        if not self.pk:
+            t_ref_id = self.transaction.t_ref_id if self.transaction_id is not None else None
+            if not t_ref_id:
+                raise ValueError('Receipt without id needs a transaction with a transaction reference')
+            self.pk = t_ref_id
+        return super(Receipt, self).save(*args, **kwargs)
 #===============================================================================
 # Batch
 #=========================================================================
@@ -431,6 +859,59 @@ class ViatelBatch(BackendDB):
     class Meta:
 		app_label = 'Polls'
 
+    def is_valid(self, at=None):
+        '''Active (neither test nor cancelled) and within the validity period.'''
+
+        return ViatelBatchCache._is_valid((self.valid_from, self.valid_to, self.inactive), at or timezone.now())
+
+
+class ViatelBatchCache(object):
+    '''Process-local cache of ViatelBatch validity metadata: batch_id -> (valid_from, valid_to, inactive).
+
+    Invalidated on ViatelBatch save/delete; changes made by other processes are picked up after TTL seconds.'''
+
+    TTL = 60
+
+    _batches = None
+    _loaded = 0
+
+    @classmethod
+    def batches(cls):
+        if cls._batches is None or time.time() - cls._loaded > cls.TTL:
+            cls._batches = dict((batch_id, (valid_from, valid_to, inactive)) for batch_id, valid_from, valid_to, inactive
+                                in ViatelBatch.objects.values_list('batch', 'valid_from', 'valid_to', 'inactive'))
+            cls._loaded = time.time()
+        return cls._batches
+
+    @classmethod
+    def invalidate(cls):
+        cls._batches = None
+
+    @staticmethod
+    def _is_valid(batch, at):
+        valid_from, valid_to, inactive = batch
+        return not inactive & (ViatelBatch.INACTIVE_BITS.TEST | ViatelBatch.INACTIVE_BITS.CANCELLED) \
+            and (valid_from is None or valid_from <= at) and (valid_to is None or at <= valid_to)
+
+    @classmethod
+    def valid_batch_ids(cls, at=None):
+        at = at or timezone.now()
+        return [batch_id for batch_id, batch in cls.batches().iteritems() if cls._is_valid(batch, at)]
+
+    @classmethod
+    def active_batch_ids(cls):
+        '''Batches neither marked as test nor cancelled (regardless of the validity period).'''
+
+        return [batch_id for batch_id, (_, _, inactive) in cls.batches().iteritems()
+                if not inactive & (ViatelBatch.INACTIVE_BITS.TEST | ViatelBatch.INACTIVE_BITS.CANCELLED)]
+
+
+@receiver(post_save, sender=ViatelBatch)
+@receiver(post_delete, sender=ViatelBatch)
+def _viatel_batch_changed(sender, **kwargs):
+    ViatelBatchCache.invalidate()
+
+
 class ViatelCode(BackendDB):
     '''Generated Viatel codes.'''
 
@@ -446,6 +927,7 @@ class ViatelCode(BackendDB):
     # 10000 codes/45000 already existing)
     MAX_PK_TRIES = 100
     CODE_LENGTH = 6
+    BULK_CHUNK_SIZE = 1000  # codes per bulk INSERT
 
     code = models.CharField(primary_key=True, max_length=CODE_LENGTH, default=None, null=False)  # code (PK)
     batch = models.ForeignKey('ViatelBatch', null=False)                                        # batch id
@@ -484,6 +966,82 @@ class ViatelCode(BackendDB):
             else:
                 raise IntegrityError('Failed to generate a unique code after %i attempt(s)' % self.MAX_PK_TRIES)
 
+    @classmethod
+    def code_space_size(cls):
+        '''Number of codes allowed by ALLOWED_PK_CHARACTERS/CODE_LENGTH constrains.'''
+
+        return reduce(operator.mul, [len(chars) for chars in cls.ALLOWED_PK_CHARACTERS[:cls.CODE_LENGTH]], 1)
+
+    @classmethod
+    def free_code_space(cls):
+        '''Number of codes still available.'''
+
+        return cls.code_space_size() - cls.objects.count()
+
+    @classmethod
+    def _code_from_index(cls, index):
+        '''Maps 0 <= index < code_space_size() onto a code (mixed radix, last position = lowest digit).'''
+
+        code = []
+        for chars in reversed(cls.ALLOWED_PK_CHARACTERS[:cls.CODE_LENGTH]):
+            index, pos = divmod(index, len(chars))
+            code.append(chars[pos])
+        return u''.join(reversed(code))
+
+    @classmethod
+    def _draw_codes(cls, count, used):
+        '''Draws count unique codes not in used (in memory).'''
+
+        space = cls.code_space_size()
+        if count > space - len(used):
+            raise IntegrityError('Cannot generate %i code(s): only %i code(s) left' % (count, space - len(used)))
+
+        if 2 * (len(used) + count) < space:
+            # sparse code space: rejection sampling
+            codes = set()
+            while len(codes) < count:
+                code = cls._code_from_index(randrange(space))
+                if code not in used:
+                    codes.add(code)
+            return list(codes)
+        else:
+            # dense code space: sample from the free codes
+            return sample([code for code in imap(cls._code_from_index, xrange(space)) if code not in used], count)
+
+    @classmethod
+    def generate_batch(cls, viatel_batch, count, chunk_size=BULK_CHUNK_SIZE):
+        '''Generates count new codes for viatel_batch: the used code space is loaded once,
+        new codes are drawn in memory and inserted with chunked bulk INSERTs.
+        Codes taken concurrently by another process are replaced (up to MAX_PK_TRIES times per chunk).
+
+        Returns (list of new codes, number of codes left in the code space).'''
+
+        used = set(cls.objects.values_list('code', flat=True).iterator())
+        codes = cls._draw_codes(count, used)
+        used.update(codes)
+
+        generated = []
+        for i in range(0, len(codes), chunk_size):
+            chunk = codes[i:i + chunk_size]
+            for _ in range(cls.MAX_PK_TRIES):
+                try:
+                    with transaction.atomic():
+                        cls.objects.bulk_create([cls(code=code, batch=viatel_batch) for code in chunk])
+                    generated.extend(chunk)
+                    break
+                except IntegrityError:
+                    taken = set(cls.objects.filter(code__in=chunk).values_list('code', flat=True))
+                    if not taken:
+                        raise
+                    used.update(taken)
+                    replacements = cls._draw_codes(len(taken), used)
+                    used.update(replacements)
+                    chunk = [code for code in chunk if code not in taken] + replacements
+            else:
+                raise IntegrityError('Failed to generate unique codes after %i attempt(s)' % cls.MAX_PK_TRIES)
+
+        return generated, cls.code_space_size() - len(used)
+
 
 class ViatelUsedCode(BackendDB):
     '''Stores utilized Viatel codes.'''
@@ -501,7 +1059,7 @@ class ViatelLog(BackendDB):
     prn = models.CharField(max_length=50, default=None, null=False)             # called PRN=Premium Rate Number
     input = models.CharField(max_length=250, null=True, db_index=True)          # input=code
     caller = models.CharField(max_length=50, null=True)                         # caller number
-    time = models.DateTimeField(null=False)                                     # call time stamp (finish)
+    time = models.DateTimeField(null=False, db_index=True)                      # call time stamp (finish)
     rate = models.DecimalField(max_digits=5, decimal_places=0, null=False)      # call cost in "cents"
     currency = models.CharField(max_length=3, default=None, null=False)         # currency (ISO 3-chars)
     ratetype = models.CharField(max_length=3, default=None, null=False)         # transaction type: PPC=Price Per Call or PPM=Pcide Per Minute
@@ -517,24 +1075,228 @@ class ViatelLog(BackendDB):
             yield field.name
     class Meta:
 		app_label = 'Polls'
-#===========================================================================
-# class Transaction_Archive(Transaction):
-#    pass
-#===========================================================================
+
+
+#===============================================================================
+# Reference data
+#=========================================================================
+
+
+class ReferenceData(object):
+    '''Process-local, versioned read-through cache of the small reference tables (initial_data fixture).
+
+    Tables are loaded whole on first use. Saving/deleting any of them bumps a version stamp
+    (IdSequence VERSION_SEQUENCE); other processes compare it at most every CHECK_INTERVAL seconds
+    and reload on change. Cached instances are shared: treat them as read-only.'''
+
+    MODELS = (Condition, ReportType, Requester, ReportCondition)
+    VERSION_SEQUENCE = 'reference_data_version'
+    CHECK_INTERVAL = 5
+
+    _tables = None
+    _version = None
+    _checked = 0
+    _lock = threading.Lock()
+
+    @classmethod
+    def _stamp(cls):
+        return IdSequence.objects.filter(name=cls.VERSION_SEQUENCE).values_list('next_value', flat=True).first()
+
+    @classmethod
+    def _load(cls):
+        tables = dict((model, dict((obj.pk, obj) for obj in model.objects.all())) for model in cls.MODELS)
+        # resolve FKs between reference tables from memory as well
+        for model in cls.MODELS:
+            fks = [field for field in model._meta.fields if field.rel and field.rel.to in tables]
+            for obj in tables[model].itervalues():
+                for field in fks:
+                    related = tables[field.rel.to].get(getattr(obj, field.attname))
+                    if related is not None:
+                        setattr(obj, field.get_cache_name(), related)
+        return tables
+
+    @classmethod
+    def tables(cls):
+        with cls._lock:
+            now = time.time()
+            if cls._tables is None or now - cls._checked > cls.CHECK_INTERVAL:
+                version = cls._stamp()
+                if cls._tables is None or version != cls._version:
+                    cls._tables, cls._version = cls._load(), version
+                cls._checked = now
+            return cls._tables
+
+    @classmethod
+    def get(cls, model, pk):
+        '''Cached instance by PK or None (not cached/not existing).'''
+
+        return cls.tables()[model].get(pk)
+
+    @classmethod
+    def all(cls, model):
+        return cls.tables()[model].values()
+
+    @classmethod
+    def invalidate(cls):
+        '''Bumps the version stamp (all processes reload) and drops the local copy.'''
+
+        IdSequence.reserve(cls.VERSION_SEQUENCE, 1)
+        cls._tables = None
+
+
+class ReferenceDataDescriptor(ReverseSingleRelatedObjectDescriptor):
+    '''FK descriptor resolving reference data instances from ReferenceData (database as fallback).'''
+
+    def __get__(self, instance, instance_type=None):
+        if instance is not None and not self.is_cached(instance):
+            value = getattr(instance, self.field.attname)
+            if value is not None:
+                related = ReferenceData.get(self.field.rel.to, value)
+                if related is not None:
+                    setattr(instance, self.cache_name, related)
+        return super(ReferenceDataDescriptor, self).__get__(instance, instance_type)
+
+
+for _model, _fk in ((Transaction, 'condition'), (Transaction, 'requester'), (Report, 'report_type'),
+                    (RcResult, 'report_type'), (RC, 'req'), (RC, 'src_req'), (Asset, 'condition')):
+    setattr(_model, _fk, ReferenceDataDescriptor(_model._meta.get_field(_fk)))
+
+
+class ConditionIndex(object):
+    '''In-memory (requester, report type) -> applicable conditions index built from ReferenceData.
+
+    Resolution (first level with matches wins; conditions ordered by id):
+      1. ReportCondition rows of the specific requester (req),
+      2. ReportCondition rows without req whose Condition.requester has the requester's legal entity,
+      3. ReportCondition rows without req whose Condition has no requester (default).
+    Rebuilt whenever ReferenceData reloads its tables.'''
+
+    _index = None
+    _tables = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def _build(cls, tables):
+        requesters = tables[Requester]
+        specific, by_entity, default = defaultdict(list), defaultdict(list), defaultdict(list)
+        for rc in tables[ReportCondition].itervalues():
+            condition = tables[Condition].get(rc.condition_id)
+            if condition is None:
+                continue
+            if rc.req_id is not None:
+                specific[(rc.req_id, rc.report_type_id)].append(condition)
+            elif condition.requester_id is not None and condition.requester_id in requesters:
+                by_entity[(requesters[condition.requester_id].legal_entity, rc.report_type_id)].append(condition)
+            else:
+                default[rc.report_type_id].append(condition)
+
+        by_id = lambda conditions: tuple(sorted(conditions, key=lambda condition: condition.id))
+        index = {}
+        for report_type_id in tables[ReportType]:
+            index[(None, report_type_id)] = by_id(default.get(report_type_id, ()))
+            for requester in requesters.itervalues():
+                index[(requester.id, report_type_id)] = by_id(specific.get((requester.id, report_type_id))
+                                                              or by_entity.get((requester.legal_entity, report_type_id))
+                                                              or default.get(report_type_id, ()))
+        return index
+
+    @classmethod
+    def index(cls):
+        tables = ReferenceData.tables()
+        with cls._lock:
+            if cls._tables is not tables:
+                cls._index, cls._tables = cls._build(tables), tables
+            return cls._index
+
+    @classmethod
+    def conditions(cls, requester, report_type):
+        '''Conditions applicable for a requester (instance, id or None) and a report type (instance or id).'''
+
+        index = cls.index()
+        report_type_id = getattr(report_type, 'pk', report_type)
+        key = (getattr(requester, 'pk', requester), report_type_id)
+        return index[key] if key in index else index.get((None, report_type_id), ())
+
+    @classmethod
+    def resolve(cls, requester, report_type, condition):
+        '''The given condition (instance or id) if applicable for requester/report type, otherwise None.'''
+
+        condition_id = getattr(condition, 'pk', condition)
+        for applicable in cls.conditions(requester, report_type):
+            if applicable.id == condition_id:
+                return applicable
+        return None
+
+    @classmethod
+    def resolve_many(cls, pulls):
+        '''Bulk resolve for (requester, report_type, condition) tuples; returns a list of Conditions/None.'''
+
+        return [cls.resolve(requester, report_type, condition) for requester, report_type, condition in pulls]
+
+
+def _reference_data_changed(sender, **kwargs):
+    if not kwargs.get('raw'):
+        ReferenceData.invalidate()
+
+for _model in ReferenceData.MODELS:
+    post_save.connect(_reference_data_changed, sender=_model, dispatch_uid='reference_data_save_%s' % _model.__name__)
+    post_delete.connect(_reference_data_changed, sender=_model, dispatch_uid='reference_data_delete_%s' % _model.__name__)
+
+
+class Transaction_Archive(BackendDB):
+    '''Stores archived transactions (see Polls.backend.Backend).
+
+    created_month (YYYYMM) is the key for range partitioning the table by the database.'''
+
+    id = models.IntegerField(primary_key=True, null=False)                                          # PK
+    t_ref_id = models.CharField(max_length=TransactionReferenceBase.PK_LENGTH, null=False)          # Transaction reference
+    account_id = models.IntegerField(null=False)                                                    # account_id
+    sub_account_id = models.IntegerField(null=True)                                                 # employee's account ID
+    role = models.IntegerField(default=None, null=True)                                             # Defined by frontend
+    t_type = models.IntegerField(default=0, null=False)                                             # Transaction type: 1xx=credits; 2xx=pulls;
+    requester_id = models.IntegerField(null=True)                                                   # Requester reference
+    condition_id = models.CharField(max_length=20, null=True)                                       # Condition reference
+    rcresult_id = models.IntegerField(null=True)                                                    # RC result reference
+    report_id = models.IntegerField(null=True)                                                      # Report reference
+    ext_t_ref = models.CharField(max_length=50, null=True)                                          # External transaction reference
+    qty = models.IntegerField(null=True)                                                            # Quantity (if relevant)
+    expires_on = models.DateTimeField(null=True)                                                    # Expiration date
+    created = models.DateTimeField(null=False)                                                      # Creation timestamp
+    asset_id = models.IntegerField(null=True)                                                       # Asset reference
+    created_month = models.IntegerField(null=False, db_index=True)                                  # Partitioning key: YYYYMM of created
+    batch = models.ForeignKey('Batch', null=False)                                                  # Maintenance batch archiving the transaction
+    class Meta:
+		app_label = 'Polls'
+
+
+class TransactionReport_Archive(BackendDB):
+    '''Stores the TransactionReport rows of archived transactions.'''
+
+    id = models.IntegerField(primary_key=True, null=False)                  # PK
+    transaction_id = models.IntegerField(null=False, db_index=True)         # Transaction_Archive reference
+    report_id = models.IntegerField(null=False)                             # Report_Archive reference
+    batch = models.ForeignKey('Batch', null=False)                          # Maintenance batch archiving the transaction
+    class Meta:
+		app_label = 'Polls'
+
+
+class Receipt_Archive(BackendDB):
+    '''Stores the receipts of archived transactions (Receipt.id = TransactionReference.id).'''
+
+    id = models.CharField(max_length=TransactionReferenceBase.PK_LENGTH, primary_key=True, null=False)   # PK
+    transaction_id = models.IntegerField(null=False, db_index=True)                                      # Transaction_Archive reference
+    price = models.DecimalField(max_digits=10, decimal_places=2, null=False)                             # Gross price (if relevant)
+    net_price = models.DecimalField(max_digits=10, decimal_places=2, null=False)                         # Net price (if relevant)
+    vat_rate = models.DecimalField(max_digits=4, decimal_places=2, null=False)                           # VAT rate (if relevant)
+    vat_value = models.DecimalField(max_digits=10, decimal_places=2, null=False)                         # VAT value (if relevant)
+    currency = models.CharField(max_length=3, default=None, null=False)                                  # Currency (if relevant)
+    created = models.DateTimeField(null=False)                                                           # Issue timestamp
+    batch = models.ForeignKey('Batch', null=False)                                                       # Maintenance batch archiving the transaction
+    class Meta:
+		app_label = 'Polls'
 
 #===========================================================================
 # class Voucher(BackendDB):
 #    '''Vouchers probably not needed for now.'''
 #    pass
-#
-# class Backend(object):
-#
-#    def transaction_b2b_rollover_all(self):
-#        pass
-#
-#    def transaction_archive_all(self):
-#        pass
-#
-#    def reports_archive_all(self):
-#        pass
 #==========================================================================
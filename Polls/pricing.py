@@ -0,0 +1,70 @@
+'''
+Bulk pricing: repricing of Conditions and issuing of Receipts (frozen prices)
+using the exact Decimal VAT calculations of Polls.util.vat.
+'''
+
+from django.db import connection
+from django.db import transaction
+
+from Polls.models import Condition, Receipt, ReferenceData
+from Polls.util.vat import VAT_RATES, vat_breakdown, vat_rate
+
+
+UPDATE_CHUNK_SIZE = 100  # conditions per UPDATE statement
+
+
+def reprice_conditions(conditions=None, prices=None, vat_rates=VAT_RATES, chunk_size=UPDATE_CHUNK_SIZE):
+    '''Recalculates price/net_price/vat_rate/vat_value of the given conditions (default: all priced ones),
+    optionally with new gross prices ({condition_id: price}), and writes them with one
+    UPDATE ... CASE statement per chunk; the ReferenceData version is bumped in the same transaction
+    (the raw UPDATE bypasses the save signals). Returns the updated conditions.'''
+
+    prices = prices or {}
+    if conditions is None:
+        conditions = Condition.objects.filter(price__isnull=False)
+    updated = []
+    for condition in conditions:
+        price = prices.get(condition.id, condition.price)
+        if price is None:
+            continue
+        condition.price, condition.net_price, condition.vat_rate, condition.vat_value = \
+            vat_breakdown(price, vat_rate(condition.country, vat_rates))
+        updated.append(condition)
+
+    qn = connection.ops.quote_name
+    pk = qn(Condition._meta.pk.column)
+    columns = ('price', 'net_price', 'vat_rate', 'vat_value')
+    with transaction.atomic():
+        cursor = connection.cursor()
+        for i in range(0, len(updated), chunk_size):
+            chunk = updated[i:i + chunk_size]
+            cases = ', '.join('%s = CASE %s %s END' % (qn(Condition._meta.get_field(column).column), pk,
+                                                        ' '.join(['WHEN %s THEN %s'] * len(chunk)))
+                              for column in columns)
+            params = [value for column in columns for condition in chunk for value in (condition.id, getattr(condition, column))]
+            cursor.execute('UPDATE %s SET %s WHERE %s IN (%s)' % (qn(Condition._meta.db_table), cases, pk,
+                                                                  ', '.join(['%s'] * len(chunk))),
+                           params + [condition.id for condition in chunk])
+        if updated:
+            ReferenceData.invalidate()
+    return updated
+
+
+def issue_receipts(transactions, vat_rates=VAT_RATES):
+    '''Freezes the purchase conditions of the given transactions into Receipts (one per transaction
+    reference, Receipt.id = TransactionReference.id) with a bulk INSERT. Transactions without a priced
+    condition or whose reference already has a receipt are skipped. Returns the new receipts.'''
+
+    transactions = [t for t in transactions if t.condition_id is not None]
+    issued = set(Receipt.objects.filter(id__in=set(t.t_ref_id for t in transactions)).values_list('id', flat=True))
+    receipts = []
+    for t in transactions:
+        condition = t.condition
+        if t.t_ref_id in issued or condition.price is None:
+            continue
+        price, net_price, rate, vat_value = vat_breakdown(condition.price, vat_rate(condition.country, vat_rates))
+        receipts.append(Receipt(id=t.t_ref_id, transaction=t, price=price, net_price=net_price, vat_rate=rate,
+                                vat_value=vat_value, currency=condition.currency))
+        issued.add(t.t_ref_id)
+    Receipt.objects.bulk_create(receipts)
+    return receipts
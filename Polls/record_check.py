@@ -0,0 +1,60 @@
+'''
+Record check audit logging.
+
+RcRecorder writes RC rows and their RcResult rows behind the request (see
+Polls.util.write_behind): pairs are queued and inserted with bulk INSERTs.
+The IDs are assigned by record() from blocks reserved in IdSequence (see
+SequenceIdBase), so callers can refer to the rows right away. The rows exist
+only once the recorder has flushed them: whatever references them (e.g.
+Transaction.rcresult) must tolerate that delay.
+'''
+
+from django.conf import settings
+from django.db import transaction
+
+from Polls.models import RC, RcResult
+from Polls.util.write_behind import WriteBehindBuffer, dump_fields, load_fields
+
+
+class RcRecorder(WriteBehindBuffer):
+
+    NAME = 'RC recorder'
+
+    def __init__(self, flush_size=WriteBehindBuffer.FLUSH_SIZE, flush_interval=None,
+                 max_pending=WriteBehindBuffer.MAX_PENDING, spool_path=None, logger=None):
+        super(RcRecorder, self).__init__(flush_size,
+                                         flush_interval or getattr(settings, 'RC_RECORDER_FLUSH_INTERVAL', self.FLUSH_INTERVAL),
+                                         max_pending, spool_path or getattr(settings, 'RC_RECORDER_SPOOL', None), logger)
+
+    def record(self, rc, results=(), timeout=None):
+        '''Assigns IDs to an unsaved RC and its unsaved RcResult rows and queues them; returns
+        immediately (or waits up to timeout seconds for free space). Raises BufferFull.'''
+
+        results = list(results)
+        if rc.pk is None:
+            rc.pk = RC.take_ids(1)[0]
+        for result, pk in zip(results, RcResult.take_ids(len(results))):
+            result.pk, result.rc = pk, rc
+        self.put((rc, results), timeout)
+
+    def _write(self, records):
+        with transaction.atomic():
+            RC.objects.bulk_create([rc for rc, _ in records])
+            results = [result for _, rc_results in records for result in rc_results]
+            if results:
+                RcResult.objects.bulk_create(results)
+
+    def _write_one(self, record):
+        self._write([record])
+
+    def _dump(self, record):
+        # IDs are spooled as well: callers may refer to them already
+        rc, results = record
+        return dict(rc=dump_fields(rc, RC._meta.fields),
+                    results=[dump_fields(result, RcResult._meta.fields) for result in results])
+
+    def _load(self, data):
+        return load_fields(RC, data['rc']), [load_fields(RcResult, result) for result in data['results']]
+
+
+rc_recorder = RcRecorder()
@@ -1,3 +1,1098 @@
-from django.test import TestCase
+import datetime
+import json
+import logging
+import os
+import shutil
+import StringIO
+import subprocess
+import tempfile
+import threading
 
-# Create your tests here.
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.cache import get_cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.db import DatabaseError
+from django.db import IntegrityError
+from django.db import transaction
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from Polls.admin import TransactionAdmin
+from Polls.backend import Backend
+from Polls.export import TRANSACTION_COLUMNS, iter_receipt_rows, iter_transaction_rows
+from Polls.logger import BufferedStreamHandler
+from Polls.middleware import DatabaseRoutingMiddleware
+from Polls.models import (Account, Batch, Condition, ConditionIndex, CreditBalance, ExpirySweep, IdSequence, Login,
+                          LoginFilter, RC, RcResult, Receipt, Receipt_Archive, ReferenceData, Report, Report_Archive,
+                          ReportCondition, ReportType, Requester, SequenceIdBase, Session, SessionAccount,
+                          SessionResolver, Token, Transaction, Transaction_Archive, TransactionReference,
+                          TransactionReferenceBase, TransactionReport, TransactionReport_Archive, ViatelBatch,
+                          ViatelBatchCache, ViatelCode, ViatelLog)
+from Polls.pricing import issue_receipts, reprice_conditions
+from Polls.record_check import RcRecorder
+from Polls.util import db_routing
+from Polls.util.bloom import BloomFilter
+from Polls.util.query_profiler import QueryProfiler, normalize_sql
+from Polls.util.vat import DEFAULT_VAT_RATE, vat_breakdown, vat_rate
+from Polls.util.vts_cache import CachedVtsLinkGenerator
+from Polls import viatel
+from Polls.util.write_behind import BufferFull, WriteBehindBuffer
+from Polls.viatel import (CODE_ALREADY_USED, CODE_INVALID_BATCH, CODE_REDEEMED, CODE_UNKNOWN, parse_notification,
+                          reconcile_day, redeem_code)
+
+
+def days_ago(days):
+    return timezone.now() - datetime.timedelta(days=days)
+
+
+class IdAllocationTest(TestCase):
+
+    def setUp(self):
+        del TransactionReferenceBase._id_block[:]   # blocks reserved by previous tests were rolled back
+
+    def test_reserve_blocks(self):
+        self.assertEqual(IdSequence.reserve('test', 10, initial=lambda: 100), 100)
+        self.assertEqual(IdSequence.reserve('test', 5, initial=lambda: 0), 110)
+        self.assertEqual(IdSequence.reserve('test', 1), 115)
+        self.assertEqual(IdSequence.reserve('other', 1), 0)
+
+    def test_reserve_ids(self):
+        ids = TransactionReference.reserve_ids(5000)
+        self.assertEqual(len(set(ids)), 5000)
+        for id in ids:
+            self.assertEqual(len(id), TransactionReferenceBase.PK_LENGTH)
+            self.assertTrue(set(id) <= set(TransactionReferenceBase.ALLOWED_PK_CHARACTERS))
+        self.assertFalse(set(ids) & set(TransactionReference.reserve_ids(10)))
+
+    def test_receipt_takes_reference_id(self):
+        t_ref = TransactionReference()
+        t_ref.save()
+        account = Account.objects.create(ext_usr_ref=1)
+        t = Transaction.objects.create(t_ref=t_ref, account=account, t_type=100, qty=1)
+        receipt = Receipt(transaction=t, price=Decimal('1.00'), net_price=Decimal('0.80'),
+                          vat_rate=Decimal('25.00'), vat_value=Decimal('0.20'), currency='SEK')
+        receipt.save()
+        self.assertEqual(receipt.id, t_ref.id)
+        self.assertEqual(Receipt.objects.get(transaction=t).id, t_ref.id)
+        self.assertEqual(IdSequence.objects.get().next_value, TransactionReference.ID_BLOCK_SIZE)    # only the reference took an id
+
+        self.assertRaises(ValueError, Receipt(price=Decimal('1.00'), net_price=Decimal('0.80'), vat_rate=Decimal('25.00'),
+                                              vat_value=Decimal('0.20'), currency='SEK').save)
+
+
+class BloomFilterTest(SimpleTestCase):
+
+    def test_membership(self):
+        bloom = BloomFilter(1000, 0.01)
+        keys = ['user%i@example.com' % i for i in range(1000)]
+        bloom.update(keys)
+        self.assertTrue(all(key in bloom for key in keys))     # no false negatives
+        false_positives = sum(1 for i in range(10000) if 'other%i@example.com' % i in bloom)
+        self.assertLess(false_positives, 300)                   # ~1% expected
+        self.assertFalse(bloom.is_full())
+        bloom.add(u'\xe5sa@example.com')
+        self.assertTrue(bloom.is_full())
+        self.assertIn(u'\xe5sa@example.com', bloom)
+
+
+class SessionResolverTest(TestCase):
+
+    def setUp(self):
+        SessionResolver.invalidate()
+        self.account = Account.objects.create(ext_usr_ref=1)
+        self.old = Session.objects.create(ext_session_ref='S1', ext_session_timestamp=days_ago(2))
+        self.session = Session.objects.create(ext_session_ref='S1', ext_session_timestamp=days_ago(1))
+        SessionAccount.objects.create(session=self.session, account=self.account)
+
+    def tearDown(self):
+        SessionResolver.invalidate()
+
+    def test_resolve(self):
+        self.assertEqual(SessionResolver.resolve('S1'), (self.session.id, self.account.id, None))
+        with self.assertNumQueries(0):
+            self.assertEqual(SessionResolver.resolve('S1'), (self.session.id, self.account.id, None))
+        anonymous = Session.objects.create(ext_session_ref='S2')
+        self.assertEqual(SessionResolver.resolve('S2'), (anonymous.id, None, None))
+        self.assertEqual(SessionResolver.resolve('UNKNOWN'), None)
+        with self.assertNumQueries(1):      # not cached
+            SessionResolver.resolve('UNKNOWN')
+
+    def test_ttl(self):
+        ttl = SessionResolver.TTL
+        SessionResolver.TTL = -1            # entries expire as soon as they are stored
+        try:
+            SessionResolver.resolve('S1')
+            with self.assertNumQueries(1):
+                SessionResolver.resolve('S1')
+        finally:
+            SessionResolver.TTL = ttl
+
+    def test_invalidated_on_change(self):
+        SessionResolver.resolve('S1')
+        sub_account = Account.objects.create(ext_usr_ref=2)
+        SessionAccount.objects.create(session=self.session, account=self.account, sub_account=sub_account)
+        self.assertEqual(SessionResolver.resolve('S1'), (self.session.id, self.account.id, sub_account.id))
+
+    def test_shared_cache(self):
+        SessionResolver.shared_cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        try:
+            SessionResolver.resolve('S1')
+            SessionResolver.invalidate()    # local cache only (another process)
+            with self.assertNumQueries(0):
+                self.assertEqual(SessionResolver.resolve('S1'), (self.session.id, self.account.id, None))
+            self.assertEqual(SessionResolver.stats()['shared_hits'] >= 1, True)
+        finally:
+            SessionResolver.shared_cache.clear()
+            SessionResolver.shared_cache = None
+
+
+class LoginFilterTest(TestCase):
+
+    def setUp(self):
+        LoginFilter.invalidate()
+        self.account = Account.objects.create(ext_usr_ref=1)
+        Login.objects.create(login='a@example.com', account=self.account)
+
+    def tearDown(self):
+        LoginFilter.invalidate()
+
+    def test_saved_login_added(self):
+        login_filter = LoginFilter.get()
+        self.assertIn('a@example.com', login_filter)
+        Login.objects.create(login='b@example.com', account=self.account)
+        self.assertIs(LoginFilter.get(), login_filter)
+        self.assertIn('b@example.com', login_filter)
+        self.assertEqual(Login.existing_logins(['a@example.com', 'b@example.com', 'c@example.com'], use_filter=True),
+                         set(['a@example.com', 'b@example.com']))
+
+    def test_delete_invalidates(self):
+        login_filter = LoginFilter.get()
+        Login.objects.get(login='a@example.com').delete()
+        self.assertIsNot(LoginFilter.get(), login_filter)
+        self.assertEqual(Login.existing_logins(['a@example.com'], use_filter=True), set())
+
+
+class TokenTest(TestCase):
+
+    def test_new_id(self):
+        ids = set(Token.new_id() for _ in range(1000))
+        self.assertEqual(len(ids), 1000)
+        self.assertTrue(all(len(id) == 32 and int(id, 16) >= 0 for id in ids))
+        token = Token()
+        token.save()
+        self.assertEqual(Token.objects.get().pk, token.pk)
+
+    def test_issue_for_reports(self):
+        report_type, account = ReportType.objects.create(id='VHR_SE'), Account.objects.create(ext_usr_ref=1)
+        reports = [Report.objects.create(account=account, report_type=report_type, report_ref='V%i' % i, query='V%i' % i)
+                   for i in range(5)]
+        existing = Token.objects.create()
+        Report.objects.filter(id=reports[0].id).update(token=existing)
+        reports[0].token = existing
+
+        chunk_size, Token.BULK_CHUNK_SIZE = Token.BULK_CHUNK_SIZE, 3
+        try:
+            tokens = Token.issue_for_reports(reports)
+        finally:
+            Token.BULK_CHUNK_SIZE = chunk_size
+        self.assertEqual(len(set(token.pk for token in tokens)), 4)
+        linked = dict(Report.objects.values_list('id', 'token'))
+        self.assertEqual(linked, dict((report.id, report.token_id) for report in reports))
+        self.assertEqual(linked[reports[0].id], existing.pk)
+        self.assertEqual(Token.objects.count(), 5)
+        self.assertEqual(Token.issue_for_reports(reports), [])
+
+
+class CachedVtsLinkGeneratorTest(SimpleTestCase):
+
+    class Generator(object):
+        calls = 0
+        host = 'vts.example.com'
+
+        def get_vts_link(self, report):
+            self.calls += 1
+            return 'vts://%s/%s' % (report.id, report.report_ref)
+
+    def report(self, id, ref='V'):
+        return Report(id=id, report_ref=ref, report_type_id='VHR_SE')
+
+    def test_hits(self):
+        generator = self.Generator()
+        cache = CachedVtsLinkGenerator(generator)
+        self.assertEqual(cache.get_vts_links([self.report(1), self.report(2), self.report(1)]),
+                         ['vts://1/V', 'vts://2/V', 'vts://1/V'])
+        self.assertEqual(generator.calls, 2)
+        self.assertEqual(cache.get_vts_link(self.report(1, 'W')), 'vts://1/W')    # other fields, other key
+        self.assertEqual(cache.stats(), dict(size=3, hits=1, misses=3, evictions=0))
+        self.assertEqual(cache.host, 'vts.example.com')
+
+    def test_ttl(self):
+        generator = self.Generator()
+        cache = CachedVtsLinkGenerator(generator, ttl=0)
+        cache.get_vts_link(self.report(1))
+        cache.get_vts_link(self.report(1))
+        self.assertEqual((generator.calls, cache.hits, cache.evictions), (2, 0, 1))
+
+    def test_lru(self):
+        generator = self.Generator()
+        cache = CachedVtsLinkGenerator(generator, maxsize=2)
+        for id in (1, 2, 1, 3):     # 2 is the least recently used
+            cache.get_vts_link(self.report(id))
+        cache.get_vts_link(self.report(1))
+        self.assertEqual(generator.calls, 3)
+        cache.get_vts_link(self.report(2))
+        self.assertEqual((generator.calls, cache.stats()['size']), (4, 2))
+
+
+class ReportArchiveTest(TestCase):
+
+    def setUp(self):
+        self.account = Account.objects.create(ext_usr_ref=1)
+        self.report_type = ReportType.objects.create(id='VHR_SE')
+        self.root = self.report('ROOT', days_ago(1))
+        self.child = self.report('CHILD', days_ago(1), parent=self.root)
+        self.live = self.report('LIVE', days_ago(-1))
+        t_ref = TransactionReference()
+        t_ref.save()
+        self.pulls = [Transaction.objects.create(t_ref=t_ref, account=self.account, t_type=200, report=report)
+                      for report in (self.root, self.child, self.live)]
+
+    def report(self, ref, expires_on, parent=None):
+        return Report.objects.create(account=self.account, report_type=self.report_type, report_ref=ref, query=ref,
+                                     expires_on=expires_on, parent=parent)
+
+    def test_archive(self):
+        batch, archived = Backend().reports_archive_all()
+        self.assertEqual(archived, 2)
+        self.assertEqual(list(Report.objects.values_list('id', flat=True)), [self.live.id])
+        archive = Report_Archive.objects.get(id=self.child.id)
+        self.assertEqual((archive.parent_id, archive.report_ref, archive.batch_id), (self.root.id, 'CHILD', batch.id))
+        self.assertEqual(sorted(TransactionReport.objects.values_list('transaction', 'report')),
+                         [(self.pulls[0].id, self.root.id), (self.pulls[1].id, self.child.id)])
+        self.assertEqual([t.report_id for t in Transaction.objects.order_by('id')], [None, None, self.live.id])
+
+    def test_already_archived(self):
+        batch = Batch.objects.create()
+        Report_Archive.objects.create(id=self.child.id, account_id=self.account.id, report_type_id='VHR_SE',
+                                      report_ref='OLD', query='OLD', created=days_ago(10), batch=batch)
+        self.assertEqual(Backend().reports_archive_all(batch)[1], 0)
+        self.assertEqual(Report.objects.count(), 3)
+        self.assertEqual(Report_Archive.objects.get(id=self.child.id).report_ref, 'OLD')
+        self.assertFalse(TransactionReport.objects.exists())
+
+
+class TransactionArchiveTest(TestCase):
+
+    def setUp(self):
+        self.report_type = ReportType.objects.create(id='VHR_SE')
+        requester = Requester.objects.create(desc='test', legal_entity='SE')
+        self.condition = Condition.objects.create(id='SE_VHR_5', requester=requester, price=100)
+        self.batch = Batch.objects.create()
+
+    def t_ref(self, account, qty):
+        t_ref = TransactionReference()
+        t_ref.save()
+        self.credit = self.transaction(t_ref, account, 100, qty=qty)
+        return t_ref
+
+    def transaction(self, t_ref, account, t_type, **kwargs):
+        return Transaction.objects.create(t_ref=t_ref, account=account, t_type=t_type, condition=self.condition,
+                                          created=days_ago(100), **kwargs)
+
+    def pull(self, t_ref, account, report=None, archived_report=False, expires_on=None):
+        if report:
+            report = Report.objects.create(account=account, report_type=self.report_type, report_ref=report,
+                                           query=report, expires_on=expires_on or days_ago(-100))
+        pull = self.transaction(t_ref, account, 200, report=report)
+        if archived_report:
+            archived = Report_Archive.objects.create(id=1000 + pull.id, account_id=account.id, report_type_id='VHR_SE',
+                                                     report_ref='A', query='A', created=days_ago(200), batch=self.batch)
+            TransactionReport.objects.create(transaction=pull, report=archived, batch=self.batch)
+        return pull
+
+    def test_archive(self):
+        account = Account.objects.create(ext_usr_ref=1)
+        t_ref = self.t_ref(account, 2)
+        expired = self.pull(t_ref, account, report='EXPIRED', expires_on=days_ago(10))
+        archived = self.pull(t_ref, account, archived_report=True)
+        Receipt.objects.create(id=t_ref.id, transaction=self.credit, price=Decimal('100.00'), net_price=Decimal('80.00'),
+                               vat_rate=Decimal('25.00'), vat_value=Decimal('20.00'), currency='SEK')
+
+        batch, stats = Backend().transaction_archive_all(created_before=days_ago(30))
+        self.assertEqual((stats['archived'], stats['archived_reports'], stats['skipped']), (3, 1, 0))
+        self.assertFalse(Transaction.objects.exists() or Report.objects.exists() or
+                         TransactionReport.objects.exists() or Receipt.objects.exists())
+        self.assertEqual(Transaction_Archive.objects.get(id=expired.id).report_id, None)
+        self.assertEqual(sorted(TransactionReport_Archive.objects.values_list('transaction_id', 'report_id', 'batch')),
+                         [(expired.id, expired.report_id, batch.id), (archived.id, 1000 + archived.id, batch.id)])
+        receipt = Receipt_Archive.objects.get()
+        self.assertEqual((receipt.id, receipt.transaction_id, receipt.price), (t_ref.id, self.credit.id, Decimal('100.00')))
+        self.assertFalse(CreditBalance.objects.exists())
+
+    def test_live_report_blocks_archiving(self):
+        account = Account.objects.create(ext_usr_ref=1)
+        t_ref = self.t_ref(account, 2)
+        self.pull(t_ref, account, report='EXPIRED', expires_on=days_ago(10))
+        self.pull(t_ref, account, report='LIVE')
+        never_expires = self.t_ref(account, 1)
+        report = self.pull(never_expires, account, report='NEVER').report
+        Report.objects.filter(id=report.id).update(expires_on=None)
+
+        stats = Backend().transaction_archive_all(created_before=days_ago(30))[1]
+        self.assertEqual((stats['archived'], stats['archived_reports'], stats['skipped']), (0, 0, 2))
+        self.assertEqual((Transaction.objects.count(), Report.objects.count()), (5, 3))
+
+    def test_dry_run(self):
+        account = Account.objects.create(ext_usr_ref=1)
+        t_ref = self.t_ref(account, 1)
+        self.pull(t_ref, account, report='EXPIRED', expires_on=days_ago(10))
+        self.assertEqual(Backend().transaction_archive_all(created_before=days_ago(30), dry_run=True)[1]['archived'], 2)
+        self.assertEqual((Transaction.objects.count(), Report.objects.count()), (2, 1))
+
+    def test_rollover(self):
+        account = Account.objects.create(org_ref='ORG')
+        t_ref = self.t_ref(account, 5)
+        consumed = self.pull(t_ref, account)
+        live = self.pull(t_ref, account, report='LIVE')
+        referenced = self.pull(t_ref, account, archived_report=True)
+        Receipt.objects.create(id=t_ref.id, transaction=self.credit, price=Decimal('100.00'), net_price=Decimal('80.00'),
+                               vat_rate=Decimal('25.00'), vat_value=Decimal('20.00'), currency='SEK')
+
+        batch, stats = Backend().transaction_b2b_rollover_all(created_before=days_ago(30))
+        self.assertEqual((stats['archived'], stats['carried_over'], stats['carried_credits']), (2, 1, 2))
+        self.assertEqual(sorted(Transaction_Archive.objects.values_list('id', flat=True)), [self.credit.id, consumed.id])
+        carry_over = Transaction.objects.get(t_type=100)
+        self.assertEqual((carry_over.t_ref_id, carry_over.qty), (t_ref.id, 4))
+        self.assertEqual(sorted(Transaction.objects.filter(t_type=200).values_list('id', flat=True)), [live.id, referenced.id])
+        self.assertTrue(Report.objects.filter(id=live.report_id).exists())
+        balance = CreditBalance.objects.get(t_ref=t_ref)
+        self.assertEqual((balance.credits, balance.pulls), (4, 2))
+        # the receipt of the rolled over credit is archived with it
+        self.assertEqual(Receipt_Archive.objects.get().transaction_id, self.credit.id)
+
+    def test_rollover_without_consumable_pulls(self):
+        account = Account.objects.create(org_ref='ORG')
+        t_ref = self.t_ref(account, 5)
+        self.pull(t_ref, account, report='LIVE')
+        stats = Backend().transaction_b2b_rollover_all(created_before=days_ago(30))[1]
+        self.assertEqual((stats['archived'], stats['carried_over'], stats['skipped']), (0, 0, 1))
+        self.assertEqual(Transaction.objects.count(), 2)
+
+
+class CreditBalanceTest(TestCase):
+
+    def setUp(self):
+        requester = Requester.objects.create(desc='test', legal_entity='SE')
+        self.condition = Condition.objects.create(id='SE_VHR_5', requester=requester, price=100)
+        self.account = Account.objects.create(ext_usr_ref=1)
+        self.t_ref = TransactionReference()
+        self.t_ref.save()
+
+    def transaction(self, t_type, **kwargs):
+        return Transaction.objects.create(t_ref=self.t_ref, account=self.account, t_type=t_type, condition=self.condition, **kwargs)
+
+    def test_credit_types(self):
+        self.transaction(100, qty=2)
+        self.transaction(199, qty=3)
+        self.transaction(200)
+        self.assertEqual(CreditBalance.remaining_credits(self.t_ref), 4)
+        self.assertEqual((Transaction.is_credit(199), Transaction.is_credit(200)), (True, False))
+
+    def test_concurrent_insert(self):
+        t = self.transaction(100, qty=2)
+        original, insert_select, calls = CreditBalance.__dict__['_insert_select'], CreditBalance._insert_select, []
+
+        def racing_insert_select(*args):
+            calls.append(args)
+            if len(calls) == 1:     # another transaction inserts the balance after our DELETE
+                CreditBalance.objects.create(t_ref=self.t_ref, credits=1)
+            return insert_select(*args)
+
+        CreditBalance._insert_select = staticmethod(racing_insert_select)
+        try:
+            CreditBalance.refresh([t.t_ref_id])
+        finally:
+            CreditBalance._insert_select = original
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(CreditBalance.remaining_credits(self.t_ref), 2)
+
+
+class ViatelRedeemTest(TestCase):
+
+    def setUp(self):
+        ViatelBatchCache.invalidate()
+        self.valid = self.batch(days_ago(1), days_ago(-1))
+        self.expired = self.batch(days_ago(10), days_ago(5))
+        ViatelCode(code='111111', batch=self.valid).save()
+        ViatelCode(code='222222', batch=self.expired).save()
+
+    def batch(self, valid_from, valid_to):
+        return ViatelBatch.objects.create(batch=Batch.objects.create(), valid_from=valid_from, valid_to=valid_to)
+
+    def test_validity(self):
+        self.assertTrue(self.valid.is_valid())
+        self.assertFalse(self.expired.is_valid())
+        self.assertTrue(self.expired.is_valid(days_ago(7)))
+        self.assertEqual(ViatelBatchCache.valid_batch_ids(), [self.valid.pk])
+
+    def test_redeem(self):
+        self.assertEqual(redeem_code('111111'), CODE_REDEEMED)
+        self.assertEqual(redeem_code('111111'), CODE_ALREADY_USED)
+        self.assertEqual(redeem_code('222222'), CODE_INVALID_BATCH)
+        self.assertEqual(redeem_code('333333'), CODE_UNKNOWN)
+
+    def test_reconcile_day(self):
+        called = days_ago(7)
+        ViatelLog.objects.create(time=called, input='222222', prn='PRN', rate=100, currency='SEK', ratetype='PPC',
+                                 duration=60, repeats=0, protected=False)
+        self.assertEqual(reconcile_day(called.date()), dict(calls=1, redeemed=1))
+        self.assertEqual(redeem_code('222222', called), CODE_ALREADY_USED)
+
+    def test_batch_chunks(self):
+        batches = [self.batch(days_ago(20), days_ago(-1)) for _ in range(3)]
+        ViatelCode(code='333333', batch=batches[-1]).save()
+        ViatelCode(code='444444', batch=batches[0]).save()
+        called = days_ago(7)
+        for code in ('333333', '444444'):
+            ViatelLog.objects.create(time=called, input=code, prn='PRN', rate=100, currency='SEK', ratetype='PPC',
+                                     duration=60, repeats=0, protected=False)
+        chunk_size, viatel.BATCH_CHUNK_SIZE = viatel.BATCH_CHUNK_SIZE, 2
+        try:
+            self.assertEqual(redeem_code('111111'), CODE_REDEEMED)
+            self.assertEqual(reconcile_day(called.date()), dict(calls=2, redeemed=2))
+        finally:
+            viatel.BATCH_CHUNK_SIZE = chunk_size
+
+
+class ViatelCodeBatchTest(TestCase):
+
+    def setUp(self):
+        self.batch = ViatelBatch.objects.create(batch=Batch.objects.create())
+        ViatelCode(code='111111', batch=self.batch).save()
+
+    def test_generate_batch(self):
+        codes, left = ViatelCode.generate_batch(self.batch, 250, chunk_size=100)
+        self.assertEqual((len(codes), len(set(codes))), (250, 250))
+        self.assertNotIn('111111', codes)
+        self.assertTrue(all(len(code) == 6 and code.isdigit() and code[0] != '0' for code in codes))
+        self.assertEqual(ViatelCode.objects.filter(batch=self.batch).count(), 251)
+        self.assertEqual(left, ViatelCode.code_space_size() - 251)
+
+    def test_codes_taken_concurrently(self):
+        draw_codes, other = ViatelCode.__dict__['_draw_codes'], ViatelBatch.objects.create(batch=Batch.objects.create())
+
+        def racing_draw_codes(cls, count, used):
+            codes = draw_codes.__func__(cls, count, used)
+            if count > 1:   # another process takes one of the drawn codes before the bulk INSERT
+                ViatelCode.objects.bulk_create([ViatelCode(code=codes[0], batch=other)])
+            return codes
+
+        ViatelCode._draw_codes = classmethod(racing_draw_codes)
+        try:
+            codes, _ = ViatelCode.generate_batch(self.batch, 10)
+        finally:
+            ViatelCode._draw_codes = draw_codes
+        self.assertEqual(len(set(codes)), 10)
+        self.assertEqual(ViatelCode.objects.filter(batch=self.batch).count(), 11)
+        self.assertEqual(ViatelCode.objects.filter(batch=other).count(), 1)
+
+    def test_dense_code_space(self):
+        ViatelCode.objects.all().delete()
+        length, ViatelCode.CODE_LENGTH = ViatelCode.CODE_LENGTH, 2     # 90 codes
+        try:
+            codes, left = ViatelCode.generate_batch(self.batch, 90)
+            self.assertEqual((len(set(codes)), left), (90, 0))
+            self.assertRaises(IntegrityError, ViatelCode.generate_batch, self.batch, 1)
+        finally:
+            ViatelCode.CODE_LENGTH = length
+
+
+class ViatelNotificationTest(TestCase):
+
+    PARAMS = dict(prn='0900123', input='111111', time='2026-01-02 10:00:00', rate='100', currency='SEK', ratetype='PPC',
+                  duration='60', repeats='0', protected='0')
+
+    def setUp(self):
+        self.queued = []
+        viatel.viatel_log_buffer.put = lambda record, timeout=None: self.queued.append(record)   # no writer thread
+
+    def tearDown(self):
+        del viatel.viatel_log_buffer.put
+
+    def test_parse(self):
+        log = parse_notification(self.PARAMS)
+        self.assertEqual((log.id, log.input, log.rate, log.duration, log.protected, log.caller),
+                         (None, '111111', Decimal('100'), 60, False, None))
+        self.assertEqual(log.time, datetime.datetime(2026, 1, 2, 10, 0))
+        self.assertRaises(ValidationError, parse_notification, dict(self.PARAMS, duration='long'))
+        params = dict(self.PARAMS)
+        del params['prn']
+        self.assertRaises(ValidationError, parse_notification, params)
+
+    def test_view(self):
+        response = self.client.get('/viatel/notify/', self.PARAMS)
+        self.assertEqual((response.status_code, response.content), (200, 'OK'))
+        self.assertEqual([log.input for log in self.queued], ['111111'])
+
+        response = self.client.post('/viatel/notify/', dict(self.PARAMS, rate='cheap'))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(self.queued), 1)
+
+    def test_view_busy(self):
+        def full(record, timeout=None):
+            raise BufferFull('full')
+        viatel.viatel_log_buffer.put = full
+        response = self.client.post('/viatel/notify/', self.PARAMS)
+        self.assertEqual((response.status_code, response.content), (503, 'BUSY'))
+
+
+class VatTest(TestCase):
+
+    def test_breakdown(self):
+        self.assertEqual(vat_breakdown(100, 25), (Decimal('100.00'), Decimal('80.00'), Decimal('25.00'), Decimal('20.00')))
+        self.assertEqual(vat_breakdown('9.99', 19), (Decimal('9.99'), Decimal('8.39'), Decimal('19.00'), Decimal('1.60')))
+        self.assertEqual(vat_breakdown(0.1, Decimal('25')), (Decimal('0.10'), Decimal('0.08'), Decimal('25.00'), Decimal('0.02')))
+
+    def test_rounding(self):
+        self.assertEqual(vat_breakdown(1.005, 0)[0], Decimal('1.01'))         # float taken by its repr, half up
+        self.assertEqual(vat_breakdown('0.125', 25)[:2], (Decimal('0.13'), Decimal('0.10')))   # price rounded first
+        self.assertEqual(vat_breakdown('0.05', 25)[1:], (Decimal('0.04'), Decimal('25.00'), Decimal('0.01')))
+
+    def test_sum(self):
+        for rate in (Decimal('25.00'), Decimal('19.00'), Decimal('7.70')):
+            for cents in range(1, 3000, 7):
+                price, net_price, _, vat_value = vat_breakdown(Decimal(cents) / 100, rate)
+                self.assertEqual(price, net_price + vat_value)
+
+    def test_rate(self):
+        self.assertEqual(vat_rate('SE'), Decimal('25.00'))
+        self.assertEqual(vat_rate('XX'), DEFAULT_VAT_RATE)
+        self.assertEqual(vat_rate('XX', {'XX': Decimal('10.00')}), Decimal('10.00'))
+
+
+class ReferenceDataTest(TestCase):
+
+    def setUp(self):
+        ReferenceData._tables = None
+        self.report_type = ReportType.objects.create(id='VHR_SE')
+        self.se, self.se_partner, self.de = [Requester.objects.create(desc=desc, legal_entity=entity)
+                                             for desc, entity in (('se', 'SE'), ('se partner', 'SE'), ('de', 'DE'))]
+        for id, requester, req in (('DEFAULT', None, None), ('SE_VHR', self.se, None), ('SE_PARTNER', None, self.se_partner)):
+            condition = Condition.objects.create(id=id, requester=requester, price=100)
+            ReportCondition.objects.create(report_type=self.report_type, condition=condition, req=req)
+
+    def ids(self, conditions):
+        return [condition.id for condition in conditions]
+
+    def test_condition_index(self):
+        self.assertEqual(self.ids(ConditionIndex.conditions(self.se_partner, self.report_type)), ['SE_PARTNER'])
+        self.assertEqual(self.ids(ConditionIndex.conditions(self.se, 'VHR_SE')), ['SE_VHR'])
+        self.assertEqual(self.ids(ConditionIndex.conditions(self.de.id, 'VHR_SE')), ['DEFAULT'])
+        self.assertEqual(self.ids(ConditionIndex.conditions(None, 'VHR_SE')), ['DEFAULT'])
+        self.assertEqual(self.ids(ConditionIndex.conditions(999, 'VHR_SE')), ['DEFAULT'])    # unknown requester
+        self.assertEqual(ConditionIndex.conditions(self.se, 'OTHER'), ())
+        self.assertEqual(ConditionIndex.resolve(self.se, 'VHR_SE', 'DEFAULT'), None)
+        self.assertEqual([condition and condition.id for condition in ConditionIndex.resolve_many(
+                              [(self.de, 'VHR_SE', 'DEFAULT'), (self.se, 'VHR_SE', 'SE_VHR'), (self.se, 'VHR_SE', 'DEFAULT')])],
+                         ['DEFAULT', 'SE_VHR', None])
+
+    def test_reload_on_change(self):
+        self.assertEqual(self.ids(ConditionIndex.conditions(self.de, 'VHR_SE')), ['DEFAULT'])
+        ReportCondition.objects.create(report_type=self.report_type,
+                                       condition=Condition.objects.create(id='DE_VHR', requester=self.de), req=None)
+        self.assertEqual(self.ids(ConditionIndex.conditions(self.de, 'VHR_SE')), ['DE_VHR'])
+
+    def test_descriptor(self):
+        account = Account.objects.create(ext_usr_ref=1)
+        t_ref = TransactionReference()
+        t_ref.save()
+        t = Transaction.objects.create(t_ref=t_ref, account=account, t_type=100, condition_id='SE_VHR', qty=1)
+        ReferenceData.tables()
+        t = Transaction.objects.get(id=t.id)
+        with self.assertNumQueries(0):
+            self.assertIs(t.condition, ReferenceData.get(Condition, 'SE_VHR'))
+            self.assertEqual(t.condition.requester.legal_entity, 'SE')
+
+        # not in the cache (written without signals): read from the database
+        Condition.objects.bulk_create([Condition(id='BULK', price=1)])
+        Transaction.objects.filter(id=t.id).update(condition='BULK')
+        t = Transaction.objects.get(id=t.id)
+        with self.assertNumQueries(1):
+            self.assertEqual(t.condition.id, 'BULK')
+
+
+class PricingTest(TestCase):
+
+    def setUp(self):
+        ReferenceData._tables = None
+        requester = Requester.objects.create(desc='test', legal_entity='SE')
+        self.condition = Condition.objects.create(id='SE_VHR_5', requester=requester, price=100, currency='SEK')
+        self.account = Account.objects.create(ext_usr_ref=1)
+
+    def credit(self):
+        t_ref = TransactionReference()
+        t_ref.save()
+        t = Transaction.objects.create(t_ref=t_ref, account=self.account, t_type=100, condition=self.condition, qty=5)
+        return Transaction.objects.get(id=t.id)     # condition from ReferenceData
+
+    def test_condition_save(self):
+        condition = Condition.objects.get(id='SE_VHR_5')
+        self.assertEqual((condition.price, condition.net_price, condition.vat_rate, condition.vat_value),
+                         (Decimal('100.00'), Decimal('80.00'), Decimal('25.00'), Decimal('20.00')))
+
+    def test_reprice(self):
+        self.assertEqual(issue_receipts([self.credit()])[0].price, Decimal('100.00'))   # caches the reference data
+        reprice_conditions(prices={'SE_VHR_5': Decimal('50')})
+        condition = Condition.objects.get(id='SE_VHR_5')
+        self.assertEqual((condition.price, condition.net_price, condition.vat_value),
+                         (Decimal('50.00'), Decimal('40.00'), Decimal('10.00')))
+        t = self.credit()
+        receipt = issue_receipts([t])[0]
+        self.assertEqual((receipt.id, receipt.price, receipt.net_price, receipt.vat_value, receipt.currency),
+                         (t.t_ref_id, Decimal('50.00'), Decimal('40.00'), Decimal('10.00'), 'SEK'))
+        self.assertEqual(issue_receipts([t]), [])
+
+
+class BufferedStreamHandlerTest(TestCase):
+
+    def handler(self, **kwargs):
+        stream = StringIO.StringIO()
+        handler = BufferedStreamHandler(stream, **kwargs)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger = logging.getLogger('test.%s' % id(handler))
+        logger.propagate = False
+        logger.addHandler(handler)
+        return stream, handler, logger
+
+    def test_write(self):
+        stream, handler, logger = self.handler(batch_size=2)
+        self.assertEqual(handler._writer, None)     # started by the first record
+        for i in range(5):
+            logger.warning('record %i', i)
+        handler.close()
+        self.assertEqual(stream.getvalue(), ''.join('record %i\n' % i for i in range(5)))
+
+    def test_fork(self):
+        stream, handler, logger = self.handler(capacity=1, overflow='block')
+        logger.warning('parent')
+        pid = os.fork()
+        if not pid:     # child: needs a writer of its own, or the full queue blocks forever
+            try:
+                for i in range(10):
+                    logger.warning('child %i', i)
+                handler.close()
+                os._exit(0 if stream.getvalue().endswith('child 9\n') else 1)
+            finally:
+                os._exit(2)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        handler.close()
+        self.assertEqual(stream.getvalue(), 'parent\n')
+
+
+class ListBuffer(WriteBehindBuffer):
+    '''Writes into a list (failing on demand).'''
+
+    def __init__(self, **kwargs):
+        super(ListBuffer, self).__init__(**kwargs)
+        self.records, self.failing = [], False
+
+    def _write(self, records):
+        if self.failing:
+            raise DatabaseError('failing')
+        if any(record.get('bad') for record in records):
+            raise ValueError('bad record')
+        self.records.extend(records)
+
+    def _write_one(self, record):
+        self._write([record])
+
+    def _dump(self, record):
+        return record
+
+    def _load(self, data):
+        return data
+
+
+class WriteBehindBufferTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.spool_path = os.path.join(self.dir, 'test.spool')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, WriteBehindBuffer)
+
+    def test_write(self):
+        buffer = ListBuffer(flush_size=2)
+        for i in range(5):
+            buffer.put({'i': i})
+        buffer.close()
+        self.assertEqual(buffer.records, [{'i': i} for i in range(5)])
+
+    def test_spool(self):
+        buffer = ListBuffer(spool_path=self.spool_path)
+        buffer.failing = True
+        buffer._flush([{'i': 1}, {'i': 2}])
+        self.assertEqual((buffer.written, buffer.spooled), (0, 2))
+
+        other = ListBuffer(spool_path=self.spool_path)
+        self.assertEqual(other.replay_spool(), 2)
+        self.assertEqual(other.records, [{'i': 1}, {'i': 2}])
+        self.assertEqual(other.replay_spool(), 0)
+        self.assertEqual(os.listdir(self.dir), ['test.spool.lock'])
+
+    def test_spool_directory_created(self):
+        buffer = ListBuffer(spool_path=os.path.join(self.dir, 'var', 'spool', 'test.spool'))
+        buffer.failing = True
+        buffer._flush([{'i': 1}])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dir, 'var', 'spool'))), ['test.spool', 'test.spool.lock'])
+
+    def test_replay_orphans(self):
+        child = subprocess.Popen(['true'])
+        child.wait()
+        for pid, i in ((child.pid, 1), (os.getppid(), 2)):
+            with open('%s.replay.%i' % (self.spool_path, pid), 'w') as replay:
+                replay.write(json.dumps({'i': i}) + '\n')
+        with open(self.spool_path, 'w') as spool:
+            spool.write(json.dumps({'i': 3}) + '\n')
+
+        buffer = ListBuffer(spool_path=self.spool_path)
+        self.assertEqual(buffer.replay_spool(), 2)
+        self.assertEqual(buffer.records, [{'i': 1}, {'i': 3}])
+        # the replay file of a live process is left alone
+        self.assertEqual(sorted(os.listdir(self.dir)), ['test.spool.lock', 'test.spool.replay.%i' % os.getppid()])
+
+    def test_bad_record(self):
+        buffer = ListBuffer(flush_size=2, spool_path=self.spool_path)
+        buffer.put({'i': 1, 'bad': True})
+        buffer.put({'i': 2})
+        buffer.put({'i': 3})
+        buffer.close()
+        self.assertEqual(buffer.records, [{'i': 2}, {'i': 3}])
+        self.assertEqual((buffer.written, buffer.spooled), (2, 1))
+        with open(self.spool_path) as spool:
+            self.assertEqual([json.loads(line) for line in spool], [{'i': 1, 'bad': True}])
+
+    def test_writer_survives_errors(self):
+        buffer = ListBuffer(flush_size=1)
+        buffer._flush = lambda records: 1 / 0 if records[0].get('bad') else buffer.records.extend(records)
+        buffer.put({'i': 1, 'bad': True})
+        buffer.put({'i': 2})
+        buffer.close()
+        self.assertEqual(buffer.records, [{'i': 2}])
+
+    def test_replay_in_writer_thread(self):
+        buffer, replayed = ListBuffer(spool_path=self.spool_path), []
+        buffer.replay_spool = lambda: replayed.append(threading.current_thread().name)
+        buffer.put({'i': 1})
+        buffer.close()
+        self.assertEqual((replayed, buffer.records), (['ListBuffer'], [{'i': 1}]))
+
+
+class ExpiryTest(TestCase):
+
+    def setUp(self):
+        self.report_type = ReportType.objects.create(id='VHR_SE', expiration_days=30)
+        requester = Requester.objects.create(desc='test', legal_entity='SE')
+        self.condition = Condition.objects.create(id='SE_VHR_5', requester=requester, price=100, expiration_days=365)
+        self.account = Account.objects.create(ext_usr_ref=1)
+
+    def report(self, ref, created):
+        return Report.objects.create(account=self.account, report_type=self.report_type, report_ref=ref, query=ref,
+                                     created=created)
+
+    def credit(self, created):
+        t_ref = TransactionReference()
+        t_ref.save()
+        return Transaction.objects.create(t_ref=t_ref, account=self.account, t_type=100, condition=self.condition,
+                                          qty=5, created=created)
+
+    def test_backfill(self):
+        old, new = self.report('OLD', days_ago(40)), self.report('NEW', days_ago(10))
+        credit = self.credit(days_ago(400))
+        self.assertEqual(Backend().expiry_backfill(chunk_size=1), dict(reports=2, credits=1))
+        self.assertEqual(Report.objects.get(id=old.id).expires_on, old.created + datetime.timedelta(days=30))
+        self.assertEqual(Report.objects.get(id=new.id).expires_on, new.created + datetime.timedelta(days=30))
+        self.assertEqual(Transaction.objects.get(id=credit.id).expires_on, credit.created + datetime.timedelta(days=365))
+        self.assertEqual(Backend().expiry_backfill(), dict(reports=0, credits=0))
+
+    def test_sweep(self):
+        reports = [self.report('OLD%i' % i, days_ago(40 + i)) for i in range(3)] + [self.report('NEW', days_ago(10))]
+        credits = [self.credit(days_ago(400 + i)) for i in range(3)] + [self.credit(days_ago(10))]
+        Backend().expiry_backfill()
+
+        batch, stats = Backend().expiry_sweep(chunk_size=2, max_chunks=10)
+        self.assertEqual(stats, dict(reports=3, archived_reports=3, credits=3, expired_balances=3))
+        self.assertEqual(list(Report.objects.values_list('id', flat=True)), [reports[-1].id])
+        self.assertEqual(sorted(Report_Archive.objects.values_list('id', flat=True)), [r.id for r in reports[:3]])
+        self.assertEqual(sorted(CreditBalance.objects.filter(expired=True).values_list('t_ref', flat=True)),
+                         sorted(c.t_ref_id for c in credits[:3]))
+        state = ExpirySweep.objects.get(name='credits')
+        self.assertEqual((state.expires_on, state.last_id), (credits[0].created + datetime.timedelta(days=365), credits[0].id))
+
+        self.assertEqual(Backend().expiry_sweep(chunk_size=2, max_chunks=10),
+                         (None, dict(reports=0, archived_reports=0, credits=0, expired_balances=0)))
+
+    def test_backfill_behind_mark(self):
+        self.report('NEW', days_ago(35))
+        self.report('LIVE', days_ago(1))    # keeps SQLite from reusing the archived report's id
+        Backend().expiry_backfill()
+        self.assertEqual(Backend().expiry_sweep()[1]['reports'], 1)
+        old = self.report('OLD', days_ago(50))
+        Backend().expiry_backfill()
+        batch, stats = Backend().expiry_sweep()
+        self.assertEqual(stats['reports'], 1)
+        self.assertEqual(Report_Archive.objects.get(id=old.id).batch_id, batch.id)
+
+
+class ExportTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.account = Account.objects.create(ext_usr_ref=1)
+        self.transactions = [self.credit() for _ in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def credit(self, created=None, **kwargs):
+        t_ref = TransactionReference()
+        t_ref.save()
+        return Transaction.objects.create(t_ref=t_ref, account=self.account, t_type=100, qty=1,
+                                          created=created or days_ago(5), **kwargs)
+
+    def receipt(self, t, created):
+        return Receipt.objects.create(id=t.t_ref_id, transaction=t, price=Decimal('1.00'), net_price=Decimal('0.80'),
+                                      vat_rate=Decimal('25.00'), vat_value=Decimal('0.20'), currency='SEK', created=created)
+
+    def receipts(self, rows):
+        column = [name for name, _ in TRANSACTION_COLUMNS].index('receipt')
+        return [(row[0], row[column]) for row in rows]
+
+    def test_rows(self):
+        t1, t2, t3 = self.transactions
+        r1, r2 = self.receipt(t1, days_ago(3)), self.receipt(t2, days_ago(1))
+        self.assertEqual(self.receipts(iter_transaction_rows(chunk_size=2)), [(t1.id, r1.id), (t2.id, r2.id), (t3.id, None)])
+        self.assertEqual(self.receipts(iter_transaction_rows(until=days_ago(6))), [])
+        self.assertEqual(self.receipts(iter_transaction_rows(until=days_ago(2))),
+                         [(t1.id, r1.id), (t2.id, None), (t3.id, None)])
+        self.assertEqual(self.receipts(iter_receipt_rows(t3.id, days_ago(2), days_ago(0), chunk_size=1)), [(t2.id, r2.id)])
+        self.assertEqual(self.receipts(iter_receipt_rows(t3.id, days_ago(4), days_ago(0), chunk_size=1)),
+                         [(t1.id, r1.id), (t2.id, r2.id)])
+        self.assertEqual(self.receipts(iter_receipt_rows(t1.id, days_ago(4), days_ago(0))), [(t1.id, r1.id)])
+
+    def export(self):
+        output, state = os.path.join(self.dir, 'export.ndjson'), os.path.join(self.dir, 'state.json')
+        call_command('transactions_export', format='ndjson', output=output, state=state, stderr=StringIO.StringIO())
+        with open(output) as f, open(state) as g:
+            return [(row['id'], row['receipt']) for row in map(json.loads, f)], json.load(g)
+
+    def test_incremental(self):
+        t1, t2, t3 = self.transactions
+        r1 = self.receipt(t1, days_ago(1))
+        rows, state = self.export()
+        self.assertEqual(rows, [(t1.id, r1.id), (t2.id, None), (t3.id, None)])
+        self.assertEqual(state['last_id'], t3.id)
+
+        # a receipt issued after its transaction was exported, and a new transaction
+        r2 = self.receipt(t2, parse_datetime(state['until']) + datetime.timedelta(microseconds=1))
+        t4 = self.credit()
+        rows, state = self.export()
+        self.assertEqual(rows, [(t2.id, r2.id), (t4.id, None)])
+        self.assertEqual((state['last_id'], state['exported_rows']), (t4.id, 2))
+        self.assertEqual(self.export()[0], [])
+
+    def test_late_commit(self):
+        t1, t2, t3 = self.transactions
+        self.export()
+        # t5 is committed while t4 (lower id, created just before) is still open: only t5 is visible
+        t4_id = t3.id + 1
+        t5 = self.credit(created=timezone.now() - datetime.timedelta(seconds=10), id=t3.id + 2)
+        rows, state = self.export()
+        self.assertEqual((rows, state['last_id']), ([], t3.id))
+
+        t4 = self.credit(created=timezone.now() - datetime.timedelta(seconds=20), id=t4_id)
+        Transaction.objects.filter(id__in=[t4.id, t5.id]).update(created=days_ago(0.5))    # settled
+        rows, state = self.export()
+        self.assertEqual((rows, state['last_id']), ([(t4.id, None), (t5.id, None)], t5.id))
+
+
+class RcRecorderTest(TestCase):
+
+    def setUp(self):
+        SequenceIdBase._id_blocks.clear()   # blocks reserved by previous tests were rolled back
+        self.requester = Requester.objects.create(desc='test', legal_entity='SE')
+        self.report_type = ReportType.objects.create(id='VHR_SE')
+        RC.objects.bulk_create([RC(id=1, req=self.requester, query='legacy')])    # written before the sequence existed
+
+    def record(self, recorder, query, *refs):
+        rc, results = RC(req=self.requester, query=query), [RcResult(report_type=self.report_type, report_ref=ref) for ref in refs]
+        recorder.record(rc, results)
+        return rc, results
+
+    def test_ids_assigned_on_record(self):
+        recorder = RcRecorder()
+        recorder.put = lambda record, timeout: None
+        rc, results = self.record(recorder, 'a', 'V1', 'V2')
+        self.assertEqual((rc.id, [(result.id, result.rc_id) for result in results]), (2, [(1, 2), (2, 2)]))
+        self.assertEqual(IdSequence.objects.get(name=RC._meta.db_table).next_value, 2 + RC.ID_BLOCK_SIZE)
+
+    def test_write(self):
+        recorder, written = RcRecorder(), []
+        recorder.put = lambda record, timeout: written.append(record)
+        self.record(recorder, 'a', 'V1', 'V2')
+        self.record(recorder, 'b')
+        self.record(recorder, 'c', 'V3')
+        recorder._write(written[:2])
+        recorder._write(written[2:])
+        self.assertEqual(list(RC.objects.order_by('id').values_list('id', 'query')), [(1, 'legacy'), (2, 'a'), (3, 'b'), (4, 'c')])
+        self.assertEqual(list(RcResult.objects.order_by('id').values_list('id', 'rc', 'report_ref')),
+                         [(1, 2, 'V1'), (2, 2, 'V2'), (3, 4, 'V3')])
+
+        SequenceIdBase._id_blocks.clear()   # another process: takes the next block
+        self.assertEqual(RC.objects.create(req=self.requester, query='d').id, 2 + RC.ID_BLOCK_SIZE)
+
+    def test_save_uses_sequence(self):
+        self.assertEqual(RC.objects.create(req=self.requester, query='a').id, 2)
+        recorder = RcRecorder()
+        recorder.put = lambda record, timeout: None
+        self.assertEqual(self.record(recorder, 'b')[0].id, 3)
+
+    def test_spool_format(self):
+        recorder = RcRecorder()
+        recorder.put = lambda record, timeout: None
+        rc, results = recorder._load(json.loads(json.dumps(recorder._dump(self.record(recorder, 'a', 'V1')))))
+        self.assertEqual((rc.id, rc.req_id, rc.query), (2, self.requester.id, 'a'))
+        self.assertEqual([(result.id, result.rc_id, result.report_type_id, result.report_ref) for result in results],
+                         [(1, 2, 'VHR_SE', 'V1')])
+
+
+@override_settings(DATABASE_REPLICAS={'default': ['replica']})
+class DatabaseRouterTest(SimpleTestCase):
+    # not a TestCase: its transaction would keep every read on the primary
+
+    def setUp(self):
+        db_routing.reset()
+        self.router = db_routing.DatabaseRouter()
+
+    def tearDown(self):
+        db_routing.reset()
+
+    def test_replica_reads(self):
+        self.assertEqual(self.router.db_for_read(Transaction), 'default')
+        with db_routing.replica_reads():
+            self.assertEqual(self.router.db_for_read(Transaction), 'replica')
+        read = db_routing.replica_reads()(lambda: self.router.db_for_read(Transaction))
+        self.assertEqual(read(), 'replica')
+
+    def test_read_after_write(self):
+        with db_routing.replica_reads():
+            self.assertEqual(self.router.db_for_write(Transaction), 'default')
+            self.assertEqual(self.router.db_for_read(Transaction), 'default')
+            db_routing.reset()
+            self.assertEqual(self.router.db_for_read(Transaction), 'replica')
+
+    def test_atomic_reads_primary(self):
+        with db_routing.replica_reads():
+            with transaction.atomic():
+                self.assertEqual(self.router.db_for_read(Transaction), 'default')
+            self.assertEqual(self.router.db_for_read(Transaction), 'replica')
+
+    def test_allow_syncdb(self):
+        self.assertTrue(self.router.allow_syncdb('default', Transaction))
+        self.assertFalse(self.router.allow_syncdb('replica', Transaction))
+
+    def test_middleware(self):
+        middleware, request = DatabaseRoutingMiddleware(), RequestFactory().get('/')
+        db_routing.pin_primary('default')
+        middleware.process_request(request)
+        with db_routing.replica_reads():
+            self.assertEqual(self.router.db_for_read(Transaction), 'replica')
+            self.router.db_for_write(Transaction)   # the view writes
+            response = HttpResponse()
+            self.assertIs(middleware.process_response(request, response), response)
+            self.assertEqual(self.router.db_for_read(Transaction), 'replica')
+
+
+class QueryProfilerTest(TestCase):
+
+    def test_nested(self):
+        with QueryProfiler('outer') as outer:
+            Account.objects.count()
+            with QueryProfiler('inner', threshold=2) as inner:
+                for i in range(3):
+                    Account.objects.filter(ext_usr_ref=i).exists()
+            Account.objects.count()
+        self.assertEqual((outer.count, inner.count), (5, 3))
+        self.assertEqual([count for _, count in inner.n_plus_one], [3])
+        self.assertEqual(outer.n_plus_one, [])
+        self.assertNotIn('make_debug_cursor', connection.__dict__)     # wrapper removed
+
+    @override_settings(DEBUG=False)
+    def test_queries_not_kept(self):
+        queries = len(connection.queries)
+        with QueryProfiler('job') as profiler:
+            for i in range(20):
+                Account.objects.filter(ext_usr_ref=i).exists()
+        self.assertEqual((profiler.count, len(connection.queries)), (20, queries))
+
+    @override_settings(DEBUG=True)
+    def test_queries_kept_with_debug(self):
+        queries = len(connection.queries)
+        with QueryProfiler('request') as profiler:
+            Account.objects.count()
+        self.assertEqual((profiler.count, len(connection.queries)), (1, queries + 1))
+
+    def test_normalize(self):
+        self.assertEqual(normalize_sql('SELECT a FROM t WHERE id IN (%s, %s) AND x = \'y\' LIMIT 21'),
+                         'SELECT a FROM t WHERE id IN (...) AND x = ? LIMIT ?')
+
+
+class KeysetChangeListTest(TestCase):
+    URL = '/admin/Polls/transaction/'
+
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        self.account, other = Account.objects.create(ext_usr_ref=1), Account.objects.create(ext_usr_ref=2)
+        t_ref = TransactionReference.objects.create()
+        self.ids = [Transaction.objects.create(t_ref=t_ref, account=account, t_type=100, qty=1).id
+                    for account in [self.account, other] * 3]
+        self.per_page = TransactionAdmin.list_per_page
+        TransactionAdmin.list_per_page = 2
+
+    def tearDown(self):
+        TransactionAdmin.list_per_page = self.per_page
+
+    def changelist(self, **params):
+        response = self.client.get(self.URL, params)
+        self.assertEqual(response.status_code, 200)
+        return response.context['cl']
+
+    def test_paging(self):
+        cl = self.changelist()
+        self.assertEqual([t.id for t in cl.result_list], self.ids[:-3:-1])
+        self.assertEqual((cl.newer_url, cl.result_count, cl.full_result_count), (None, 6, 6))
+        cl = self.changelist(before=self.ids[2])
+        self.assertEqual([t.id for t in cl.result_list], self.ids[1::-1])
+        self.assertEqual(cl.older_url, None)
+        cl = self.changelist(after=self.ids[1])
+        self.assertEqual([t.id for t in cl.result_list], self.ids[3:1:-1])
+        self.assertTrue(cl.newer_url and cl.older_url)
+
+    def test_search(self):
+        cl = self.changelist(q=str(self.account.id))
+        self.assertEqual([t.id for t in cl.result_list], self.ids[4::-2][:2])
+        self.assertEqual((cl.result_count, cl.full_result_count), (3, 6))
+        self.assertEqual(self.changelist(q='not a number').result_count, 0)
@@ -0,0 +1,45 @@
+'''
+Simple Bloom filter: probabilistic set membership without false negatives
+and with a configurable false positive rate.
+'''
+
+import hashlib
+import math
+import struct
+
+
+class BloomFilter(object):
+    '''Bit array of num_bits bits and num_hashes positions per key (double hashing).'''
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(int(capacity), 1)
+        self.num_bits = int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(int(round(float(self.num_bits) / self.capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.sha1(key).digest()[:16])
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def is_full(self):
+        '''True once more keys were added than planned (error rate degrades).'''
+        return self.count > self.capacity
+
+    def __contains__(self, key):
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
@@ -0,0 +1,102 @@
+'''
+Database routing: the Drupal-backed Books models use their own connection, all
+other models the primary ('default'). Both may have read replicas:
+
+    DATABASES = {'default': {...}, 'drupal': {...}, 'replica': {...}}
+    DATABASE_REPLICAS = {'default': ['replica']}
+    DATABASE_ROUTERS = ['Polls.util.db_routing.DatabaseRouter']
+
+Reads only go to a replica inside a replica_reads() block (read-heavy paths such
+as FrontendUser.packages()/payments()), and never after a write to the same
+primary in the current request (read-your-writes; reset by
+Polls.middleware.DatabaseRoutingMiddleware) or inside a transaction on the
+primary. Everything else (maintenance jobs, raw SQL) reads the primary.
+
+Local stand-ins: any alias may point at an SQLite file; a replica alias pointing
+at the primary's file (TEST_MIRROR) behaves like a replica without lag.
+'''
+
+import random
+import threading
+
+from django.conf import settings
+from django.db import connections
+
+
+DRUPAL_DATABASE = 'drupal'
+DRUPAL_APPS = ('Books',)
+
+_state = threading.local()
+
+
+def _pinned():
+    if not hasattr(_state, 'pinned'):
+        _state.pinned = set()
+    return _state.pinned
+
+
+def pin_primary(alias):
+    '''Sends the following reads of the current request/thread to the given primary.'''
+
+    _pinned().add(alias)
+
+
+def reset():
+    '''Forgets the writes of the previous request (see DatabaseRoutingMiddleware).'''
+
+    _pinned().clear()
+
+
+class replica_reads(object):
+    '''Context manager/decorator: reads in the block may use a replica.'''
+
+    def __enter__(self):
+        _state.replica_reads = getattr(_state, 'replica_reads', 0) + 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _state.replica_reads -= 1
+
+    def __call__(self, func):
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        wrapper.__name__, wrapper.__doc__ = func.__name__, func.__doc__
+        return wrapper
+
+
+def primary_for(model):
+    if model._meta.app_label in DRUPAL_APPS and DRUPAL_DATABASE in settings.DATABASES:
+        return DRUPAL_DATABASE
+    return 'default'
+
+
+class DatabaseRouter(object):
+
+    def db_for_read(self, model, **hints):
+        primary = primary_for(model)
+        replicas = getattr(settings, 'DATABASE_REPLICAS', {}).get(primary)
+        if replicas and getattr(_state, 'replica_reads', 0) and primary not in _pinned() \
+                and not connections[primary].in_atomic_block:
+            return random.choice(replicas)
+        return primary
+
+    def db_for_write(self, model, **hints):
+        primary = primary_for(model)
+        pin_primary(primary)
+        return primary
+
+    def _group(self, db):
+        for primary, replicas in getattr(settings, 'DATABASE_REPLICAS', {}).items():
+            if db in replicas:
+                return primary
+        return db
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._state.db is None or obj2._state.db is None:
+            return None
+        return self._group(obj1._state.db) == self._group(obj2._state.db)
+
+    def allow_syncdb(self, db, model):
+        # tables are created on the primaries only
+        return db == primary_for(model)
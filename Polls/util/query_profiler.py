@@ -0,0 +1,125 @@
+'''
+ORM query profiling: query count, DB time and repeated query shapes (N+1 detection)
+per request (see Polls.middleware.QueryProfilerMiddleware) or per maintenance job:
+
+    with QueryProfiler('reports_archive'):
+        ...
+
+Statements are timed by a cursor wrapper feeding the counters of every active
+profiler of the connection, so profilers can be nested and connection.queries
+does not grow during long jobs (it is only filled as usual if DEBUG is on).
+'''
+
+import re
+import time
+
+from collections import Counter
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends import util
+
+from Polls.logger import Logger
+
+
+N_PLUS_ONE_THRESHOLD = 10   # same query shape executed more often => N+1 suspect
+
+_NORMALIZERS = (
+    (re.compile(r'%s'), '?'),                              # parameters
+    (re.compile(r"'(?:[^']|'')*'"), '?'),                  # string literals
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),               # numbers
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),  # IN lists
+    (re.compile(r'\s+'), ' '),
+)
+
+
+def normalize_sql(sql):
+    '''Query shape: literals replaced by placeholders.'''
+
+    for pattern, replacement in _NORMALIZERS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+class _ProfilingCursor(util.CursorWrapper):
+    '''Times the statements of a cursor for the active profilers of its connection.'''
+
+    def _record(self, sql, started):
+        duration = time.time() - started
+        for profiler in getattr(self.db, '_query_profilers', ()):
+            profiler._record(sql, duration)
+
+    def execute(self, sql, params=None):
+        started = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self._record(sql, started)
+
+    def executemany(self, sql, param_list):
+        started = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self._record(sql, started)
+
+
+def _profiling_cursor_factory(connection, use_debug_cursor):
+    def make_debug_cursor(cursor):
+        if use_debug_cursor or (use_debug_cursor is None and settings.DEBUG):
+            cursor = type(connection).make_debug_cursor(connection, cursor)     # connection.queries as usual
+        else:
+            cursor = util.CursorWrapper(cursor, connection)
+        return _ProfilingCursor(cursor, connection)
+    return make_debug_cursor
+
+
+class QueryProfiler(object):
+    '''Context manager counting the queries of all database connections executed in its block
+    (count, DB time, query shapes) and logging a compact summary through Polls.logger.Logger.'''
+
+    def __init__(self, label, threshold=None, logger=None):
+        self.label = label
+        self.threshold = threshold or getattr(settings, 'QUERY_PROFILER_N_PLUS_ONE', N_PLUS_ONE_THRESHOLD)
+        self.logger = logger or Logger()
+        self.count = 0
+        self.db_time = 0.0
+        self.shapes = Counter()
+        self.n_plus_one = []
+
+    def _record(self, sql, duration):
+        self.count += 1
+        self.db_time += duration
+        self.shapes[normalize_sql(sql)] += 1
+
+    def __enter__(self):
+        self._started = time.time()
+        self._connections = connections.all()
+        for connection in self._connections:
+            profilers = connection.__dict__.setdefault('_query_profilers', [])
+            if not profilers:
+                # the first profiler of the connection installs the wrapper (through the debug cursor hook)
+                connection._profiled_debug_cursor = connection.use_debug_cursor
+                connection.make_debug_cursor = _profiling_cursor_factory(connection, connection.use_debug_cursor)
+                connection.use_debug_cursor = True
+            profilers.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for connection in self._connections:
+            connection._query_profilers.remove(self)
+            if not connection._query_profilers:
+                # the last one removes it
+                del connection.make_debug_cursor
+                connection.use_debug_cursor = connection._profiled_debug_cursor
+
+        self.n_plus_one = [(shape, count) for shape, count in self.shapes.most_common() if count > self.threshold]
+        fields = dict(queries=self.count, db_ms=round(self.db_time * 1000, 1),
+                      total_ms=round((time.time() - self._started) * 1000, 1), shapes=len(self.shapes))
+        if self.n_plus_one:
+            shape, count = self.n_plus_one[0]
+            self.logger.warning('Queries %s: possible N+1 (%i shape(s) repeated > %i times; top %ix: %s)' % (
+                self.label, len(self.n_plus_one), self.threshold, count, shape[:200]), **fields)
+        else:
+            self.logger.info('Queries %s' % self.label, **fields)
+        return False
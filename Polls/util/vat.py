@@ -0,0 +1,39 @@
+'''
+VAT calculations with exact Decimal arithmetic.
+'''
+
+from decimal import Decimal, ROUND_HALF_UP
+
+
+CENT = Decimal('0.01')
+
+# VAT rates (%) per country (ISO code)
+VAT_RATES = {
+    'SE': Decimal('25.00'),
+    'DE': Decimal('19.00'),
+}
+DEFAULT_VAT_RATE = Decimal('19.00')
+
+
+def to_decimal(value):
+    '''Exact Decimal of a price given as Decimal, int, float or string (floats via their repr).'''
+
+    if isinstance(value, Decimal):
+        return value
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    return Decimal(value)
+
+
+def vat_rate(country, vat_rates=VAT_RATES):
+    return vat_rates.get(country, DEFAULT_VAT_RATE)
+
+
+def vat_breakdown(price, rate):
+    '''Splits a gross price into (price, net_price, vat_rate, vat_value), all rounded to cents
+    (half up); price == net_price + vat_value always holds.'''
+
+    price = to_decimal(price).quantize(CENT, ROUND_HALF_UP)
+    rate = to_decimal(rate).quantize(CENT, ROUND_HALF_UP)
+    net_price = (price * 100 / (100 + rate)).quantize(CENT, ROUND_HALF_UP)
+    return price, net_price, rate, price - net_price
@@ -0,0 +1,69 @@
+'''
+Memoising (LRU + TTL) layer in front of VtsLinkGenerator.get_vts_link.
+
+VTS links only depend on fields of a report that never change, so they can be
+cached for Report as well as for Report_Archive instances.
+'''
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class CachedVtsLinkGenerator(object):
+    '''Wraps a VtsLinkGenerator; keeps up to maxsize links for ttl seconds (least recently used are evicted first).'''
+
+    MAXSIZE = 10000
+    TTL = 3600
+
+    def __init__(self, generator, maxsize=MAXSIZE, ttl=TTL):
+        self.generator = generator
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._links = OrderedDict()  # key -> (expires, link); most recently used last
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def key(report):
+        return (report.id, report.report_ref, report.report_type_id, report.token_id)
+
+    def get_vts_link(self, report):
+        key = self.key(report)
+        now = time.time()
+        with self._lock:
+            entry = self._links.pop(key, None)
+            if entry is not None:
+                if entry[0] > now:
+                    self._links[key] = entry
+                    self.hits += 1
+                    return entry[1]
+                self.evictions += 1
+            self.misses += 1
+
+        link = self.generator.get_vts_link(report)
+
+        with self._lock:
+            self._links.pop(key, None)
+            self._links[key] = (now + self.ttl, link)
+            while len(self._links) > self.maxsize:
+                self._links.popitem(last=False)
+                self.evictions += 1
+        return link
+
+    def get_vts_links(self, reports):
+        '''Returns the links of all reports (in the same order).'''
+
+        return [self.get_vts_link(report) for report in reports]
+
+    def clear(self):
+        with self._lock:
+            self._links.clear()
+
+    def stats(self):
+        return dict(size=len(self._links), hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+    def __getattr__(self, attr):
+        # everything else is served by the wrapped generator
+        return getattr(self.generator, attr)
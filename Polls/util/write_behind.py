@@ -0,0 +1,277 @@
+'''
+Write-behind buffering for append-only records (logs, audit rows).
+
+Records are queued in memory and written by a background thread with bulk
+INSERTs once flush_size records are pending or flush_interval seconds have
+passed. The bounded queue provides backpressure (BufferFull); records which
+cannot be written are appended to a spool file (one JSON object per line)
+and replayed by the writer thread on the next start; replay files left by a
+process which died while replaying are picked up as well. Processes sharing
+a spool file serialise their access with a lock file (<spool>.lock). Every
+process (e.g. forked workers) starts its own writer thread on its first
+record.
+
+A record is acknowledged once it is queued: close() (registered with
+atexit) flushes the queue on a normal exit, but records still in memory are
+lost if the process is killed (SIGKILL, OOM killer). Records which must not
+be lost have to be written synchronously.
+
+Subclasses implement _write (bulk), _write_one (fallback) and the spool
+serialisation (_dump/_load).
+'''
+
+import abc
+import atexit
+import errno
+import fcntl
+import glob
+import json
+import os
+import Queue
+import shutil
+import threading
+import time
+
+from contextlib import contextmanager
+
+from django.db import connection
+from django.db import DatabaseError
+
+from Polls.logger import Logger
+
+
+class BufferFull(Exception):
+    '''Raised when the ingestion queue is full (caller should retry later).'''
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class WriteBehindBuffer(object):
+
+    __metaclass__ = abc.ABCMeta
+
+    NAME = 'Write-behind buffer'
+    FLUSH_SIZE = 500        # records per bulk INSERT
+    FLUSH_INTERVAL = 1.0    # max. seconds a record waits in the buffer
+    MAX_PENDING = 20000     # queue size (backpressure)
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING,
+                 spool_path=None, logger=None):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+        self.logger = logger or Logger()
+        self.written = self.spooled = 0
+        self._max_pending = max_pending
+        self._queue = Queue.Queue(max_pending)
+        self._stopping = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def start(self):
+        '''Starts the writer thread of this process (which replays the spool file first).'''
+
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                if self._pid is not None and self._pid != os.getpid():
+                    # forked: the parent's thread does not exist here, its queued records are the parent's
+                    self._queue = Queue.Queue(self._max_pending)
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name=type(self).__name__)
+                self._thread.daemon = True
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def put(self, record, timeout=None):
+        '''Queues a record; returns immediately (or waits up to timeout seconds for free space).
+        Raises BufferFull.'''
+
+        if self._stopping.is_set():
+            raise BufferFull('%s is shutting down' % self.NAME)
+        self.start()
+        try:
+            self._queue.put(record, timeout is not None, timeout)
+        except Queue.Full:
+            raise BufferFull('%s is full (%i records pending)' % (self.NAME, self._queue.qsize()))
+
+    def close(self):
+        '''Flushes all pending records and stops the writer thread.'''
+
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and self._pid == os.getpid():
+            self._stopping.set()
+            thread.join()
+
+    def _drain(self, limit=None):
+        records = []
+        while limit is None or len(records) < limit:
+            try:
+                records.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        return records
+
+    def _run(self):
+        try:
+            self.replay_spool()
+        except Exception, e:
+            self.logger.error('%s: replaying the spool file failed (%s)' % (self.NAME, e))
+        pending, last_flush = [], time.time()
+        while True:
+            stopping = self._stopping.is_set()
+            try:
+                pending.append(self._queue.get(True, self.POLL_INTERVAL))
+            except Queue.Empty:
+                pass
+            pending.extend(self._drain(self.flush_size - len(pending)))
+            if pending and (stopping or len(pending) >= self.flush_size or time.time() - last_flush >= self.flush_interval):
+                try:
+                    self._flush(pending)
+                except Exception, e:
+                    # never let a bad batch kill the writer thread
+                    self.logger.error('%s: %i record(s) lost (%s)' % (self.NAME, len(pending), e))
+                pending, last_flush = [], time.time()
+            if stopping and self._queue.empty():
+                break
+        connection.close()
+
+    @abc.abstractmethod
+    def _write(self, records):
+        '''Writes records with bulk INSERTs (all or nothing).'''
+
+    @abc.abstractmethod
+    def _write_one(self, record):
+        '''Writes a single record.'''
+
+    @abc.abstractmethod
+    def _dump(self, record):
+        '''Record -> JSON serialisable dict (spool file).'''
+
+    @abc.abstractmethod
+    def _load(self, data):
+        '''Spool file dict -> record.'''
+
+    def _flush(self, records):
+        try:
+            self._write(records)
+            self.written += len(records)
+            return
+        except Exception, e:
+            # any record may be bad (DatabaseError, ValueError from a field, ...): isolate it
+            self.logger.error('%s: bulk insert of %i record(s) failed (%s), retrying one by one' % (self.NAME, len(records), e))
+            if isinstance(e, DatabaseError):
+                connection.close()
+
+        failed = []
+        for record in records:
+            try:
+                self._write_one(record)
+                self.written += 1
+            except Exception, e:
+                self.logger.error('%s: record failed (%s)' % (self.NAME, e))
+                if isinstance(e, DatabaseError):
+                    connection.close()
+                failed.append(record)
+        if failed:
+            self._spool(failed)
+
+    @contextmanager
+    def _spool_lock(self):
+        '''Exclusive access to the spool file across processes.'''
+
+        directory = os.path.dirname(self.spool_path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:     # created concurrently
+                    raise
+        with open(self.spool_path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _spool(self, records):
+        if not self.spool_path:
+            self.logger.error('%s: %i record(s) could not be written and no spool file is configured' % (self.NAME, len(records)))
+            return
+        lines = []
+        for record in records:
+            try:
+                lines.append(json.dumps(self._dump(record)) + '\n')
+            except Exception, e:
+                self.logger.error('%s: record lost, it cannot be spooled (%s)' % (self.NAME, e))
+        with self._spool_lock():
+            with open(self.spool_path, 'a') as spool:
+                spool.writelines(lines)
+        self.spooled += len(lines)
+        self.logger.error('%s: %i record(s) spooled to %s' % (self.NAME, len(lines), self.spool_path))
+
+    def _orphaned_replays(self):
+        '''Replay files (<spool>.replay.<pid>) of processes which no longer exist.'''
+
+        for path in glob.glob(self.spool_path + '.replay.*'):
+            try:
+                pid = int(path.rsplit('.', 1)[1])
+            except ValueError:
+                continue
+            if pid == os.getpid() or not _alive(pid):
+                yield path
+
+    def replay_spool(self):
+        '''Writes records spooled by a previous run (bulk); returns their number. The spool file and
+        orphaned replay files are taken over under the lock, so concurrent processes never replay the
+        same records twice.'''
+
+        if not self.spool_path:
+            return 0
+        replay_path = '%s.replay.%i' % (self.spool_path, os.getpid())
+        with self._spool_lock():
+            sources = [path for path in self._orphaned_replays() if path != replay_path]
+            if os.path.exists(self.spool_path):
+                sources.append(self.spool_path)
+            if not sources and not os.path.exists(replay_path):
+                return 0
+            with open(replay_path, 'a') as replay:
+                for path in sources:
+                    with open(path) as source:
+                        shutil.copyfileobj(source, replay)
+                    os.remove(path)
+        with open(replay_path) as spool:
+            records = [self._load(json.loads(line)) for line in spool if line.strip()]
+        for i in range(0, len(records), self.flush_size):
+            self._flush(records[i:i + self.flush_size])
+        os.remove(replay_path)
+        self.logger.info('%s: %i spooled record(s) replayed' % (self.NAME, len(records)))
+        return len(records)
+
+
+def dump_fields(instance, fields):
+    '''Model instance -> dict of field name -> string value (None kept as null).'''
+
+    return dict((field.name, None if getattr(instance, field.attname) is None else field.value_to_string(instance))
+                for field in fields)
+
+
+def load_fields(model, data):
+    '''dump_fields result -> (unsaved) model instance.'''
+
+    values = {}
+    for name, value in data.items():
+        field = model._meta.get_field(name)
+        if value is not None:
+            value = (field.rel.get_related_field() if field.rel else field).to_python(value)
+        values[field.attname] = value
+    return model(**values)
@@ -0,0 +1,152 @@
+'''
+Viatel payment services.
+
+redeem_code/reconcile_day: code redemption. A code is validated and marked as used
+by a single INSERT ... SELECT (batch validity is taken from ViatelBatchCache).
+
+ViatelLogBuffer: HTTP notification ingestion. Notifications are parsed against
+ViatelLog.get_field_names() and written behind the request (see
+Polls.util.write_behind: bulk INSERTs, backpressure via BufferFull, spool file
+replayed on the next start).
+'''
+
+import datetime
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db import IntegrityError
+from django.db import transaction
+from django.utils import timezone
+
+from Polls.models import ViatelBatch, ViatelBatchCache, ViatelCode, ViatelLog, ViatelUsedCode
+from Polls.util.write_behind import WriteBehindBuffer, dump_fields
+
+
+CODE_REDEEMED = 'REDEEMED'
+CODE_UNKNOWN = 'UNKNOWN'
+CODE_ALREADY_USED = 'ALREADY_USED'
+CODE_INVALID_BATCH = 'INVALID_BATCH'
+
+BATCH_CHUNK_SIZE = 500  # batch ids per IN (...) list (one statement per chunk)
+
+
+def _column(model, name):
+    return connection.ops.quote_name(model._meta.get_field(name).column)
+
+
+def _chunks(ids):
+    for i in range(0, len(ids), BATCH_CHUNK_SIZE):
+        yield ids[i:i + BATCH_CHUNK_SIZE]
+
+
+def _redeem_sql(source, where, used_up, batch_ids):
+    '''INSERT INTO ViatelUsedCode ... SELECT codes (c=ViatelCode) FROM source WHERE where,
+    limited to the given batches and to codes not used yet.'''
+
+    qn = connection.ops.quote_name
+    used_table, code_pk = qn(ViatelUsedCode._meta.db_table), qn(ViatelCode._meta.pk.column)
+    return 'INSERT INTO %s (%s, %s) SELECT c.%s, %s FROM %s WHERE %s AND c.%s IN (%s) ' \
+           'AND NOT EXISTS (SELECT 1 FROM %s u WHERE u.%s = c.%s) GROUP BY c.%s' % (
+               used_table, _column(ViatelUsedCode, 'code'), _column(ViatelUsedCode, 'used_up'), code_pk, used_up, source, where,
+               _column(ViatelCode, 'batch'), ', '.join(['%s'] * len(batch_ids)), used_table, _column(ViatelUsedCode, 'code'),
+               code_pk, code_pk)
+
+
+def redeem_code(code, at=None):
+    '''Validates a code and marks it as used in one statement (atomic); returns CODE_REDEEMED or
+    the reason of the rejection (which costs another lookup).'''
+
+    at = at or timezone.now()
+    code_table, code_pk = connection.ops.quote_name(ViatelCode._meta.db_table), connection.ops.quote_name(ViatelCode._meta.pk.column)
+    for batch_ids in _chunks(ViatelBatchCache.valid_batch_ids(at)):
+        try:
+            with transaction.atomic():
+                cursor = connection.cursor()
+                cursor.execute(_redeem_sql('%s c' % code_table, 'c.%s = %%s' % code_pk, '%s', batch_ids), [at, code] + batch_ids)
+                if cursor.rowcount:
+                    return CODE_REDEEMED
+        except IntegrityError:  # redeemed concurrently
+            return CODE_ALREADY_USED
+
+    if not ViatelCode.objects.filter(pk=code).exists():
+        return CODE_UNKNOWN
+    if ViatelUsedCode.objects.filter(code=code).exists():
+        return CODE_ALREADY_USED
+    return CODE_INVALID_BATCH
+
+
+def reconcile_day(day):
+    '''Redeems (bulk, one statement) all codes entered in calls logged on the given day, checking the batch
+    validity at the time of the call. Returns dict(calls, redeemed).'''
+
+    start = datetime.datetime(day.year, day.month, day.day)
+    if settings.USE_TZ:
+        start = timezone.make_aware(start, timezone.get_current_timezone())
+    end = start + datetime.timedelta(days=1)
+    calls = ViatelLog.objects.filter(time__gte=start, time__lt=end, input__isnull=False).count()
+    batch_ids = ViatelBatchCache.active_batch_ids()
+    if not calls or not batch_ids:
+        return dict(calls=calls, redeemed=0)
+
+    qn = connection.ops.quote_name
+    log_time, valid_from, valid_to = _column(ViatelLog, 'time'), _column(ViatelBatch, 'valid_from'), _column(ViatelBatch, 'valid_to')
+    source = '%s l JOIN %s c ON c.%s = l.%s JOIN %s b ON b.%s = c.%s' % (
+        qn(ViatelLog._meta.db_table), qn(ViatelCode._meta.db_table), qn(ViatelCode._meta.pk.column), _column(ViatelLog, 'input'),
+        qn(ViatelBatch._meta.db_table), qn(ViatelBatch._meta.pk.column), _column(ViatelCode, 'batch'))
+    where = 'l.%s >= %%s AND l.%s < %%s AND (b.%s IS NULL OR b.%s <= l.%s) AND (b.%s IS NULL OR l.%s <= b.%s)' % (
+        log_time, log_time, valid_from, valid_from, log_time, valid_to, log_time, valid_to)
+    redeemed = 0
+    with transaction.atomic():
+        cursor = connection.cursor()
+        for chunk in _chunks(batch_ids):
+            cursor.execute(_redeem_sql(source, where, 'MIN(l.%s)' % log_time, chunk), [start, end] + chunk)
+            redeemed += cursor.rowcount
+    return dict(calls=calls, redeemed=redeemed)
+
+
+def parse_notification(params):
+    '''Maps notification parameters onto a (not yet saved) ViatelLog; raises ValidationError
+    for invalid values or missing mandatory parameters.'''
+
+    values = {}
+    for name in ViatelLog.get_field_names():
+        field = ViatelLog._meta.get_field(name)
+        if field.primary_key:
+            continue
+        if name in params:
+            values[field.attname] = field.to_python(params[name])
+        elif not field.null and (not field.has_default() or field.default is None):    # default=None: mandatory
+            raise ValidationError('Missing parameter: %s' % name)
+    return ViatelLog(**values)
+
+
+class ViatelLogBuffer(WriteBehindBuffer):
+
+    NAME = 'Viatel log'
+
+    def __init__(self, flush_size=WriteBehindBuffer.FLUSH_SIZE, flush_interval=WriteBehindBuffer.FLUSH_INTERVAL,
+                 max_pending=WriteBehindBuffer.MAX_PENDING, spool_path=None, logger=None):
+        super(ViatelLogBuffer, self).__init__(flush_size, flush_interval, max_pending,
+                                              spool_path or getattr(settings, 'VIATEL_LOG_SPOOL', None), logger)
+
+    def submit(self, params, timeout=None):
+        '''Parses and queues a notification; returns immediately (or waits up to timeout seconds
+        for free space). Raises ValidationError/BufferFull.'''
+
+        self.put(parse_notification(params), timeout)
+
+    def _write(self, records):
+        ViatelLog.objects.bulk_create(records)
+
+    def _write_one(self, record):
+        record.save(force_insert=True)
+
+    def _dump(self, record):
+        return dump_fields(record, [field for field in ViatelLog._meta.fields if not field.primary_key])
+
+    def _load(self, data):
+        return parse_notification(data)
+
+
+viatel_log_buffer = ViatelLogBuffer()
@@ -1,3 +1,20 @@
+from django.core.exceptions import ValidationError
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.shortcuts import render
+from django.views.decorators.csrf import csrf_exempt
 
-# Create your views here.
+from Polls.util.write_behind import BufferFull
+from Polls.viatel import viatel_log_buffer
+
+
+@csrf_exempt
+def viatel_notification(request):
+    '''Viatel HTTP notification listener: queues the notification and returns immediately.'''
+
+    try:
+        viatel_log_buffer.submit(request.POST or request.GET)
+    except ValidationError, e:
+        return HttpResponseBadRequest('; '.join(e.messages))
+    except BufferFull:
+        return HttpResponse('BUSY', status=503)
+    return HttpResponse('OK')